@@ -0,0 +1,63 @@
+"""Esquema inicial de la BD de conversaciones (sesiones, mensajes y turnos asíncronos)
+
+Las BDs creadas antes con metadata.create_all ya tienen este esquema: basta con `alembic stamp 0001`.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "chat_sessions",
+        sa.Column("id", sa.String(36), primary_key=True),
+        sa.Column("user_id", sa.String(255), nullable=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+        sa.Column("updated_at", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("session_data", sa.Text, nullable=True),
+    )
+    op.create_index("ix_chat_sessions_id", "chat_sessions", ["id"])
+    op.create_index("ix_chat_sessions_user_id", "chat_sessions", ["user_id"])
+
+    op.create_table(
+        "chat_messages",
+        sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column("session_id", sa.String(36), sa.ForeignKey("chat_sessions.id"), nullable=False),
+        sa.Column("sender", sa.String(50), nullable=False),
+        sa.Column("message", sa.Text, nullable=False),
+        sa.Column("timestamp", sa.DateTime(timezone=True), server_default=sa.func.now()),
+    )
+    op.create_index("ix_chat_messages_id", "chat_messages", ["id"])
+
+    op.create_table(
+        "chat_turns",
+        sa.Column("id", sa.String(36), primary_key=True),
+        sa.Column("session_id", sa.String(36), sa.ForeignKey("chat_sessions.id"), nullable=False),
+        sa.Column("user_id", sa.String(255), nullable=True),
+        sa.Column("message", sa.Text, nullable=False),
+        sa.Column("status", sa.String(20), nullable=False),
+        sa.Column("response", sa.Text, nullable=True),
+        sa.Column("error", sa.Text, nullable=True),
+        sa.Column("attempts", sa.Integer, nullable=False),
+        sa.Column("worker_id", sa.String(100), nullable=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+        sa.Column("started_at", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("heartbeat_at", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("finished_at", sa.DateTime(timezone=True), nullable=True),
+    )
+    op.create_index("ix_chat_turns_session_id", "chat_turns", ["session_id"])
+    op.create_index("ix_chat_turns_status_created", "chat_turns", ["status", "created_at"])
+
+
+def downgrade() -> None:
+    op.drop_table("chat_turns")
+    op.drop_table("chat_messages")
+    op.drop_table("chat_sessions")
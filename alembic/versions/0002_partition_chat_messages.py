@@ -0,0 +1,58 @@
+"""Particionado mensual de chat_messages
+
+MySQL exige que la columna de partición forme parte de todas las claves únicas y no admite
+claves foráneas en tablas particionadas, así que:
+- se elimina la FK chat_messages.session_id -> chat_sessions.id (la integridad la mantiene la app),
+- `timestamp` pasa a NOT NULL y la PK a (id, timestamp),
+- se añade el índice (session_id, timestamp) que usan las lecturas de historial.
+En tablas grandes conviene ejecutar esta migración en una ventana de mantenimiento.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-19
+"""
+from datetime import date
+
+from alembic import op
+import sqlalchemy as sa
+
+from app.core.config import settings
+from app.db.partitioning import add_months, month_start, partition_by_clause
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def _foreign_keys_to_sessions(bind):
+    return bind.execute(sa.text(
+        "SELECT CONSTRAINT_NAME FROM information_schema.KEY_COLUMN_USAGE "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'chat_messages' "
+        "AND REFERENCED_TABLE_NAME = 'chat_sessions'"
+    )).scalars().all()
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    for fk_name in _foreign_keys_to_sessions(bind):
+        op.drop_constraint(fk_name, "chat_messages", type_="foreignkey")
+    op.create_index("ix_chat_messages_session_ts", "chat_messages", ["session_id", "timestamp"])
+
+    op.execute("UPDATE chat_messages SET `timestamp` = NOW() WHERE `timestamp` IS NULL")
+    op.execute("ALTER TABLE chat_messages MODIFY `timestamp` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP")
+    # ix_chat_messages_id mantiene indexada la columna AUTO_INCREMENT mientras se cambia la PK
+    op.execute("ALTER TABLE chat_messages DROP PRIMARY KEY, ADD PRIMARY KEY (id, `timestamp`)")
+
+    oldest = bind.execute(sa.text("SELECT MIN(`timestamp`) FROM chat_messages")).scalar()
+    first_month = month_start(oldest.date() if oldest else date.today())
+    last_month = add_months(month_start(date.today()), settings.PARTITION_MONTHS_AHEAD)
+    op.execute(f"ALTER TABLE chat_messages {partition_by_clause(first_month, last_month)}")
+
+
+def downgrade() -> None:
+    op.execute("ALTER TABLE chat_messages REMOVE PARTITIONING")
+    op.execute("ALTER TABLE chat_messages DROP PRIMARY KEY, ADD PRIMARY KEY (id)")
+    op.execute("ALTER TABLE chat_messages MODIFY `timestamp` DATETIME NULL DEFAULT CURRENT_TIMESTAMP")
+    op.drop_index("ix_chat_messages_session_ts", table_name="chat_messages")
+    op.create_foreign_key(None, "chat_messages", "chat_sessions", ["session_id"], ["id"])
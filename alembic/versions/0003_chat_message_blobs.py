@@ -0,0 +1,32 @@
+"""Tabla chat_message_blobs para payloads grandes de tools, comprimidos y fuera de chat_messages
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.mysql import LONGBLOB
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "chat_message_blobs",
+        sa.Column("id", sa.String(36), primary_key=True),
+        sa.Column("session_id", sa.String(36), nullable=False),
+        sa.Column("codec", sa.String(10), nullable=False),
+        sa.Column("raw_size", sa.Integer, nullable=False),
+        sa.Column("data", sa.LargeBinary().with_variant(LONGBLOB(), "mysql"), nullable=False),
+        sa.Column("created_at", sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+    )
+    op.create_index("ix_chat_message_blobs_session_id", "chat_message_blobs", ["session_id"])
+    op.create_index("ix_chat_message_blobs_created_at", "chat_message_blobs", ["created_at"])
+
+
+def downgrade() -> None:
+    op.drop_table("chat_message_blobs")
@@ -0,0 +1,46 @@
+"""Tabla materialized_query_results: agregaciones frecuentes de la BD externa materializadas
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-19
+"""
+import os
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.mysql import LONGBLOB
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+# Mismo esquema que el modelo (MATERIALIZE_SCHEMA); debe existir antes de migrar
+SCHEMA = os.getenv("MATERIALIZE_SCHEMA") or None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "materialized_query_results",
+        sa.Column("id", sa.String(40), primary_key=True),
+        sa.Column("db_key", sa.String(16), nullable=False),
+        sa.Column("db_label", sa.String(255), nullable=True),
+        sa.Column("fingerprint", sa.String(16), nullable=False),
+        sa.Column("canonical_sql", sa.Text, nullable=False),
+        sa.Column("source_tables", sa.Text, nullable=False),
+        sa.Column("source_versions", sa.Text, nullable=False),
+        sa.Column("codec", sa.String(10), nullable=False),
+        sa.Column("result", sa.LargeBinary().with_variant(LONGBLOB(), "mysql"), nullable=False),
+        sa.Column("row_count", sa.Integer, nullable=False),
+        sa.Column("build_ms", sa.Integer, nullable=False),
+        sa.Column("score", sa.Integer, nullable=False),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+        sa.Column("refreshed_at", sa.DateTime(timezone=True), nullable=False),
+        schema=SCHEMA,
+    )
+    op.create_index("ix_materialized_query_results_fingerprint", "materialized_query_results", ["fingerprint"], schema=SCHEMA)
+    op.create_index("ix_materialized_query_results_db_score", "materialized_query_results", ["db_key", "score"], schema=SCHEMA)
+
+
+def downgrade() -> None:
+    op.drop_table("materialized_query_results", schema=SCHEMA)
@@ -0,0 +1,40 @@
+"""Tabla tool_query_log: registro de las consultas de las tools SQL
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "tool_query_log",
+        sa.Column("id", sa.BigInteger, primary_key=True, autoincrement=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("fingerprint", sa.String(16), nullable=True),
+        sa.Column("normalized_sql", sa.Text, nullable=True),
+        sa.Column("sql_text", sa.Text, nullable=True),
+        sa.Column("engine", sa.String(20), nullable=False),
+        sa.Column("db_label", sa.String(255), nullable=True),
+        sa.Column("tenant_id", sa.String(64), nullable=True),
+        sa.Column("session_id", sa.String(36), nullable=True),
+        sa.Column("source", sa.String(20), nullable=False),
+        sa.Column("latency_ms", sa.Float, nullable=False),
+        sa.Column("rows_returned", sa.Integer, nullable=True),
+        sa.Column("rows_examined", sa.BigInteger, nullable=True),
+        sa.Column("result_bytes", sa.Integer, nullable=True),
+        sa.Column("error", sa.Text, nullable=True),
+    )
+    op.create_index("ix_tool_query_log_created", "tool_query_log", ["created_at"])
+    op.create_index("ix_tool_query_log_fingerprint_created", "tool_query_log", ["fingerprint", "created_at"])
+
+
+def downgrade() -> None:
+    op.drop_table("tool_query_log")
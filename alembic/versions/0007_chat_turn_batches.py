@@ -0,0 +1,25 @@
+"""chat_turns.batch_id/batch_index: turnos de los lotes de POST /batch
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column("chat_turns", sa.Column("batch_id", sa.String(36), nullable=True))
+    op.add_column("chat_turns", sa.Column("batch_index", sa.Integer, nullable=True))
+    op.create_index("ix_chat_turns_batch", "chat_turns", ["batch_id", "batch_index"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_chat_turns_batch", table_name="chat_turns")
+    op.drop_column("chat_turns", "batch_index")
+    op.drop_column("chat_turns", "batch_id")
@@ -0,0 +1,41 @@
+"""chat_sessions.session_data como JSON nativo, con columnas generadas e índices para tenant_id y channel
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0008"
+down_revision = "0007"
+branch_labels = None
+depends_on = None
+
+# Mismas claves y longitud que SESSION_METADATA_INDEXED_KEYS / SESSION_METADATA_MAX_LENGTH en app/db/models_conversation.py
+INDEXED_KEYS = ("tenant_id", "channel")
+MAX_LENGTH = 64
+
+
+def upgrade() -> None:
+    # El texto que no sea JSON válido se conserva envuelto en un objeto para que el cambio de tipo no falle
+    op.execute(
+        "UPDATE chat_sessions SET session_data = JSON_OBJECT('legacy_session_data', session_data) "
+        "WHERE session_data IS NOT NULL AND JSON_VALID(session_data) = 0"
+    )
+    op.execute("UPDATE chat_sessions SET session_data = NULL WHERE session_data = 'null'")
+    op.alter_column("chat_sessions", "session_data", type_=sa.JSON, existing_type=sa.Text, existing_nullable=True)
+    for key in INDEXED_KEYS:
+        # SUBSTR: los valores existentes más largos que la columna no hacen fallar la migración
+        op.add_column("chat_sessions", sa.Column(
+            f"meta_{key}", sa.String(MAX_LENGTH),
+            sa.Computed(f"SUBSTR(session_data ->> '$.{key}', 1, {MAX_LENGTH})", persisted=False),
+        ))
+        op.create_index(f"ix_chat_sessions_meta_{key}", "chat_sessions", [f"meta_{key}", "created_at"])
+
+
+def downgrade() -> None:
+    for key in INDEXED_KEYS:
+        op.drop_index(f"ix_chat_sessions_meta_{key}", table_name="chat_sessions")
+        op.drop_column("chat_sessions", f"meta_{key}")
+    op.alter_column("chat_sessions", "session_data", type_=sa.Text, existing_type=sa.JSON, existing_nullable=True)
@@ -1,12 +1,30 @@
 import uuid
-import json
-from typing import List, Optional # Importa List y Optional
-from fastapi import APIRouter, Depends, HTTPException, Body, status # Importa status
+from datetime import datetime
+from typing import Any, Dict, List, Optional # Importa List y Optional
+from fastapi import APIRouter, Depends, HTTPException, Body, Query, Request, WebSocket, status # Importa status
+from fastapi.responses import JSONResponse, StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
+from app.core.config import settings
+from app.core import jsonutil
 from app.db.database import get_conv_db
-from app.schemas.chat import ChatMessageCreate, ChatMessageResponse, SessionCreate, SessionResponse
+from app.schemas.chat import (
+    ChatMessageCreate, ChatMessageResponse, SessionCreate, SessionResponse,
+    TurnAcceptedResponse, TurnStatusResponse, BulkDeleteRequest, BulkDeleteStatusResponse,
+    BatchRequest, BatchAcceptedResponse, BatchStatusResponse, check_indexed_metadata
+)
+from app.db.models_conversation import SESSION_METADATA_MAX_LENGTH
 from app.services.chat_orchestrator import ChatOrchestrator
+from app.services.chat_socket import ChatSocketConnection
+from app.services.admission import admission_controller, session_locks, AdmissionRejected
 from app.crud import crud_conversation # Para crear/obtener/eliminar sesiones y mensajes
+from app.crud import crud_turn
+from app.db.blob_store import is_blob_ref
+from app.services.turn_worker import turn_worker_pool
+from app.services.batch_runner import batch_runner
+from app.services.session_cleanup import bulk_session_deleter
+from app.services.conversation_export import export_ndjson
+from app.tools.tenant_tools import TenantNotFoundError
+from app.services.llm_rate_limiter import LLMUnavailableError
 
 router = APIRouter()
 
@@ -28,7 +46,7 @@ async def create_new_chat_session(
             session_id=session.id,
             user_id=session.user_id,
             created_at=session.created_at,
-            metadata=json.loads(session.metadata) if session.metadata else None
+            metadata=session.session_data
         )
     except Exception as e:
         print(f"Error creando sesión: {e}")
@@ -36,10 +54,16 @@ async def create_new_chat_session(
 
 
 # Endpoint principal para enviar mensajes a una sesión existente
-@router.post("/sessions/{session_id}/messages", response_model=ChatMessageResponse)
+@router.post(
+    "/sessions/{session_id}/messages",
+    response_model=ChatMessageResponse,
+    responses={status.HTTP_202_ACCEPTED: {"model": TurnAcceptedResponse}}
+)
 async def post_chat_message(
     session_id: str,
     message_in: ChatMessageCreate,
+    request: Request,
+    async_mode: bool = Query(False, alias="async"), # ?async=true: encola el turno y responde 202
     db: AsyncSession = Depends(get_conv_db)
 ):
     # Verificar si la sesión existe
@@ -47,16 +71,51 @@ async def post_chat_message(
     if not session:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Sesión de chat no encontrada.")
 
-    orchestrator = ChatOrchestrator(db_session=db, session_id=session_id, user_id=message_in.user_id or session.user_id)
-    
+    user_id = message_in.user_id or session.user_id
+
+    if async_mode:
+        turn = await crud_turn.create_turn(
+            db, turn_id=str(uuid.uuid4()), session_id=session_id, message=message_in.message, user_id=user_id
+        )
+        turn_worker_pool.notify_new_turn()
+        accepted = TurnAcceptedResponse(
+            turn_id=turn.id,
+            session_id=session_id,
+            status_url=str(request.url_for("get_turn_status", turn_id=turn.id))
+        )
+        return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=accepted.model_dump())
+
+    # Sin user_id, los límites por usuario se aplican por IP del cliente
+    user_key = user_id or f"ip:{request.client.host if request.client else 'unknown'}"
+    await db.rollback() # Libera la conexión mientras el turno espera en la cola de admisión
+
     try:
-        response = await orchestrator.handle_user_message(message_in.message)
-        return response
+        async with admission_controller.admit(user_key), session_locks.hold(session_id):
+            orchestrator = ChatOrchestrator(db_session=db, session_id=session_id, user_id=user_id)
+            response = await orchestrator.handle_user_message(message_in.message)
+            return response
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+    except TenantNotFoundError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except LLMUnavailableError as e:
+        # El mensaje del usuario queda guardado sin respuesta; el siguiente turno lo incluye en el prompt
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=e.detail,
+            headers={"Retry-After": str(e.retry_after_seconds)}
+        )
     except Exception as e:
         print(f"Error en el endpoint de chat: {e}")
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Ocurrió un error interno en el servidor: {str(e)}")
 
 
+# Canal WebSocket de la sesión: el orquestador y el historial viven lo que dure la conexión y la
+# respuesta llega en streaming (progreso de tools y fragmentos de texto). Protocolo en app/services/chat_socket.py
+@router.websocket("/sessions/{session_id}/ws")
+async def chat_websocket(websocket: WebSocket, session_id: str, user_id: Optional[str] = None):
+    await ChatSocketConnection(websocket, session_id, user_id=user_id).serve()
+
+
 # --- app/api/v1/endpoints/chat.py (Fragmento de código) ---
 
 # ... Tus importaciones existentes (uuid, json, List, Optional, APIRouter, Depends, HTTPException, Body, status)
@@ -86,24 +145,91 @@ async def delete_conversation(session_id: str, db: AsyncSession = Depends(get_co
 # --- Fin del fragmento de código ---
 
 
+@router.delete(
+    "/sessions",
+    response_model=BulkDeleteStatusResponse,
+    status_code=status.HTTP_202_ACCEPTED
+)
+async def bulk_delete_sessions(
+    request: Request,
+    user_id: Optional[str] = None,
+    before: Optional[datetime] = Query(None, description="Solo sesiones creadas antes de esta fecha"),
+    body: Optional[BulkDeleteRequest] = Body(None)
+):
+    """
+    Elimina en segundo plano todas las sesiones que cumplan los filtros (`user_id`, `before` y/o
+    la lista `session_ids` del cuerpo) junto con sus mensajes y turnos. Retorna 202 con la URL
+    para consultar el progreso.
+    """
+    session_ids = body.session_ids if body else None
+    if not user_id and not before and session_ids is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Indica al menos un filtro: user_id, before o session_ids."
+        )
+    job = await bulk_session_deleter.submit(user_id=user_id, before=before, session_ids=session_ids)
+    return BulkDeleteStatusResponse(
+        **job, status_url=str(request.url_for("get_bulk_delete_status", job_id=job["job_id"]))
+    )
+
+
+@router.get(
+    "/sessions/deletions/{job_id}",
+    response_model=BulkDeleteStatusResponse,
+    name="get_bulk_delete_status"
+)
+async def get_bulk_delete_status(job_id: str):
+    """Progreso de un borrado masivo: sesiones y mensajes eliminados hasta ahora."""
+    job = await bulk_session_deleter.get_status(job_id)
+    if not job:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Trabajo de borrado no encontrado.")
+    return BulkDeleteStatusResponse(**job)
+
+
 @router.get("/sessions", response_model=List[SessionResponse]) # Cambiado a SessionResponse para más detalle
-async def list_user_sessions(user_id: Optional[str] = None, db: AsyncSession = Depends(get_conv_db)):
+async def list_user_sessions(
+    user_id: Optional[str] = None,
+    tenant_id: Optional[str] = Query(None, max_length=SESSION_METADATA_MAX_LENGTH, description="Solo sesiones con este tenant_id en la metadata (indexado)"),
+    channel: Optional[str] = Query(None, max_length=SESSION_METADATA_MAX_LENGTH, description="Solo sesiones con este channel en la metadata (indexado)"),
+    db: AsyncSession = Depends(get_conv_db)
+):
     """
-    Lista todas las sesiones de conversación, opcionalmente filtradas por user_id.
+    Lista todas las sesiones de conversación, opcionalmente filtradas por user_id y por tenant_id / channel de la metadata.
     """
-    sessions = await crud_conversation.get_all_sessions(db, user_id=user_id)
+    metadata_filters = {key: value for key, value in (("tenant_id", tenant_id), ("channel", channel)) if value is not None}
+    sessions = await crud_conversation.get_all_sessions(db, user_id=user_id, metadata_filters=metadata_filters)
     return [
         SessionResponse(
             session_id=s.id,
             user_id=s.user_id,
             created_at=s.created_at,
-            # --- ¡CAMBIO AQUÍ! Usar 's.session_data' en lugar de 's.metadata' ---
-            # --- Y manejar el caso de que no sea un JSON válido si hay datos antiguos/corruptos ---
-            metadata=json.loads(s.session_data) if s.session_data else None # <-- LÍNEA CORREGIDA
+            metadata=s.session_data # JSON nativo: ya llega decodificado
         ) for s in sessions
     ]
 
 
+@router.patch("/sessions/{session_id}/metadata", response_model=SessionResponse)
+async def patch_session_metadata(
+    session_id: str,
+    patch: Dict[str, Any] = Body(...),
+    db: AsyncSession = Depends(get_conv_db)
+):
+    """
+    Actualización parcial y atómica de la metadata (semántica de JSON merge patch): las claves enviadas
+    se añaden o reemplazan, las que llevan null se eliminan y el resto se conserva.
+    """
+    try:
+        check_indexed_metadata(patch)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+    if not await crud_conversation.update_session_metadata(db, session_id, patch):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Sesión de chat no encontrada.")
+    session = await crud_conversation.get_chat_session(db, session_id)
+    return SessionResponse(
+        session_id=session.id, user_id=session.user_id, created_at=session.created_at, metadata=session.session_data
+    )
+
+
 @router.get("/sessions/{session_id}/messages", response_model=List[ChatMessageResponse])
 async def get_conversation_messages(session_id: str, db: AsyncSession = Depends(get_conv_db)):
     """
@@ -120,7 +246,7 @@ async def get_conversation_messages(session_id: str, db: AsyncSession = Depends(
         message_content = msg.message
         # Intentar parsear el contenido si es JSON (como tool_calls/responses guardadas)
         try:
-            parsed_content = json.loads(message_content)
+            parsed_content = jsonutil.loads(message_content)
             if isinstance(parsed_content, list) and all(isinstance(p, dict) for p in parsed_content):
                 # Si son partes, extraer el texto si existe o una representación de la tool
                 text_parts = [p.get("text") for p in parsed_content if "text" in p]
@@ -133,8 +259,13 @@ async def get_conversation_messages(session_id: str, db: AsyncSession = Depends(
                     responses_content = []
                     for p in parsed_content:
                         if "function_response" in p and p["function_response"].get("response"):
-                            # Asumimos que la respuesta de la tool es un dict con 'content'
-                            responses_content.append(str(p["function_response"]["response"].get("content", "...")))
+                            tool_response = p["function_response"]["response"]
+                            if is_blob_ref(tool_response):
+                                # Payload guardado fuera de línea: basta el extracto, sin descomprimir
+                                responses_content.append(f"{tool_response.get('preview', '')}...")
+                            else:
+                                # Asumimos que la respuesta de la tool es un dict con 'content'
+                                responses_content.append(str(tool_response.get("content", "...")))
                     if responses_content:
                         message_content = f"[Respuesta de la herramienta: {', '.join(responses_content)}]"
                     else:
@@ -144,9 +275,13 @@ async def get_conversation_messages(session_id: str, db: AsyncSession = Depends(
             elif "function_call" in parsed_content:
                 message_content = f"[El asistente utilizó la herramienta: {parsed_content['function_call']['name']}]"
             elif "function_response" in parsed_content:
-                message_content = f"[Respuesta de la herramienta: {parsed_content['function_response']['response'].get('content', '...')}]"
+                tool_response = parsed_content['function_response']['response']
+                if is_blob_ref(tool_response):
+                    message_content = f"[Respuesta de la herramienta: {tool_response.get('preview', '')}...]"
+                else:
+                    message_content = f"[Respuesta de la herramienta: {tool_response.get('content', '...')}]"
             
-        except (json.JSONDecodeError, TypeError):
+        except (jsonutil.JSONDecodeError, TypeError):
             # Es texto plano o no se puede parsear, no hacer nada
             pass
 
@@ -156,4 +291,115 @@ async def get_conversation_messages(session_id: str, db: AsyncSession = Depends(
             sender=msg.sender,
             created_at=msg.timestamp # <--- ¡CAMBIO AQUÍ! Should be 'timestamp'
         ))
-    return formatted_messages
\ No newline at end of file
+    return formatted_messages
+
+
+def _export_response(chunks, filename: str, compress: bool) -> StreamingResponse:
+    if compress:
+        return StreamingResponse(
+            chunks, media_type="application/gzip",
+            headers={"Content-Disposition": f'attachment; filename="{filename}.ndjson.gz"'}
+        )
+    return StreamingResponse(
+        chunks, media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}.ndjson"'}
+    )
+
+
+@router.get("/sessions/{session_id}/export")
+async def export_conversation(
+    session_id: str,
+    gzip: bool = Query(False, description="Comprimir el flujo en gzip"),
+    db: AsyncSession = Depends(get_conv_db)
+):
+    """
+    Exporta todos los mensajes de una conversación como NDJSON (un mensaje por línea), leídos
+    con un cursor del lado del servidor y enviados en streaming.
+    """
+    session = await crud_conversation.get_chat_session(db, session_id)
+    if not session:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Sesión de chat no encontrada.")
+    return _export_response(export_ndjson(session_id=session_id, compress=gzip), f"session_{session_id}", gzip)
+
+
+@router.get("/export")
+async def export_conversations(
+    user_id: Optional[str] = None,
+    since: Optional[datetime] = Query(None, description="Solo mensajes desde esta fecha"),
+    gzip: bool = Query(False, description="Comprimir el flujo en gzip")
+):
+    """Exportación masiva en NDJSON de los mensajes de todas las sesiones que cumplan los filtros."""
+    return _export_response(export_ndjson(user_id=user_id, since=since, compress=gzip), "conversations", gzip)
+
+
+@router.get("/turns/{turn_id}", response_model=TurnStatusResponse, name="get_turn_status")
+async def get_turn_status(
+    turn_id: str,
+    wait: float = Query(0, ge=0, description="Segundos a esperar (long-poll) a que el turno termine")
+):
+    """
+    Consulta el estado de un turno asíncrono. Con `wait` > 0 la petición se mantiene abierta
+    hasta que el turno termine o se agote el tiempo (máximo TURN_LONG_POLL_MAX_SECONDS).
+    """
+    turn = await turn_worker_pool.wait_for_turn(turn_id, timeout=min(wait, settings.TURN_LONG_POLL_MAX_SECONDS))
+    if not turn:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Turno no encontrado.")
+    return TurnStatusResponse(
+        turn_id=turn.id,
+        session_id=turn.session_id,
+        status=turn.status,
+        created_at=turn.created_at,
+        started_at=turn.started_at,
+        finished_at=turn.finished_at,
+        result=ChatMessageResponse.model_validate_json(turn.response) if turn.response else None,
+        error=turn.error
+    )
+
+
+@router.post(
+    "/batch",
+    responses={status.HTTP_202_ACCEPTED: {"model": BatchAcceptedResponse}}
+)
+async def run_batch(
+    batch: BatchRequest,
+    request: Request,
+    mode: str = Query("stream", pattern="^(stream|job)$", description="stream: NDJSON en vivo; job: lote en segundo plano")
+):
+    """
+    Ejecuta un lote de preguntas (evaluaciones, informes). Cada pregunta sin `session_id` va en una
+    sesión nueva; las de una misma sesión se ejecutan en orden, como una conversación.
+
+    - `mode=stream`: responde NDJSON con un resultado por línea (BatchItemResult) según terminan.
+    - `mode=job`: encola el lote para los workers de turnos y responde 202 con la URL de estado.
+    """
+    if len(batch.questions) > settings.BATCH_MAX_QUESTIONS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"El lote admite como máximo {settings.BATCH_MAX_QUESTIONS} preguntas."
+        )
+    batch_id = str(uuid.uuid4())
+    if mode == "job":
+        await batch_runner.submit(batch_id, batch.questions, user_id=batch.user_id, metadata=batch.metadata)
+        turn_worker_pool.notify_new_turn()
+        accepted = BatchAcceptedResponse(
+            batch_id=batch_id,
+            total=len(batch.questions),
+            status_url=str(request.url_for("get_batch_status", batch_id=batch_id))
+        )
+        return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=accepted.model_dump())
+    return StreamingResponse(
+        batch_runner.stream(
+            batch_id, batch.questions, user_id=batch.user_id, metadata=batch.metadata, concurrency=batch.concurrency
+        ),
+        media_type="application/x-ndjson",
+        headers={"X-Batch-Id": batch_id}
+    )
+
+
+@router.get("/batch/{batch_id}", response_model=BatchStatusResponse, name="get_batch_status")
+async def get_batch_status(batch_id: str):
+    """Estado de un lote en modo job: contadores por estado y el resultado de cada pregunta terminada."""
+    batch = await batch_runner.status(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Lote no encontrado.")
+    return BatchStatusResponse(**batch)
@@ -0,0 +1,67 @@
+# app/api/v1/endpoints/metrics.py
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.crud import crud_materialized, crud_query_log
+from app.db.database import get_conv_db
+from app.services.index_advisor import index_advisor
+from app.services.llm_rate_limiter import llm_rate_limiter
+from app.services.model_router import model_router
+from app.services.query_log import query_log
+from app.services.query_materializer import query_materializer
+from app.tools.tenant_tools import tenant_tool_cache
+
+router = APIRouter()
+
+# Estadísticas de este proceso (con varios workers, cada uno responde con las suyas)
+@router.get("/metrics/tenant-pools")
+async def get_tenant_pool_metrics() -> Dict[str, Any]:
+    """Caché LRU de tools/pools por tenant: aciertos, creaciones, expulsiones y tenants abiertos."""
+    return tenant_tool_cache.stats()
+
+@router.get("/metrics/materialized-queries")
+async def get_materialized_query_metrics(db: AsyncSession = Depends(get_conv_db)) -> Dict[str, Any]:
+    """Aciertos de las agregaciones materializadas (de este proceso) y las materializaciones vigentes (top-N por BD)."""
+    return {
+        **query_materializer.stats(),
+        "materializations": await crud_materialized.list_materialized_summaries(db),
+    }
+
+@router.get("/metrics/llm-routing")
+async def get_llm_routing_metrics() -> Dict[str, Any]:
+    """Decisiones del enrutado de modelos (por nivel y motivo), escalados y latencia por modelo (p50/p95)."""
+    return model_router.stats()
+
+@router.get("/metrics/llm-quota")
+async def get_llm_quota_metrics() -> Dict[str, Any]:
+    """Limitador de cuota del LLM: profundidad de la cola, esperas, rechazos, 429 recibidos y cuota por modelo."""
+    return llm_rate_limiter.stats()
+
+# Informes sobre tool_query_log (todas las consultas de las tools, de todos los workers)
+@router.get("/metrics/queries")
+async def get_query_report(
+    hours: float = Query(24, gt=0, le=24 * 90),
+    limit: int = Query(20, ge=1, le=200),
+    db: AsyncSession = Depends(get_conv_db),
+) -> Dict[str, Any]:
+    """Consultas por huella: las de más tiempo acumulado, las más lentas de media y las más frecuentes."""
+    since = datetime.utcnow() - timedelta(hours=hours)
+    return {
+        "since": since.isoformat(),
+        "logger": query_log.stats(),
+        "most_time": await crud_query_log.get_fingerprint_report(db, since, "total", limit),
+        "slowest": await crud_query_log.get_fingerprint_report(db, since, "avg", limit),
+        "most_frequent": await crud_query_log.get_fingerprint_report(db, since, "calls", limit),
+    }
+
+@router.get("/metrics/queries/index-suggestions")
+async def get_index_suggestions(
+    hours: float = Query(24, gt=0, le=24 * 90),
+    limit: int = Query(10, ge=1, le=50),
+    db: AsyncSession = Depends(get_conv_db),
+) -> List[Dict[str, Any]]:
+    """Índices sugeridos (EXPLAIN contra la BD de cada consulta) para las `limit` consultas más costosas."""
+    return await index_advisor.suggest(db, datetime.utcnow() - timedelta(hours=hours), limit)
@@ -1,5 +1,6 @@
 # app/core/config.py
 import os
+from urllib.parse import quote_plus
 from pydantic_settings import BaseSettings
 from dotenv import load_dotenv
 
@@ -15,7 +16,58 @@ class Settings(BaseSettings):
     CONVERSATION_DB_HOST: str = os.getenv("CONVERSATION_DB_HOST", "db_conversation")
     CONVERSATION_DB_PORT: str = os.getenv("CONVERSATION_DB_PORT", "3306")
     CONVERSATION_DB_NAME: str = os.getenv("CONVERSATION_DB_NAME", "conversation_db")
-    CONVERSATION_DB_URL: str = f"mysql+aiomysql://{CONVERSATION_DB_USER}:{CONVERSATION_DB_PASSWORD}@{CONVERSATION_DB_HOST}:{CONVERSATION_DB_PORT}/{CONVERSATION_DB_NAME}"
+    # Usuario y contraseña se escapan para que caracteres como ':' o '@' no rompan la URL
+    CONVERSATION_DB_URL: str = f"mysql+aiomysql://{quote_plus(CONVERSATION_DB_USER)}:{quote_plus(CONVERSATION_DB_PASSWORD)}@{CONVERSATION_DB_HOST}:{CONVERSATION_DB_PORT}/{CONVERSATION_DB_NAME}"
+
+    # Arranque: "create_all" (crea tablas con SQLAlchemy, desarrollo), "check" (solo verifica la
+    # revisión de Alembic, sin DDL) o "skip"
+    DB_SCHEMA_STARTUP: str = os.getenv("DB_SCHEMA_STARTUP", "create_all")
+    STARTUP_WARM_CONNECTIONS: int = int(os.getenv("STARTUP_WARM_CONNECTIONS", "2"))
+    STARTUP_BUDGET_SECONDS: float = float(os.getenv("STARTUP_BUDGET_SECONDS", "10"))
+    STARTUP_RETRY_MAX_BACKOFF_SECONDS: float = float(os.getenv("STARTUP_RETRY_MAX_BACKOFF_SECONDS", "30")) # Reintentos del esquema
+
+    # Persistencia de mensajes: "sync" (commit por mensaje), "flush_before_respond" (write-behind por lotes,
+    # pero la respuesta espera a que el turno esté persistido) o "respond_then_flush" (máxima latencia baja,
+    # se pueden perder los últimos milisegundos de mensajes si el proceso muere).
+    MESSAGE_WRITE_MODE: str = os.getenv("MESSAGE_WRITE_MODE", "sync")
+    WRITE_BEHIND_FLUSH_INTERVAL_MS: float = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL_MS", "5"))
+    WRITE_BEHIND_MAX_BATCH: int = int(os.getenv("WRITE_BEHIND_MAX_BATCH", "500"))
+    WRITE_BEHIND_QUEUE_SIZE: int = int(os.getenv("WRITE_BEHIND_QUEUE_SIZE", "10000"))
+
+    # Particionado mensual de chat_messages (siempre activo) y retención opcional (archivado + borrado por lotes)
+    PARTITION_MONTHS_AHEAD: int = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+    RETENTION_ENABLED: bool = os.getenv("RETENTION_ENABLED", "false").lower() == "true"
+    MESSAGE_RETENTION_DAYS: int = int(os.getenv("MESSAGE_RETENTION_DAYS", "180"))
+    RETENTION_BATCH_SIZE: int = int(os.getenv("RETENTION_BATCH_SIZE", "500"))
+    RETENTION_BATCH_PAUSE_SECONDS: float = float(os.getenv("RETENTION_BATCH_PAUSE_SECONDS", "0.05"))
+    RETENTION_INTERVAL_SECONDS: float = float(os.getenv("RETENTION_INTERVAL_SECONDS", "3600"))
+    RETENTION_ARCHIVE_DIR: str = os.getenv("RETENTION_ARCHIVE_DIR", "./archive")
+
+    # Borrado masivo de sesiones (DELETE /sessions): tamaño de los lotes y pausa entre ellos
+    BULK_DELETE_SESSION_CHUNK: int = int(os.getenv("BULK_DELETE_SESSION_CHUNK", "50"))
+    BULK_DELETE_MESSAGE_CHUNK: int = int(os.getenv("BULK_DELETE_MESSAGE_CHUNK", "1000"))
+    BULK_DELETE_PAUSE_SECONDS: float = float(os.getenv("BULK_DELETE_PAUSE_SECONDS", "0.02"))
+    BULK_DELETE_STATUS_TTL: int = int(os.getenv("BULK_DELETE_STATUS_TTL", "86400"))
+
+    # Exportación NDJSON: filas por fetch del cursor del servidor y tamaño de los trozos enviados
+    EXPORT_FETCH_SIZE: int = int(os.getenv("EXPORT_FETCH_SIZE", "500"))
+    EXPORT_CHUNK_BYTES: int = int(os.getenv("EXPORT_CHUNK_BYTES", "65536"))
+
+    # Payloads de tools por encima de este tamaño se guardan comprimidos en chat_message_blobs.
+    # Códec: "auto" (zstd si está instalado el paquete zstandard, si no zlib), "zstd" o "zlib".
+    MESSAGE_BLOB_THRESHOLD_BYTES: int = int(os.getenv("MESSAGE_BLOB_THRESHOLD_BYTES", "8192"))
+    MESSAGE_BLOB_PREVIEW_CHARS: int = int(os.getenv("MESSAGE_BLOB_PREVIEW_CHARS", "300"))
+    MESSAGE_BLOB_CODEC: str = os.getenv("MESSAGE_BLOB_CODEC", "auto")
+
+    # Compactación del historial: las respuestas de tools de turnos anteriores se envían al LLM como
+    # un resumen (columnas, nº de filas, primeras filas y el resumen del asistente) en vez de completas
+    HISTORY_COMPACT_TOOL_RESULTS: bool = os.getenv("HISTORY_COMPACT_TOOL_RESULTS", "true").lower() == "true"
+    HISTORY_DIGEST_SAMPLE_ROWS: int = int(os.getenv("HISTORY_DIGEST_SAMPLE_ROWS", "3"))
+    HISTORY_DIGEST_SUMMARY_CHARS: int = int(os.getenv("HISTORY_DIGEST_SUMMARY_CHARS", "500"))
+
+    # Volcado en consola del historial completo enviado al LLM y de los resultados de las tools.
+    # Con resultados grandes cuesta más CPU que el resto del turno: solo para depurar.
+    LLM_DEBUG_LOGGING: bool = os.getenv("LLM_DEBUG_LOGGING", "false").lower() == "true"
 
     # Base de datos externa para MCP (MySQL Asíncrona)
     EXTERNAL_DB_USER: str = os.getenv("EXTERNAL_DB_USER", "ext_user")
@@ -23,14 +75,145 @@ class Settings(BaseSettings):
     EXTERNAL_DB_HOST: str = os.getenv("EXTERNAL_DB_HOST", "db_external")
     EXTERNAL_DB_PORT: str = os.getenv("EXTERNAL_DB_PORT", "3306") # Puerto diferente ejemplo
     EXTERNAL_DB_NAME: str = os.getenv("EXTERNAL_DB_NAME", "external_info_db")
-    EXTERNAL_DB_URL: str = f"mysql+aiomysql://{EXTERNAL_DB_USER}:{EXTERNAL_DB_PASSWORD}@{EXTERNAL_DB_HOST}:{EXTERNAL_DB_PORT}/{EXTERNAL_DB_NAME}"
+    EXTERNAL_DB_URL: str = f"mysql+aiomysql://{quote_plus(EXTERNAL_DB_USER)}:{quote_plus(EXTERNAL_DB_PASSWORD)}@{EXTERNAL_DB_HOST}:{EXTERNAL_DB_PORT}/{EXTERNAL_DB_NAME}"
+    EXTERNAL_DB_POOL_SIZE: int = int(os.getenv("EXTERNAL_DB_POOL_SIZE", "5"))
+    EXTERNAL_DB_MAX_OVERFLOW: int = int(os.getenv("EXTERNAL_DB_MAX_OVERFLOW", "5"))
+    EXTERNAL_DB_POOL_MIN_SIZE: int = int(os.getenv("EXTERNAL_DB_POOL_MIN_SIZE", "1"))
+    # crud_external_data toma prestadas conexiones del pool SQLAlchemy de las tools (mismo primario)
+    # en lugar de abrir un pool aiomysql propio.
+    EXTERNAL_DB_SHARE_TOOL_POOL: bool = os.getenv("EXTERNAL_DB_SHARE_TOOL_POOL", "true").lower() == "true"
+
+    # Réplicas de lectura de la BD externa (URLs separadas por coma, mismo formato que EXTERNAL_DB_URL).
+    # Si hay réplicas configuradas, las consultas de las tools se reparten entre ellas y
+    # el primario solo se usa como respaldo (failover).
+    EXTERNAL_DB_REPLICA_URLS: str = os.getenv("EXTERNAL_DB_REPLICA_URLS", "")
+    EXTERNAL_DB_REPLICA_POOL_SIZE: int = int(os.getenv("EXTERNAL_DB_REPLICA_POOL_SIZE", "5"))
+    EXTERNAL_DB_REPLICA_MAX_OVERFLOW: int = int(os.getenv("EXTERNAL_DB_REPLICA_MAX_OVERFLOW", "5"))
+    EXTERNAL_DB_REPLICA_POOL_TIMEOUT: float = float(os.getenv("EXTERNAL_DB_REPLICA_POOL_TIMEOUT", "5"))
+    EXTERNAL_DB_REPLICA_MAX_LAG_SECONDS: float = float(os.getenv("EXTERNAL_DB_REPLICA_MAX_LAG_SECONDS", "30"))
+    EXTERNAL_DB_REPLICA_HEALTH_INTERVAL: float = float(os.getenv("EXTERNAL_DB_REPLICA_HEALTH_INTERVAL", "10"))
+    EXTERNAL_DB_REPLICA_HEALTH_TIMEOUT: float = float(os.getenv("EXTERNAL_DB_REPLICA_HEALTH_TIMEOUT", "2"))
+    # Si es False, las lecturas nunca caen al primario aunque no haya réplicas sanas.
+    EXTERNAL_DB_PRIMARY_FALLBACK: bool = os.getenv("EXTERNAL_DB_PRIMARY_FALLBACK", "true").lower() == "true"
+
+    # Límites de los resultados de las tools SQL (MySQL y PostgreSQL): filas y tamaño en JSON.
+    # Si se superan, el resultado se recorta y se marca con "truncated".
+    SQL_TOOL_MAX_ROWS: int = int(os.getenv("SQL_TOOL_MAX_ROWS", "5000"))
+    SQL_TOOL_MAX_RESULT_BYTES: int = int(os.getenv("SQL_TOOL_MAX_RESULT_BYTES", "2000000"))
+    SQL_TOOL_STATEMENT_TIMEOUT_MS: int = int(os.getenv("SQL_TOOL_STATEMENT_TIMEOUT_MS", "15000"))
+
+    # Análisis y reescritura de las consultas de las tools SQL (app/tools/sql_rewriter.py): LIMIT
+    # SQL_TOOL_MAX_ROWS si falta, y `SELECT *` expandido a las columnas del catálogo sin las de estos tipos.
+    SQL_REWRITE_INJECT_LIMIT: bool = os.getenv("SQL_REWRITE_INJECT_LIMIT", "true").lower() == "true"
+    SQL_REWRITE_EXPAND_STAR: bool = os.getenv("SQL_REWRITE_EXPAND_STAR", "true").lower() == "true"
+    SQL_REWRITE_PRUNED_TYPES: str = os.getenv(
+        "SQL_REWRITE_PRUNED_TYPES", "tinyblob,blob,mediumblob,longblob,binary,varbinary,geometry,point,polygon,bytea"
+    )
+    SQL_PARSE_CACHE_SIZE: int = int(os.getenv("SQL_PARSE_CACHE_SIZE", "2048"))
+    SQL_CATALOG_TTL_SECONDS: float = float(os.getenv("SQL_CATALOG_TTL_SECONDS", "600"))
+
+    # Materialización de agregaciones frecuentes de MySQLTool (app/services/query_materializer.py): una
+    # agregación que tarda más de MATERIALIZE_MIN_QUERY_MS y se repite MATERIALIZE_MIN_HITS veces en la
+    # ventana se guarda (top-N por BD) y se responde desde la copia mientras sus tablas de origen no
+    # cambien. MATERIALIZE_SCHEMA: esquema de analítica separado en el servidor de conversaciones
+    # (vacío = la BD de conversaciones).
+    MATERIALIZE_ENABLED: bool = os.getenv("MATERIALIZE_ENABLED", "true").lower() == "true"
+    MATERIALIZE_SCHEMA: str = os.getenv("MATERIALIZE_SCHEMA", "")
+    MATERIALIZE_TOP_N: int = int(os.getenv("MATERIALIZE_TOP_N", "20"))
+    MATERIALIZE_MIN_HITS: int = int(os.getenv("MATERIALIZE_MIN_HITS", "3"))
+    MATERIALIZE_HIT_WINDOW_SECONDS: float = float(os.getenv("MATERIALIZE_HIT_WINDOW_SECONDS", "3600"))
+    MATERIALIZE_MIN_QUERY_MS: float = float(os.getenv("MATERIALIZE_MIN_QUERY_MS", "500"))
+    MATERIALIZE_MAX_ROWS: int = int(os.getenv("MATERIALIZE_MAX_ROWS", "1000"))
+    # Tope de antigüedad aunque UPDATE_TIME no cambie (tablas particionadas o no InnoDB lo dejan en NULL)
+    MATERIALIZE_MAX_AGE_SECONDS: float = float(os.getenv("MATERIALIZE_MAX_AGE_SECONDS", "900"))
+    MATERIALIZE_VERSION_CHECK_SECONDS: float = float(os.getenv("MATERIALIZE_VERSION_CHECK_SECONDS", "5"))
+    MATERIALIZE_INDEX_TTL_SECONDS: float = float(os.getenv("MATERIALIZE_INDEX_TTL_SECONDS", "30"))
+
+    # Registro de las consultas de las tools SQL (tabla tool_query_log, escrita por lotes con el writer
+    # write-behind) e informe de consultas lentas/frecuentes con sugerencias de índices (EXPLAIN).
+    # QUERY_LOG_ROWS_EXAMINED lee ROWS_EXAMINED de performance_schema tras cada consulta MySQL (MySQL 8,
+    # requiere SELECT sobre performance_schema; una ida y vuelta más por consulta).
+    QUERY_LOG_ENABLED: bool = os.getenv("QUERY_LOG_ENABLED", "true").lower() == "true"
+    QUERY_LOG_SQL_MAX_CHARS: int = int(os.getenv("QUERY_LOG_SQL_MAX_CHARS", "4000"))
+    QUERY_LOG_ROWS_EXAMINED: bool = os.getenv("QUERY_LOG_ROWS_EXAMINED", "false").lower() == "true"
+    QUERY_LOG_RETENTION_DAYS: int = int(os.getenv("QUERY_LOG_RETENTION_DAYS", "30")) # Se aplica siempre que el registro esté activo
+    INDEX_ADVISOR_MIN_ROWS: int = int(os.getenv("INDEX_ADVISOR_MIN_ROWS", "1000"))
+
+    # Pool asyncpg de PostgresTool (uno por BD y proceso) y caché de sentencias preparadas por conexión
+    POSTGRES_TOOL_POOL_MIN_SIZE: int = int(os.getenv("POSTGRES_TOOL_POOL_MIN_SIZE", "1"))
+    POSTGRES_TOOL_POOL_MAX_SIZE: int = int(os.getenv("POSTGRES_TOOL_POOL_MAX_SIZE", "10"))
+    POSTGRES_TOOL_STATEMENT_CACHE_SIZE: int = int(os.getenv("POSTGRES_TOOL_STATEMENT_CACHE_SIZE", "256"))
+
+    # Multi-tenant: cada sesión puede indicar `tenant_id` en su metadata y sus consultas van a la BD del
+    # tenant (tabla tenants). Las tools/pools de tenants se guardan en una LRU acotada por proceso: los
+    # que llevan más de TENANT_POOL_IDLE_SECONDS sin uso, o los menos recientes si se supera el máximo,
+    # se cierran. TENANT_DB_MAX_CONNECTIONS limita las conexiones de cada tenant (por proceso).
+    TENANT_POOL_CACHE_SIZE: int = int(os.getenv("TENANT_POOL_CACHE_SIZE", "50"))
+    TENANT_POOL_IDLE_SECONDS: float = float(os.getenv("TENANT_POOL_IDLE_SECONDS", "600"))
+    TENANT_POOL_SWEEP_INTERVAL: float = float(os.getenv("TENANT_POOL_SWEEP_INTERVAL", "60"))
+    TENANT_DB_MAX_CONNECTIONS: int = int(os.getenv("TENANT_DB_MAX_CONNECTIONS", "3"))
+    TENANT_CONFIG_TTL_SECONDS: float = float(os.getenv("TENANT_CONFIG_TTL_SECONDS", "60"))
+
+    # Control de admisión de turnos de chat
+    ADMISSION_MAX_CONCURRENT_TURNS: int = int(os.getenv("ADMISSION_MAX_CONCURRENT_TURNS", "32"))
+    ADMISSION_MAX_TURNS_PER_USER: int = int(os.getenv("ADMISSION_MAX_TURNS_PER_USER", "2"))
+    ADMISSION_MAX_QUEUE: int = int(os.getenv("ADMISSION_MAX_QUEUE", "100"))
+    ADMISSION_MAX_QUEUE_PER_USER: int = int(os.getenv("ADMISSION_MAX_QUEUE_PER_USER", "4"))
+    ADMISSION_QUEUE_TIMEOUT: float = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10"))
+    ADMISSION_SHARED_COUNTER_TTL: float = float(os.getenv("ADMISSION_SHARED_COUNTER_TTL", "300"))
+
+    # Estado compartido entre workers (cachés, límites): "memory" (por proceso) o "redis"
+    SHARED_STATE_BACKEND: str = os.getenv("SHARED_STATE_BACKEND", "memory")
+    SHARED_STATE_REDIS_URL: str = os.getenv("SHARED_STATE_REDIS_URL", "redis://localhost:6379/0")
+    SHARED_STATE_PREFIX: str = os.getenv("SHARED_STATE_PREFIX", "chatbot:")
+
+    # Modo asíncrono (jobs) de turnos de chat
+    TURN_WORKERS: int = int(os.getenv("TURN_WORKERS", "4")) # Workers dentro del proceso de la API (0 = solo encolar)
+    TURN_POLL_INTERVAL: float = float(os.getenv("TURN_POLL_INTERVAL", "1.0"))
+    TURN_LEASE_SECONDS: float = float(os.getenv("TURN_LEASE_SECONDS", "120"))
+    TURN_MAX_ATTEMPTS: int = int(os.getenv("TURN_MAX_ATTEMPTS", "2"))
+    TURN_LONG_POLL_MAX_SECONDS: float = float(os.getenv("TURN_LONG_POLL_MAX_SECONDS", "30"))
+
+    # Lotes de preguntas (POST /batch): evaluaciones e informes. Los turnos de lotes no pasan por la admisión
+    # interactiva: tienen su propio tope de concurrencia por proceso y un ritmo máximo global (0 = sin tope)
+    BATCH_MAX_QUESTIONS: int = int(os.getenv("BATCH_MAX_QUESTIONS", "1000"))
+    BATCH_MAX_CONCURRENCY: int = int(os.getenv("BATCH_MAX_CONCURRENCY", "8")) # También workers del carril de lotes por proceso
+    BATCH_MAX_TURNS_PER_MINUTE: int = int(os.getenv("BATCH_MAX_TURNS_PER_MINUTE", "0"))
+
+    # Canal WebSocket de chat (/sessions/{id}/ws): orquestador e historial en memoria mientras dure la conexión
+    WS_PING_INTERVAL_SECONDS: float = float(os.getenv("WS_PING_INTERVAL_SECONDS", "20"))
+    WS_IDLE_TIMEOUT_SECONDS: float = float(os.getenv("WS_IDLE_TIMEOUT_SECONDS", "900")) # Sin mensajes ni pongs: se cierra
+    WS_MAX_PENDING_MESSAGES: int = int(os.getenv("WS_MAX_PENDING_MESSAGES", "3")) # Mensajes en cola tras el turno en curso
+    WS_SEND_TIMEOUT_SECONDS: float = float(os.getenv("WS_SEND_TIMEOUT_SECONDS", "10")) # Cliente que no lee: se cierra
+    WS_HISTORY_MAX_ENTRIES: int = int(os.getenv("WS_HISTORY_MAX_ENTRIES", "20"))
 
     # Gemini API Key
     GEMINI_API_KEY: str = os.getenv("GEMINI_API_KEY", "YOUR_GEMINI_API_KEY")
 
-    # Pydantic Settings la leerá de la variable de entorno GEMINI_LLM_MODEL
-    # Si no está definida, usará "gemini-1.5-flash" como valor por defecto.
-    GEMINI_LLM_MODEL: str = "gemini-2.0-flash-lite" 
+    # Modelo rápido (por defecto en todos los turnos si el enrutado está desactivado)
+    GEMINI_LLM_MODEL: str = os.getenv("GEMINI_LLM_MODEL", "gemini-2.0-flash-lite")
+
+    # Enrutado por llamada entre modelos rápidos y fuertes (ver app/services/model_router.py).
+    # Cada nivel admite varios modelos separados por comas: se usa el de menor latencia observada.
+    LLM_ROUTING_ENABLED: bool = os.getenv("LLM_ROUTING_ENABLED", "true").lower() == "true"
+    LLM_FAST_MODELS: str = os.getenv("LLM_FAST_MODELS", "") # Vacío: GEMINI_LLM_MODEL
+    LLM_STRONG_MODELS: str = os.getenv("LLM_STRONG_MODELS", "gemini-2.0-flash")
+    LLM_ROUTER_COMPLEX_MIN_CHARS: int = int(os.getenv("LLM_ROUTER_COMPLEX_MIN_CHARS", "220")) # Preguntas más largas: modelo fuerte
+    LLM_ROUTER_COMPLEX_MIN_SIGNALS: int = int(os.getenv("LLM_ROUTER_COMPLEX_MIN_SIGNALS", "2")) # Señales de agregación/cruce
+    LLM_ROUTER_STALL_CALLS: int = int(os.getenv("LLM_ROUTER_STALL_CALLS", "3")) # Llamadas a tools sin respuesta: escalar
+    LLM_ROUTER_LATENCY_SAMPLES: int = int(os.getenv("LLM_ROUTER_LATENCY_SAMPLES", "200")) # Por modelo, para p50/p95
+    LLM_ROUTER_ERROR_COOLDOWN_SECONDS: float = float(os.getenv("LLM_ROUTER_ERROR_COOLDOWN_SECONDS", "30")) # Se dobla con cada error seguido
+
+    # Limitador de cuota del LLM (ver app/services/llm_rate_limiter.py): peticiones (RPM) y tokens
+    # estimados (TPM) por minuto y por modelo. 0 = sin límite propio (solo se respetan los 429 del servidor).
+    LLM_RATE_LIMIT_RPM: int = int(os.getenv("LLM_RATE_LIMIT_RPM", "0"))
+    LLM_RATE_LIMIT_TPM: int = int(os.getenv("LLM_RATE_LIMIT_TPM", "0"))
+    LLM_RATE_LIMITS: str = os.getenv("LLM_RATE_LIMITS", "") # Por modelo: "gemini-2.0-flash=2000:4000000,..."
+    LLM_RATE_LIMIT_MAX_WAIT_SECONDS: float = float(os.getenv("LLM_RATE_LIMIT_MAX_WAIT_SECONDS", "30")) # En cola, por llamada
+    LLM_RATE_LIMIT_MAX_RETRIES: int = int(os.getenv("LLM_RATE_LIMIT_MAX_RETRIES", "3")) # Reintentos tras un 429
+    LLM_RATE_LIMIT_BACKOFF_SECONDS: float = float(os.getenv("LLM_RATE_LIMIT_BACKOFF_SECONDS", "5")) # 429 sin retry_delay
+    LLM_ESTIMATED_OUTPUT_TOKENS: int = int(os.getenv("LLM_ESTIMATED_OUTPUT_TOKENS", "512"))
+    LLM_CHARS_PER_TOKEN: float = float(os.getenv("LLM_CHARS_PER_TOKEN", "4"))
 
     class Config:
         case_sensitive = True
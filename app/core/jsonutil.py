@@ -0,0 +1,50 @@
+# app/core/jsonutil.py
+import datetime
+import decimal
+import json
+from typing import Any, Union
+
+# orjson es varias veces más rápido que json (y serializa datetime de forma nativa). Si no está
+# instalado se usa json con el mismo comportamiento: salida compacta y UTF-8 sin escapar.
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depende del entorno
+    orjson = None
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, decimal.Decimal):
+        return str(value) # Sin pérdida de precisión
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).decode("utf-8", errors="replace")
+    raise TypeError(f"Tipo no serializable a JSON: {type(value).__name__}")
+
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def dumps_bytes(obj: Any) -> bytes:
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS)
+
+    def dumps(obj: Any) -> str:
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS).decode("utf-8")
+
+    def loads(data: Union[str, bytes, bytearray]) -> Any:
+        return orjson.loads(data)
+
+else:
+    def dumps(obj: Any) -> str:
+        return json.dumps(obj, default=_default, ensure_ascii=False, separators=(",", ":"))
+
+    def dumps_bytes(obj: Any) -> bytes:
+        return dumps(obj).encode("utf-8")
+
+    def loads(data: Union[str, bytes, bytearray]) -> Any:
+        return json.loads(data)
+
+# Excepción que lanza `loads` con JSON inválido (orjson.JSONDecodeError hereda de ella)
+JSONDecodeError = json.JSONDecodeError
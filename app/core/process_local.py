@@ -0,0 +1,58 @@
+# app/core/process_local.py
+import os
+import threading
+import weakref
+from typing import Callable, Generic, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+# Instancias vivas, para rehacer sus locks en el hijo tras un fork
+_instances: "weakref.WeakSet[ProcessLocal]" = weakref.WeakSet()
+
+
+class ProcessLocal(Generic[T]):
+    """
+    Valor creado perezosamente y una sola vez por proceso.
+
+    Engines, pools y clientes del LLM no pueden compartirse entre procesos: si el proceso
+    se bifurca (gunicorn con preload), el hijo detecta que el PID cambió y crea los suyos.
+    Los objetos heredados del padre se conservan sin cerrar, porque cerrarlos desde el hijo
+    cortaría las conexiones que el padre sigue usando.
+    """
+
+    def __init__(self, factory: Callable[[], T]):
+        self._factory = factory
+        self._value: Optional[T] = None
+        self._pid: Optional[int] = None
+        self._inherited: List[T] = []
+        self._lock = threading.Lock()
+        _instances.add(self)
+
+    def get(self) -> T:
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    if self._value is not None:
+                        self._inherited.append(self._value)
+                    self._value = self._factory()
+                    self._pid = pid
+        return self._value
+
+    def peek(self) -> Optional[T]:
+        """El valor de este proceso, sin crearlo si aún no existe."""
+        return self._value if self._pid == os.getpid() else None
+
+    def clear(self) -> None:
+        self._value = None
+        self._pid = None
+
+
+def _after_fork_in_child() -> None:
+    # Un fork mientras otro hilo tenía el lock tomado lo dejaría bloqueado para siempre en el hijo
+    for instance in list(_instances):
+        instance._lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,135 @@
+# app/core/shared_state.py
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Optional, Tuple
+
+from app.core.config import settings
+from app.core.process_local import ProcessLocal
+
+
+class SharedStateBackend(ABC):
+    """
+    Almacén clave/valor para cachés y límites que deben verse igual desde todos los workers.
+    `memory` solo comparte dentro del proceso; `redis` comparte entre procesos y contenedores.
+    """
+
+    distributed: bool = False
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        ...
+
+    @abstractmethod
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        """Suma `amount` de forma atómica y retorna el nuevo valor. `ttl` se renueva en cada llamada."""
+        ...
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        ...
+
+    async def close(self) -> None:
+        pass
+
+
+class InMemoryBackend(SharedStateBackend):
+    # Las claves caducadas se borran al leerlas y, para las que no se vuelven a leer (ventanas por
+    # minuto, marcas de "ya visto"), con un barrido cada tantas escrituras o cada tanto tiempo
+    _SWEEP_EVERY_WRITES = 1000
+    _SWEEP_INTERVAL_SECONDS = 60.0
+
+    def __init__(self):
+        self._data: Dict[str, Tuple[str, Optional[float]]] = {}
+        self._writes = 0
+        self._last_sweep = time.monotonic()
+
+    def _alive(self, key: str) -> Optional[str]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    async def get(self, key: str) -> Optional[str]:
+        return self._alive(key)
+
+    def _sweep(self, now: float) -> None:
+        expired = [key for key, (_, expires_at) in self._data.items() if expires_at is not None and expires_at <= now]
+        for key in expired:
+            del self._data[key]
+        self._writes = 0
+        self._last_sweep = now
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        now = time.monotonic()
+        self._data[key] = (value, now + ttl if ttl else None)
+        self._writes += 1
+        if self._writes >= self._SWEEP_EVERY_WRITES or now - self._last_sweep >= self._SWEEP_INTERVAL_SECONDS:
+            self._sweep(now)
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        value = int(self._alive(key) or 0) + amount
+        await self.set(key, str(value), ttl)
+        return value
+
+    async def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+
+class RedisBackend(SharedStateBackend):
+    distributed = True
+
+    def __init__(self, url: str, prefix: str):
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError as e:
+            raise RuntimeError("SHARED_STATE_BACKEND=redis requiere el paquete 'redis' (pip install redis).") from e
+        self._client = redis_asyncio.from_url(url, decode_responses=True)
+        self._prefix = prefix
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self._client.get(self._prefix + key)
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        await self._client.set(self._prefix + key, value, px=int(ttl * 1000) if ttl else None)
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        async with self._client.pipeline(transaction=True) as pipe:
+            pipe.incrby(self._prefix + key, amount)
+            if ttl:
+                pipe.pexpire(self._prefix + key, int(ttl * 1000))
+            results = await pipe.execute()
+        return int(results[0])
+
+    async def delete(self, key: str) -> None:
+        await self._client.delete(self._prefix + key)
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+
+def _create_backend() -> SharedStateBackend:
+    if settings.SHARED_STATE_BACKEND == "redis":
+        return RedisBackend(settings.SHARED_STATE_REDIS_URL, settings.SHARED_STATE_PREFIX)
+    return InMemoryBackend()
+
+
+_backend: ProcessLocal[SharedStateBackend] = ProcessLocal(_create_backend)
+
+
+def get_shared_state() -> SharedStateBackend:
+    return _backend.get()
+
+
+async def close_shared_state() -> None:
+    backend = _backend.peek()
+    if backend is not None:
+        await backend.close()
+        _backend.clear()
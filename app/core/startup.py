@@ -0,0 +1,136 @@
+# app/core/startup.py
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from app.core.config import settings
+
+
+class StartupState:
+    """Estado del arranque del worker: tiempos medidos y si ya está listo para recibir tráfico."""
+
+    def __init__(self):
+        self.import_started: Optional[float] = None
+        self.import_seconds: Optional[float] = None
+        self.startup_seconds: Optional[float] = None
+        self.steps: Dict[str, Dict[str, Any]] = {}
+        self.ready = False
+        self.error: Optional[str] = None
+
+    def mark_imported(self, import_started: float) -> None:
+        self.import_started = import_started
+        self.import_seconds = time.perf_counter() - import_started
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "error": self.error,
+            "import_seconds": self.import_seconds,
+            "startup_seconds": self.startup_seconds,
+            "budget_seconds": settings.STARTUP_BUDGET_SECONDS,
+            "within_budget": (
+                self.startup_seconds <= settings.STARTUP_BUDGET_SECONDS if self.startup_seconds is not None else None
+            ),
+            "steps": self.steps,
+        }
+
+
+startup_state = StartupState()
+
+
+async def _timed_step(name: str, step: Callable[[], Awaitable[Any]], required: bool) -> None:
+    started = time.perf_counter()
+    try:
+        await step()
+        startup_state.steps[name] = {"ok": True, "seconds": round(time.perf_counter() - started, 3)}
+    except Exception as e:
+        startup_state.steps[name] = {"ok": False, "seconds": round(time.perf_counter() - started, 3), "error": str(e)}
+        print(f"ERROR:app.core.startup:Fallo en el paso de arranque '{name}': {e}")
+        if required:
+            raise
+
+
+async def _retried_step(name: str, step: Callable[[], Awaitable[Any]]) -> None:
+    """
+    Paso obligatorio: se reintenta con backoff exponencial hasta que funcione. Un fallo transitorio
+    (la BD aún no acepta conexiones) no deja al worker vivo pero sin arrancar para siempre.
+    """
+    delay = 1.0
+    attempt = 1
+    while True:
+        try:
+            await _timed_step(name, step, required=True)
+            startup_state.steps[name]["attempts"] = attempt
+            startup_state.error = None
+            return
+        except Exception as e:
+            startup_state.error = f"{name}: {e} (intento {attempt}, reintento en {delay:.0f}s)"
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, settings.STARTUP_RETRY_MAX_BACKOFF_SECONDS)
+            attempt += 1
+
+
+async def _prepare_schema() -> None:
+    from app.db.database import create_db_and_tables, check_schema_version
+    from app.db import models_conversation  # noqa: F401 - registra los modelos en el metadata
+
+    if settings.DB_SCHEMA_STARTUP == "create_all":
+        await create_db_and_tables()
+    elif settings.DB_SCHEMA_STARTUP == "check":
+        await check_schema_version()
+    # "skip": el esquema lo gestiona el despliegue (alembic upgrade head)
+
+
+async def _warm_conversation_pool() -> None:
+    from app.db.database import get_conv_engine
+
+    async def _open_one():
+        async with get_conv_engine().connect() as conn:
+            await conn.exec_driver_sql("SELECT 1")
+
+    # Abrir varias conexiones a la vez deja el pool con conexiones ya autenticadas
+    await asyncio.gather(*(_open_one() for _ in range(settings.STARTUP_WARM_CONNECTIONS)))
+
+
+async def _warm_external_pool() -> None:
+    from app.db.replica_router import get_replica_router
+
+    router = get_replica_router(settings.EXTERNAL_DB_URL)
+    async with router.primary.engine.connect() as conn:
+        await conn.exec_driver_sql("SELECT 1")
+    await router.check_health()
+
+
+async def _warm_llm_client() -> None:
+    from app.services.llm_handler import get_genai
+
+    # El import del SDK es CPU/disco: en un hilo para que se solape con la E/S de las BDs
+    await asyncio.to_thread(get_genai)
+
+
+async def warm_up(on_ready: Optional[Callable[[], None]] = None) -> None:
+    """
+    Prepara el worker en paralelo (esquema, pools, cliente del LLM) y marca el worker como listo.
+    Solo el paso del esquema es obligatorio y se reintenta hasta que funciona (mientras tanto el
+    worker no está listo: /ready responde 503 con `error` y los intentos; /health solo indica que el
+    proceso vive); si un pool o el LLM fallan, el worker arranca
+    igual y se conectará en la primera petición.
+    """
+    await asyncio.gather(
+        _retried_step("schema", _prepare_schema),
+        _timed_step("conversation_pool", _warm_conversation_pool, required=False),
+        _timed_step("external_pool", _warm_external_pool, required=False),
+        _timed_step("llm_client", _warm_llm_client, required=False),
+    )
+
+    if on_ready is not None:
+        on_ready()
+    startup_state.ready = True
+    if startup_state.import_started is not None:
+        startup_state.startup_seconds = round(time.perf_counter() - startup_state.import_started, 3)
+        if startup_state.startup_seconds > settings.STARTUP_BUDGET_SECONDS:
+            print(
+                f"WARNING:app.core.startup:Arranque en {startup_state.startup_seconds}s, por encima del presupuesto "
+                f"de {settings.STARTUP_BUDGET_SECONDS}s. Pasos: {startup_state.steps}"
+            )
+    print(f"INFO:app.core.startup:Worker listo. Import: {startup_state.import_seconds:.3f}s, pasos: {startup_state.steps}")
@@ -0,0 +1,28 @@
+# app/core/tool_context.py
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, NamedTuple, Optional
+
+
+class ToolContext(NamedTuple):
+    """Sesión y tenant del turno en curso, para las tools (que se comparten entre sesiones)."""
+    session_id: Optional[str] = None
+    tenant_id: Optional[str] = None
+
+
+_current: ContextVar[ToolContext] = ContextVar("tool_context", default=ToolContext())
+
+
+def current_tool_context() -> ToolContext:
+    return _current.get()
+
+
+@contextmanager
+def bind_tool_context(session_id: Optional[str], tenant_id: Optional[str] = None) -> Iterator[ToolContext]:
+    """Asocia sesión y tenant a todo lo que se ejecute dentro del bloque (también en tareas hijas)."""
+    context = ToolContext(session_id, tenant_id)
+    token = _current.set(context)
+    try:
+        yield context
+    finally:
+        _current.reset(token)
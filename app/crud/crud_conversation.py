@@ -1,12 +1,16 @@
 # app/crud/crud_conversation.py
-import json
-from typing import List, Optional, Dict, Any
+from datetime import datetime
+from typing import List, Optional, Dict, Any, Union
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select # Using sqlalchemy.future.select for modern async patterns
 from sqlalchemy.orm import selectinload
-from sqlalchemy import desc, asc, delete # Import 'delete' here
+from sqlalchemy import desc, asc, delete, exists, func, insert, update # Import 'delete' here
 
-from app.db.models_conversation import ChatSession, ChatMessage # Assuming these are your ORM models
+from app.core.config import settings
+from app.core import jsonutil
+from app.db.models_conversation import ChatSession, ChatMessage, ChatTurn, ChatMessageBlob, SESSION_METADATA_INDEXED_KEYS # Assuming these are your ORM models
+from app.db.write_behind import message_writer
+from app.db.blob_store import externalize_message, serialize_parts
 
 async def create_chat_session(
     db: AsyncSession,
@@ -15,17 +19,29 @@ async def create_chat_session(
     metadata: Optional[Dict[str, Any]] = None
 ) -> ChatSession:
     """Crea una nueva sesión de chat en la base de datos."""
-    session_metadata_json = json.dumps(metadata) if metadata else None
     db_session = ChatSession(
         id=session_id,
         user_id=user_id,
-        metadata=session_metadata_json
+        session_data=metadata or None
     )
     db.add(db_session)
     await db.commit()
     await db.refresh(db_session)
     return db_session
 
+async def create_chat_sessions(
+    db: AsyncSession,
+    session_ids: List[str],
+    user_id: Optional[str] = None,
+    metadata: Optional[Dict[str, Any]] = None
+) -> None:
+    """Crea varias sesiones con el mismo usuario y metadata en un solo INSERT (lotes de POST /batch)."""
+    await db.execute(
+        insert(ChatSession),
+        [{"id": session_id, "user_id": user_id, "session_data": metadata or None} for session_id in session_ids]
+    )
+    await db.commit()
+
 async def get_chat_session(db: AsyncSession, session_id: str) -> Optional[ChatSession]:
     """Obtiene una sesión de chat por su ID."""
     result = await db.execute(select(ChatSession).filter(ChatSession.id == session_id))
@@ -35,9 +51,32 @@ async def create_chat_message(
     db: AsyncSession,
     session_id: str,
     sender: str, # "user" o "assistant" o "tool"
-    message: str, # Puede ser texto plano o JSON de partes de tool
+    message: Union[str, List[Dict[str, Any]]], # Texto plano, o las partes de tool ya estructuradas
 ) -> ChatMessage:
-    """Crea un nuevo mensaje de chat en la base de datos."""
+    """
+    Crea un nuevo mensaje de chat en la base de datos.
+    En modo write-behind el mensaje se encola para el INSERT por lotes y se devuelve sin id.
+    Las respuestas de tools grandes se guardan comprimidas en chat_message_blobs (ver app/db/blob_store.py).
+    """
+    if isinstance(message, str):
+        message, blob_rows = externalize_message(session_id, message)
+    else:
+        # Partes estructuradas: se serializan una sola vez aquí (los payloads grandes, directo al blob)
+        message, blob_rows = serialize_parts(session_id, message)
+
+    if settings.MESSAGE_WRITE_MODE != "sync" and message_writer.running:
+        # Los blobs se encolan antes que el mensaje: se insertan en el mismo lote o en uno anterior
+        for blob_row in blob_rows:
+            await message_writer.enqueue(ChatMessageBlob.__table__, blob_row, key=session_id)
+        await message_writer.enqueue(
+            ChatMessage.__table__,
+            {"session_id": session_id, "sender": sender, "message": message},
+            key=session_id
+        )
+        return ChatMessage(session_id=session_id, sender=sender, message=message)
+
+    for blob_row in blob_rows:
+        db.add(ChatMessageBlob(**blob_row))
     db_message = ChatMessage(
         session_id=session_id,
         sender=sender,
@@ -48,6 +87,11 @@ async def create_chat_message(
     await db.refresh(db_message)
     return db_message
 
+async def flush_session_messages(session_id: str) -> None:
+    """En modo 'flush_before_respond', espera a que los mensajes encolados de la sesión estén persistidos."""
+    if settings.MESSAGE_WRITE_MODE == "flush_before_respond":
+        await message_writer.wait_flushed(session_id)
+
 # app/crud/crud_conversation.py (fragmento)
 
 async def get_messages_by_session(
@@ -61,13 +105,21 @@ async def get_messages_by_session(
     Obtiene mensajes de una sesión específica, ordenados por fecha de creación.
     Opcionalmente limita el número de mensajes y define el orden.
     """
+    # Leer lo que uno mismo escribió: los mensajes aún en la cola write-behind se vuelcan antes
+    if message_writer.has_pending(session_id):
+        await message_writer.wait_flushed(session_id)
+
     # CAMBIO AQUÍ: Usar ChatMessage.timestamp
-    order_direction = asc(ChatMessage.timestamp) if ascending_order else desc(ChatMessage.timestamp)
-    
+    # El id desempata mensajes del mismo segundo (p.ej. los insertados en un mismo lote)
+    if ascending_order:
+        order_by = (asc(ChatMessage.timestamp), asc(ChatMessage.id))
+    else:
+        order_by = (desc(ChatMessage.timestamp), desc(ChatMessage.id))
+
     stmt = (
         select(ChatMessage)
         .filter(ChatMessage.session_id == session_id)
-        .order_by(order_direction)
+        .order_by(*order_by)
         .offset(offset)
     )
     
@@ -78,48 +130,120 @@ async def get_messages_by_session(
     messages = result.scalars().all()
     return list(messages)
 
-# Y también en get_full_conversation_history si la usas para ordenar sus mensajes cargados
 async def get_full_conversation_history(db: AsyncSession, session_id: str) -> Optional[ChatSession]:
-    """Obtiene una sesión de chat con todos sus mensajes cargados."""
+    """Obtiene una sesión de chat con todos sus mensajes cargados (ya ordenados por la relación)."""
     result = await db.execute(
         select(ChatSession)
         .filter(ChatSession.id == session_id)
         .options(selectinload(ChatSession.messages)) # Removí joinedload porque a veces causa problemas con el orden
     )
-    session = result.scalar_one_or_none()
-    if session and session.messages:
-        # CAMBIO AQUÍ: Usar m.timestamp
-        session.messages.sort(key=lambda m: m.timestamp) 
-    return session
+    return result.scalar_one_or_none()
+
+# --- Payloads fuera de línea (chat_message_blobs) ---
+
+async def get_message_blobs(db: AsyncSession, blob_ids: List[str]) -> List[ChatMessageBlob]:
+    """Trae en una sola consulta los blobs referenciados por un conjunto de mensajes."""
+    if not blob_ids:
+        return []
+    result = await db.execute(select(ChatMessageBlob).where(ChatMessageBlob.id.in_(set(blob_ids))))
+    return list(result.scalars().all())
+
+async def delete_message_blobs(db: AsyncSession, blob_ids: List[str]) -> int:
+    if not blob_ids:
+        return 0
+    result = await db.execute(delete(ChatMessageBlob).where(ChatMessageBlob.id.in_(blob_ids)))
+    await db.commit()
+    return result.rowcount
+
+# --- Exportación (cursor del lado del servidor) ---
+
+_EXPORT_COLUMNS = (
+    ChatMessage.id, ChatMessage.session_id, ChatSession.user_id,
+    ChatMessage.sender, ChatMessage.message, ChatMessage.timestamp
+)
+
+async def stream_session_messages(db: AsyncSession, session_id: str):
+    """
+    Filas (id, session_id, user_id, sender, message, timestamp) de una sesión en orden cronológico,
+    leídas con un cursor del lado del servidor: la memoria no depende del tamaño de la conversación.
+    """
+    stmt = (
+        select(*_EXPORT_COLUMNS)
+        .join(ChatSession, ChatSession.id == ChatMessage.session_id)
+        .where(ChatMessage.session_id == session_id)
+        .order_by(asc(ChatMessage.timestamp), asc(ChatMessage.id))
+        .execution_options(yield_per=settings.EXPORT_FETCH_SIZE)
+    )
+    return await db.stream(stmt)
+
+async def stream_messages_for_export(db: AsyncSession, user_id: Optional[str] = None, since: Optional[datetime] = None):
+    """Como stream_session_messages, pero de todas las sesiones que cumplan los filtros, agrupadas por sesión."""
+    stmt = select(*_EXPORT_COLUMNS).join(ChatSession, ChatSession.id == ChatMessage.session_id)
+    if user_id:
+        stmt = stmt.where(ChatSession.user_id == user_id)
+    if since:
+        stmt = stmt.where(ChatMessage.timestamp >= since)
+    stmt = (
+        stmt.order_by(asc(ChatMessage.session_id), asc(ChatMessage.timestamp), asc(ChatMessage.id))
+        .execution_options(yield_per=settings.EXPORT_FETCH_SIZE)
+    )
+    return await db.stream(stmt)
 
 # También asegúrate de que get_all_sessions siga usando ChatSession.created_at (que sí existe)
-async def get_all_sessions(db: AsyncSession, user_id: Optional[str] = None) -> List[ChatSession]:
+async def get_all_sessions(
+    db: AsyncSession, user_id: Optional[str] = None, metadata_filters: Optional[Dict[str, str]] = None
+) -> List[ChatSession]:
     """
-    Obtiene todas las sesiones de conversación, opcionalmente filtradas por user_id.
+    Obtiene todas las sesiones de conversación, opcionalmente filtradas por user_id y por claves de la metadata.
     Ordena por fecha de creación descendente para mostrar las más recientes primero.
     """
     query = select(ChatSession)
     if user_id:
         query = query.where(ChatSession.user_id == user_id)
+    for key, value in (metadata_filters or {}).items():
+        query = query.where(_metadata_column(key) == str(value))
     # ESTO YA ESTÁ CORRECTO: ChatSession sí tiene 'created_at'
     query = query.order_by(desc(ChatSession.created_at)) 
     result = await db.execute(query)
     return result.scalars().all()
 
+async def get_recent_session_ids(
+    db: AsyncSession, limit: int, user_id: Optional[str] = None, since: Optional[datetime] = None
+) -> List[str]:
+    """IDs de las sesiones más recientes que tienen mensajes (p. ej. para grabar conversaciones reales)."""
+    query = select(ChatSession.id).where(exists().where(ChatMessage.session_id == ChatSession.id))
+    if user_id:
+        query = query.where(ChatSession.user_id == user_id)
+    if since:
+        query = query.where(ChatSession.created_at >= since)
+    result = await db.execute(query.order_by(desc(ChatSession.created_at)).limit(limit))
+    return list(result.scalars().all())
+
+def _metadata_column(key: str):
+    """Columna generada (indexada) de la clave si la tiene; si no, extracción del JSON (recorre las filas)."""
+    if key in SESSION_METADATA_INDEXED_KEYS:
+        return getattr(ChatSession, f"meta_{key}")
+    return ChatSession.session_data[key].as_string()
+
 async def update_session_metadata(
     db: AsyncSession,
     session_id: str,
     new_metadata: Dict[str, Any]
-) -> Optional[ChatSession]:
-    """Actualiza los metadatos de una sesión de chat."""
-    session = await get_chat_session(db, session_id)
-    if session:
-        current_metadata = json.loads(session.metadata) if session.metadata else {}
-        current_metadata.update(new_metadata)
-        session.metadata = json.dumps(current_metadata)
-        await db.commit()
-        await db.refresh(session)
-    return session
+) -> bool:
+    """
+    Mezcla `new_metadata` en la metadata de la sesión con un solo UPDATE atómico (JSON_MERGE_PATCH en
+    la BD, sin leer la fila): las claves con valor None se eliminan y los objetos anidados se mezclan.
+    Retorna False si la sesión no existe.
+    """
+    result = await db.execute(
+        update(ChatSession)
+        .where(ChatSession.id == session_id)
+        .values(session_data=func.json_merge_patch(
+            func.coalesce(ChatSession.session_data, func.json_object()), jsonutil.dumps(new_metadata)
+        ))
+    )
+    await db.commit()
+    return result.rowcount > 0
 
 # --- NUEVAS FUNCIONES ---
 
@@ -128,7 +252,9 @@ async def delete_session(db: AsyncSession, session_id: str) -> bool:
     Elimina una sesión de conversación y todos sus mensajes asociados.
     Retorna True si la sesión fue encontrada y eliminada, False en caso contrario.
     """
-    # Primero, eliminar todos los mensajes asociados a la sesión
+    # Primero, eliminar todos los mensajes y turnos asociados a la sesión
+    await db.execute(delete(ChatTurn).where(ChatTurn.session_id == session_id))
+    await db.execute(delete(ChatMessageBlob).where(ChatMessageBlob.session_id == session_id))
     delete_messages_stmt = delete(ChatMessage).where(ChatMessage.session_id == session_id)
     await db.execute(delete_messages_stmt)
 
@@ -138,3 +264,110 @@ async def delete_session(db: AsyncSession, session_id: str) -> bool:
     await db.commit() # Confirmar la transacción para aplicar los cambios
     
     return result.rowcount > 0 # Retorna True si se eliminó al menos una sesión
+
+# --- Borrado masivo de sesiones ---
+
+async def get_session_ids_page(
+    db: AsyncSession,
+    user_id: Optional[str] = None,
+    before: Optional[datetime] = None,
+    session_ids: Optional[List[str]] = None,
+    after_id: Optional[str] = None,
+    limit: int = 50
+) -> List[str]:
+    """
+    Página de IDs de sesión que cumplen los filtros (paginación por clave: `after_id` es el último ID
+    de la página anterior). `before` filtra por fecha de creación.
+    """
+    query = select(ChatSession.id)
+    if user_id:
+        query = query.where(ChatSession.user_id == user_id)
+    if before:
+        query = query.where(ChatSession.created_at < before)
+    if session_ids is not None:
+        query = query.where(ChatSession.id.in_(session_ids))
+    if after_id:
+        query = query.where(ChatSession.id > after_id)
+    result = await db.execute(query.order_by(asc(ChatSession.id)).limit(limit))
+    return list(result.scalars().all())
+
+async def delete_messages_chunk(db: AsyncSession, session_ids: List[str], limit: int) -> int:
+    """
+    Borra como mucho `limit` mensajes de las sesiones indicadas, en una transacción corta.
+    Retorna cuántos borró (0 cuando ya no quedan).
+    """
+    result = await db.execute(
+        select(ChatMessage.id).where(ChatMessage.session_id.in_(session_ids)).limit(limit)
+    )
+    message_ids = list(result.scalars().all())
+    if not message_ids:
+        return 0
+    deleted = await db.execute(
+        delete(ChatMessage).where(ChatMessage.id.in_(message_ids), ChatMessage.session_id.in_(session_ids))
+    )
+    await db.commit()
+    return deleted.rowcount
+
+async def delete_message_blobs_chunk(db: AsyncSession, session_ids: List[str], limit: int) -> int:
+    """
+    Borra como mucho `limit` payloads de chat_message_blobs de las sesiones indicadas, en una transacción
+    corta (son las filas más grandes). Retorna cuántos borró (0 cuando ya no quedan).
+    """
+    result = await db.execute(
+        select(ChatMessageBlob.id).where(ChatMessageBlob.session_id.in_(session_ids)).limit(limit)
+    )
+    blob_ids = list(result.scalars().all())
+    if not blob_ids:
+        return 0
+    deleted = await db.execute(delete(ChatMessageBlob).where(ChatMessageBlob.id.in_(blob_ids)))
+    await db.commit()
+    return deleted.rowcount
+
+async def delete_sessions_by_ids(db: AsyncSession, session_ids: List[str]) -> int:
+    """
+    Borra las sesiones (y sus turnos) cuyos mensajes y blobs ya se eliminaron (ver delete_messages_chunk
+    y delete_message_blobs_chunk). Retorna cuántas sesiones borró.
+    """
+    await db.execute(delete(ChatTurn).where(ChatTurn.session_id.in_(session_ids)))
+    result = await db.execute(delete(ChatSession).where(ChatSession.id.in_(session_ids)))
+    await db.commit()
+    return result.rowcount
+
+# --- Retención ---
+
+async def get_expired_messages(db: AsyncSession, cutoff: datetime, limit: int) -> List[ChatMessage]:
+    """Mensajes anteriores a `cutoff`, los más antiguos primero (el filtro por fecha poda particiones)."""
+    result = await db.execute(
+        select(ChatMessage)
+        .where(ChatMessage.timestamp < cutoff)
+        .order_by(asc(ChatMessage.timestamp), asc(ChatMessage.id))
+        .limit(limit)
+    )
+    return list(result.scalars().all())
+
+async def delete_messages_by_ids(db: AsyncSession, message_ids: List[int], before: datetime) -> int:
+    """Borra un lote de mensajes en su propia transacción corta. `before` acota las particiones afectadas."""
+    result = await db.execute(
+        delete(ChatMessage).where(ChatMessage.id.in_(message_ids), ChatMessage.timestamp < before)
+    )
+    await db.commit()
+    return result.rowcount
+
+async def delete_expired_sessions(db: AsyncSession, cutoff: datetime, limit: int) -> int:
+    """Borra hasta `limit` sesiones creadas antes de `cutoff` que ya no tienen mensajes (y sus turnos)."""
+    result = await db.execute(
+        select(ChatSession.id)
+        .where(
+            ChatSession.created_at < cutoff,
+            ~exists().where(ChatMessage.session_id == ChatSession.id)
+        )
+        .limit(limit)
+    )
+    session_ids = list(result.scalars().all())
+    if not session_ids:
+        return 0
+    await db.execute(delete(ChatTurn).where(ChatTurn.session_id.in_(session_ids)))
+    await db.execute(delete(ChatMessageBlob).where(ChatMessageBlob.session_id.in_(session_ids)))
+    deleted = await db.execute(delete(ChatSession).where(ChatSession.id.in_(session_ids)))
+    await db.commit()
+    return deleted.rowcount
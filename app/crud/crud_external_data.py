@@ -1,48 +1,106 @@
 # app/crud/crud_external_data.py
+import asyncio
 import aiomysql
-from typing import List, Dict, Any, Optional
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Dict, Any, Optional, Union
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.sql import text # Para ejecutar SQL raw con SQLAlchemy
 from app.core.config import settings # Para la URL de la BD externa
+from app.core.process_local import ProcessLocal
+from app.db.replica_router import get_replica_router
 
 # --- Opción 1: Usando aiomysql directamente (similar a como lo haría la tool) ---
 
-async def _get_external_db_connection_direct():
-    """Helper para obtener una conexión directa a la BD externa."""
-    # Parsear la URL de forma más robusta es recomendable
-    db_url_parts = settings.EXTERNAL_DB_URL.replace("mysql+aiomysql://", "").split("@")
-    user_pass, host_db = db_url_parts[0], db_url_parts[1]
-    user, password = user_pass.split(":")
-    host_port, db_name = host_db.split("/")
-    host, port_str = host_port.split(":")
-
-    return await aiomysql.connect(
-        host=host, port=int(port_str),
-        user=user, password=password,
-        db=db_name, autocommit=True
-    )
-
-async def execute_raw_sql_external_db_direct(sql_query: str, params: Optional[tuple] = None) -> List[Dict[str, Any]]:
+class _PoolHolder:
+    def __init__(self):
+        self.pool: Optional[aiomysql.Pool] = None
+        self.lock = asyncio.Lock()
+
+# Pool aiomysql propio, creado la primera vez que se necesita (solo si no se comparte el de las tools)
+_external_pool: ProcessLocal[_PoolHolder] = ProcessLocal(_PoolHolder)
+
+
+def _parse_external_db_url(db_url: str) -> Dict[str, Any]:
+    """Convierte la URL SQLAlchemy en parámetros de aiomysql (decodifica usuario/contraseña escapados)."""
+    url = make_url(db_url)
+    return {
+        "host": url.host,
+        "port": url.port or 3306,
+        "user": url.username,
+        "password": url.password or "",
+        "db": url.database,
+    }
+
+
+async def get_external_pool() -> aiomysql.Pool:
+    """Devuelve el pool aiomysql compartido de la BD externa, creándolo la primera vez."""
+    holder = _external_pool.get()
+    if holder.pool is None:
+        async with holder.lock:
+            if holder.pool is None:
+                holder.pool = await aiomysql.create_pool(
+                    minsize=settings.EXTERNAL_DB_POOL_MIN_SIZE,
+                    maxsize=settings.EXTERNAL_DB_POOL_SIZE + settings.EXTERNAL_DB_MAX_OVERFLOW,
+                    pool_recycle=3600,
+                    autocommit=True,
+                    **_parse_external_db_url(settings.EXTERNAL_DB_URL),
+                )
+    return holder.pool
+
+
+async def close_external_pool() -> None:
+    holder = _external_pool.peek()
+    if holder is not None and holder.pool is not None:
+        holder.pool.close()
+        await holder.pool.wait_closed()
+        holder.pool = None
+
+
+@asynccontextmanager
+async def _external_db_connection() -> AsyncIterator[aiomysql.Connection]:
+    """
+    Presta una conexión aiomysql a la BD externa.
+    Si está habilitado, la toma del pool SQLAlchemy del primario que ya usan las tools
+    (un solo pool de conexiones hacia el ERP); si no, del pool aiomysql propio.
+    """
+    if settings.EXTERNAL_DB_SHARE_TOOL_POOL and settings.EXTERNAL_DB_URL.startswith("mysql+aiomysql"):
+        engine = get_replica_router(settings.EXTERNAL_DB_URL).primary.engine
+        async with engine.connect() as sa_conn:
+            raw_conn = await sa_conn.get_raw_connection()
+            yield raw_conn.driver_connection
+    else:
+        pool = await get_external_pool()
+        async with pool.acquire() as conn:
+            yield conn
+
+
+async def execute_raw_sql_external_db_direct(
+    sql_query: str,
+    params: Optional[tuple] = None,
+    as_dict: bool = True
+) -> Union[List[Dict[str, Any]], List[tuple]]:
     """
     Ejecuta una consulta SQL raw en la base de datos externa y devuelve los resultados.
+    Con `as_dict=False` las filas se devuelven como tuplas (más barato para resultados grandes).
     ¡ASEGÚRATE DE QUE LA SQL SEA SEGURA SI VIENE DE UNA ENTRADA NO CONFIABLE!
     Esta función es la que usaría tu `MCPSQLQueryTool` internamente.
     """
-    conn = None
-    results = []
+    cursor_class = aiomysql.DictCursor if as_dict else aiomysql.Cursor
     try:
-        conn = await _get_external_db_connection_direct()
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            await cur.execute(sql_query, args=params)
-            results = await cur.fetchall()
-        return results
+        async with _external_db_connection() as conn:
+            async with conn.cursor(cursor_class) as cur:
+                await cur.execute(sql_query, args=params)
+                if cur.description is None:
+                    # INSERT/UPDATE/DELETE: las conexiones compartidas no son autocommit
+                    if not conn.get_autocommit():
+                        await conn.commit()
+                    return []
+                return list(await cur.fetchall())
     except Exception as e:
         print(f"Error ejecutando SQL en BD externa (directo): {e}")
         # Aquí podrías relanzar la excepción o devolver un error estructurado
         raise  # O return {"error": str(e), "query": sql_query}
-    finally:
-        if conn:
-            conn.close()
 
 # --- Opción 2: Usando SQLAlchemy para la BD externa (si defines modelos o prefieres su API) ---
 # Necesitarías definir `async_engine_external` y `AsyncSessionLocalExternal` en `app/db/database.py`
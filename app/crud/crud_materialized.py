@@ -0,0 +1,51 @@
+# app/crud/crud_materialized.py
+from typing import Any, Dict, List, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy import delete
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+from app.db.models_conversation import MaterializedQueryResult
+
+async def list_materialized_ids(db: AsyncSession) -> List[str]:
+    result = await db.execute(select(MaterializedQueryResult.id))
+    return list(result.scalars().all())
+
+async def get_materialized(db: AsyncSession, result_id: str) -> Optional[MaterializedQueryResult]:
+    result = await db.execute(select(MaterializedQueryResult).filter(MaterializedQueryResult.id == result_id))
+    return result.scalar_one_or_none()
+
+async def upsert_materialized(db: AsyncSession, values: Dict[str, Any]) -> None:
+    """Inserta o refresca la materialización (una sola sentencia: INSERT ... ON DUPLICATE KEY UPDATE)."""
+    statement = mysql_insert(MaterializedQueryResult).values(**values)
+    refreshed = {column: statement.inserted[column] for column in values if column not in ("id", "created_at")}
+    await db.execute(statement.on_duplicate_key_update(**refreshed))
+    await db.commit()
+
+async def trim_materialized(db: AsyncSession, db_key: str, keep: int) -> List[str]:
+    """Deja solo las `keep` materializaciones con más score de la BD. Retorna los IDs eliminados."""
+    result = await db.execute(
+        select(MaterializedQueryResult.id)
+        .filter(MaterializedQueryResult.db_key == db_key)
+        .order_by(MaterializedQueryResult.score.desc())
+        .offset(keep)
+    )
+    evicted = list(result.scalars().all())
+    if evicted:
+        await db.execute(delete(MaterializedQueryResult).where(MaterializedQueryResult.id.in_(evicted)))
+        await db.commit()
+    return evicted
+
+async def delete_materialized(db: AsyncSession, result_id: str) -> None:
+    await db.execute(delete(MaterializedQueryResult).where(MaterializedQueryResult.id == result_id))
+    await db.commit()
+
+async def list_materialized_summaries(db: AsyncSession) -> List[Dict[str, Any]]:
+    """Materializaciones sin el resultado (para las métricas), de mayor a menor score."""
+    columns = (
+        MaterializedQueryResult.id, MaterializedQueryResult.db_label, MaterializedQueryResult.fingerprint,
+        MaterializedQueryResult.canonical_sql, MaterializedQueryResult.source_tables, MaterializedQueryResult.row_count,
+        MaterializedQueryResult.build_ms, MaterializedQueryResult.score, MaterializedQueryResult.refreshed_at,
+    )
+    result = await db.execute(select(*columns).order_by(MaterializedQueryResult.score.desc()))
+    return [dict(row) for row in result.mappings().all()]
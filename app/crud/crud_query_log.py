@@ -0,0 +1,72 @@
+# app/crud/crud_query_log.py
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy import case, delete, func
+
+from app.db.models_conversation import ToolQueryLog
+
+_REPORT_ORDER = {
+    "total": lambda: func.sum(ToolQueryLog.latency_ms),
+    "avg": lambda: func.avg(ToolQueryLog.latency_ms),
+    "calls": lambda: func.count(ToolQueryLog.id),
+}
+
+async def get_fingerprint_report(db: AsyncSession, since: datetime, order_by: str, limit: int) -> List[Dict[str, Any]]:
+    """
+    Consultas agrupadas por huella desde `since`, ordenadas por tiempo total, latencia media o
+    número de llamadas (`order_by`: "total" | "avg" | "calls").
+    """
+    database = ToolQueryLog.source == "database"
+    total_ms = func.sum(ToolQueryLog.latency_ms)
+    result = await db.execute(
+        select(
+            ToolQueryLog.fingerprint,
+            func.max(ToolQueryLog.normalized_sql).label("normalized_sql"),
+            func.max(ToolQueryLog.engine).label("engine"),
+            func.count(ToolQueryLog.id).label("calls"),
+            func.count(func.distinct(ToolQueryLog.tenant_id)).label("tenants"),
+            total_ms.label("total_ms"),
+            func.avg(ToolQueryLog.latency_ms).label("avg_ms"),
+            func.max(ToolQueryLog.latency_ms).label("max_ms"),
+            func.sum(case((ToolQueryLog.error.isnot(None), 1), else_=0)).label("errors"),
+            func.sum(case((ToolQueryLog.source == "materialized", 1), else_=0)).label("materialized"),
+            func.avg(case((database, ToolQueryLog.rows_returned))).label("avg_rows_returned"),
+            func.avg(case((database, ToolQueryLog.rows_examined))).label("avg_rows_examined"),
+            func.avg(ToolQueryLog.result_bytes).label("avg_result_bytes"),
+            func.max(ToolQueryLog.created_at).label("last_seen"),
+        )
+        .where(ToolQueryLog.created_at >= since, ToolQueryLog.fingerprint.isnot(None))
+        .group_by(ToolQueryLog.fingerprint)
+        .order_by(_REPORT_ORDER[order_by]().desc())
+        .limit(limit)
+    )
+    return [dict(row) for row in result.mappings().all()]
+
+async def get_latest_sample(db: AsyncSession, fingerprint: str, since: datetime) -> Optional[ToolQueryLog]:
+    """Última ejecución correcta contra la BD de la huella (SQL real y tenant, para el EXPLAIN)."""
+    result = await db.execute(
+        select(ToolQueryLog)
+        .where(
+            ToolQueryLog.fingerprint == fingerprint,
+            ToolQueryLog.created_at >= since,
+            ToolQueryLog.source == "database",
+            ToolQueryLog.error.is_(None),
+        )
+        .order_by(ToolQueryLog.created_at.desc())
+        .limit(1)
+    )
+    return result.scalar_one_or_none()
+
+async def delete_query_log_before(db: AsyncSession, cutoff: datetime, limit: int) -> int:
+    """Borra hasta `limit` entradas del registro anteriores a `cutoff` (lotes pequeños, ver RetentionJob)."""
+    result = await db.execute(
+        select(ToolQueryLog.id).where(ToolQueryLog.created_at < cutoff).order_by(ToolQueryLog.id).limit(limit)
+    )
+    ids = list(result.scalars().all())
+    if not ids:
+        return 0
+    deleted = await db.execute(delete(ToolQueryLog).where(ToolQueryLog.id.in_(ids)))
+    await db.commit()
+    return deleted.rowcount
@@ -0,0 +1,11 @@
+# app/crud/crud_tenant.py
+from typing import Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from app.db.models_conversation import Tenant
+
+async def get_tenant(db: AsyncSession, tenant_id: str) -> Optional[Tenant]:
+    """Obtiene un tenant activo por su ID."""
+    result = await db.execute(select(Tenant).filter(Tenant.id == tenant_id, Tenant.active.is_(True)))
+    return result.scalar_one_or_none()
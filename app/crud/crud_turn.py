@@ -0,0 +1,141 @@
+# app/crud/crud_turn.py
+from typing import Any, Dict, List, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy import insert, update, and_, or_, text, tuple_
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql import func
+
+from app.db.models_conversation import ChatTurn
+
+TURN_FINAL_STATUSES = ("done", "failed")
+
+async def create_turn(
+    db: AsyncSession,
+    turn_id: str,
+    session_id: str,
+    message: str,
+    user_id: Optional[str] = None
+) -> ChatTurn:
+    """Registra un turno pendiente de ejecutar por los workers."""
+    turn = ChatTurn(id=turn_id, session_id=session_id, user_id=user_id, message=message, status="queued")
+    db.add(turn)
+    await db.commit()
+    await db.refresh(turn)
+    return turn
+
+async def create_batch_turns(db: AsyncSession, turns: List[Dict[str, Any]]) -> None:
+    """Registra los turnos de un lote (con batch_id/batch_index) en un solo INSERT."""
+    await db.execute(insert(ChatTurn), [{**turn, "status": "queued", "attempts": 0} for turn in turns])
+    await db.commit()
+
+async def get_batch_turns(db: AsyncSession, batch_id: str) -> List[ChatTurn]:
+    result = await db.execute(
+        select(ChatTurn).filter(ChatTurn.batch_id == batch_id).order_by(ChatTurn.batch_index)
+    )
+    return list(result.scalars().all())
+
+async def get_turn(db: AsyncSession, turn_id: str) -> Optional[ChatTurn]:
+    result = await db.execute(select(ChatTurn).filter(ChatTurn.id == turn_id))
+    return result.scalar_one_or_none()
+
+def _blocked_by_earlier_turn():
+    """
+    Hay otro turno de la misma sesión en curso, o en cola y anterior: este debe esperar.
+    Así las preguntas de una sesión se ejecutan de una en una y en orden aunque las reclamen
+    workers de procesos distintos. El orden es (created_at, batch_index, id); el id solo
+    desempata turnos creados en el mismo segundo para que nunca sean reclamables a la vez.
+    """
+    prev = aliased(ChatTurn)
+    earlier = (
+        tuple_(prev.created_at, func.coalesce(prev.batch_index, -1), prev.id)
+        < tuple_(ChatTurn.created_at, func.coalesce(ChatTurn.batch_index, -1), ChatTurn.id)
+    )
+    return (
+        select(prev.id)
+        .where(
+            prev.session_id == ChatTurn.session_id,
+            prev.id != ChatTurn.id,
+            or_(prev.status == "running", and_(prev.status == "queued", earlier)),
+        )
+        .exists()
+    )
+
+async def claim_next_turn(db: AsyncSession, worker_id: str, batch: bool = False) -> Optional[ChatTurn]:
+    """
+    Toma el turno en cola más antiguo y lo marca como 'running' para este worker.
+    SKIP LOCKED permite que varios workers (en uno o varios procesos) reclamen en paralelo
+    sin bloquearse ni tomar el mismo turno. `batch` elige el carril: turnos interactivos
+    (?async=true) o turnos de lotes (POST /batch). Se saltan los turnos cuya sesión tiene
+    otro turno anterior pendiente o en curso.
+    """
+    lane = ChatTurn.batch_id.isnot(None) if batch else ChatTurn.batch_id.is_(None)
+    result = await db.execute(
+        select(ChatTurn)
+        .filter(ChatTurn.status == "queued", lane, ~_blocked_by_earlier_turn())
+        .order_by(ChatTurn.created_at, ChatTurn.batch_index)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    )
+    turn = result.scalar_one_or_none()
+    if turn is None:
+        await db.rollback()
+        return None
+    turn.status = "running"
+    turn.worker_id = worker_id
+    turn.attempts = (turn.attempts or 0) + 1
+    turn.started_at = func.now()
+    turn.heartbeat_at = func.now()
+    await db.commit()
+    await db.refresh(turn)
+    return turn
+
+async def heartbeat_turn(db: AsyncSession, turn_id: str) -> None:
+    await db.execute(update(ChatTurn).where(ChatTurn.id == turn_id).values(heartbeat_at=func.now()))
+    await db.commit()
+
+async def finish_turn(
+    db: AsyncSession,
+    turn_id: str,
+    status: str,
+    response: Optional[str] = None,
+    error: Optional[str] = None
+) -> None:
+    """Marca el turno como 'done' (con la respuesta serializada) o 'failed' (con el error)."""
+    await db.execute(
+        update(ChatTurn)
+        .where(ChatTurn.id == turn_id)
+        .values(status=status, response=response, error=error, finished_at=func.now())
+    )
+    await db.commit()
+
+async def requeue_turn(db: AsyncSession, turn_id: str) -> None:
+    """Devuelve a la cola un turno que no pudo empezar (sin contar el intento)."""
+    await db.execute(
+        update(ChatTurn)
+        .where(ChatTurn.id == turn_id)
+        .values(status="queued", worker_id=None, attempts=ChatTurn.attempts - 1)
+    )
+    await db.commit()
+
+async def recover_stale_turns(db: AsyncSession, lease_seconds: float, max_attempts: int) -> int:
+    """
+    Recupera turnos 'running' cuyo worker dejó de dar señales (reinicio, caída):
+    vuelven a la cola si les quedan intentos, si no se marcan como fallidos.
+    Retorna el número de turnos recuperados.
+    """
+    # Se calcula con el reloj de la BD, igual que heartbeat_at, para no depender de la zona horaria de cada worker
+    stale_before = func.date_sub(func.now(), text(f"INTERVAL {int(lease_seconds)} SECOND"))
+    stale = and_(ChatTurn.status == "running", ChatTurn.heartbeat_at < stale_before)
+    requeued = await db.execute(
+        update(ChatTurn)
+        .where(stale, ChatTurn.attempts < max_attempts)
+        .values(status="queued", worker_id=None)
+    )
+    await db.execute(
+        update(ChatTurn)
+        .where(stale, ChatTurn.attempts >= max_attempts)
+        .values(status="failed", error="El worker que ejecutaba el turno dejó de responder.", finished_at=func.now())
+    )
+    await db.commit()
+    return requeued.rowcount
@@ -0,0 +1,160 @@
+# app/db/blob_store.py
+import functools
+import uuid
+import zlib
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from app.core import jsonutil
+from app.core.config import settings
+from app.tools.result_digest import digest_tool_response
+
+# Referencia que sustituye, dentro del JSON del mensaje, al payload guardado en chat_message_blobs:
+#   {"$blob": "<uuid>", "size": <bytes sin comprimir>, "preview": "<primeros caracteres>", "digest": {...}}
+# El digest (ver app/tools/result_digest.py) se calcula al escribir: el historial compactado no
+# necesita leer ni descomprimir el blob.
+BLOB_REF_KEY = "$blob"
+
+
+@functools.lru_cache(maxsize=1)
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def _codec() -> str:
+    if settings.MESSAGE_BLOB_CODEC == "zlib":
+        return "zlib"
+    if _zstd() is not None:
+        return "zstd"
+    if settings.MESSAGE_BLOB_CODEC == "zstd":
+        print("WARNING:app.db.blob_store:MESSAGE_BLOB_CODEC=zstd pero el paquete 'zstandard' no está instalado. Se usa zlib.")
+    return "zlib"
+
+
+def compress_payload(raw: bytes) -> Tuple[str, bytes]:
+    codec = _codec()
+    if codec == "zstd":
+        return codec, _zstd().ZstdCompressor(level=3).compress(raw)
+    return codec, zlib.compress(raw, 6)
+
+
+def decompress_payload(codec: str, data: bytes) -> bytes:
+    if codec == "zstd":
+        zstandard = _zstd()
+        if zstandard is None:
+            raise RuntimeError("Hay blobs comprimidos con zstd: instala el paquete 'zstandard' para leerlos.")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def is_blob_ref(value: Any) -> bool:
+    return isinstance(value, dict) and BLOB_REF_KEY in value
+
+
+def _function_responses(parsed: Any) -> Iterable[Dict[str, Any]]:
+    for part in parsed if isinstance(parsed, list) else [parsed]:
+        if isinstance(part, dict) and isinstance(part.get("function_response"), dict):
+            yield part["function_response"]
+
+
+def externalize_parts(session_id: str, parsed: Any) -> Tuple[Any, List[Dict[str, Any]]]:
+    """
+    Saca a filas de chat_message_blobs (comprimidas) las respuestas de tools del mensaje cuyo JSON
+    supera MESSAGE_BLOB_THRESHOLD_BYTES y deja en su lugar una referencia con extracto y digest.
+    No modifica `parsed` (el orquestador sigue usando esas partes para el LLM): retorna una copia
+    con las referencias y las filas de blobs a insertar (antes que el mensaje).
+    """
+    parts = parsed if isinstance(parsed, list) else [parsed]
+    stored_parts: List[Any] = []
+    blob_rows: List[Dict[str, Any]] = []
+    for part in parts:
+        function_response = part.get("function_response") if isinstance(part, dict) else None
+        response = function_response.get("response") if isinstance(function_response, dict) else None
+        if response is None or is_blob_ref(response):
+            stored_parts.append(part)
+            continue
+        raw = jsonutil.dumps_bytes(response) # Única serialización de un payload grande
+        if len(raw) <= settings.MESSAGE_BLOB_THRESHOLD_BYTES:
+            stored_parts.append(part)
+            continue
+        codec, data = compress_payload(raw)
+        blob_id = str(uuid.uuid4())
+        blob_rows.append({"id": blob_id, "session_id": session_id, "codec": codec, "raw_size": len(raw), "data": data})
+        reference = {
+            BLOB_REF_KEY: blob_id,
+            "size": len(raw),
+            "preview": raw[:settings.MESSAGE_BLOB_PREVIEW_CHARS].decode("utf-8", "ignore"),
+            "digest": digest_tool_response(response),
+        }
+        stored_parts.append({**part, "function_response": {**function_response, "response": reference}})
+    return (stored_parts if isinstance(parsed, list) else stored_parts[0]), blob_rows
+
+
+def serialize_parts(session_id: str, parts: Any) -> Tuple[str, List[Dict[str, Any]]]:
+    """Serializa un mensaje estructurado (partes de tool) para guardarlo, sacando antes los payloads grandes."""
+    stored_parts, blob_rows = externalize_parts(session_id, parts)
+    return jsonutil.dumps(stored_parts), blob_rows
+
+
+def externalize_message(session_id: str, message: str) -> Tuple[str, List[Dict[str, Any]]]:
+    """Como serialize_parts, para un mensaje que ya llega serializado como texto."""
+    if len(message) <= settings.MESSAGE_BLOB_THRESHOLD_BYTES:
+        return message, []
+    try:
+        parsed = jsonutil.loads(message)
+    except (jsonutil.JSONDecodeError, TypeError):
+        return message, []
+    stored_parts, blob_rows = externalize_parts(session_id, parsed)
+    if not blob_rows:
+        return message, []
+    return jsonutil.dumps(stored_parts), blob_rows
+
+
+def blob_ids_in(parsed: Any) -> List[str]:
+    """IDs de blob referenciados en un mensaje ya parseado."""
+    return [fr["response"][BLOB_REF_KEY] for fr in _function_responses(parsed) if is_blob_ref(fr.get("response"))]
+
+
+def blob_ids_in_message(message: Optional[str]) -> List[str]:
+    """Como blob_ids_in, pero sobre el texto guardado (sin parsear los mensajes que no tienen referencias)."""
+    if not message or BLOB_REF_KEY not in message:
+        return []
+    try:
+        return blob_ids_in(jsonutil.loads(message))
+    except (jsonutil.JSONDecodeError, TypeError):
+        return []
+
+
+def decode_blob(blob) -> Any:
+    """Payload original (JSON ya parseado) de una fila de chat_message_blobs."""
+    return jsonutil.loads(decompress_payload(blob.codec, blob.data))
+
+
+def resolve_blob_refs(parsed: Any, payloads: Dict[str, Any]) -> Any:
+    """Sustituye en el mensaje parseado las referencias cuyo payload está en `payloads` (id -> payload)."""
+    for function_response in _function_responses(parsed):
+        response = function_response.get("response")
+        if is_blob_ref(response) and response[BLOB_REF_KEY] in payloads:
+            function_response["response"] = payloads[response[BLOB_REF_KEY]]
+    return parsed
+
+
+def compact_function_responses(parsed: Any, summary: Optional[str] = None) -> Any:
+    """
+    Sustituye cada respuesta de tool del mensaje parseado por su digest. Para las referencias a
+    blobs se usa el digest guardado en la propia referencia, sin leer el blob.
+    """
+    for function_response in _function_responses(parsed):
+        response = function_response.get("response")
+        if is_blob_ref(response):
+            stored = response.get("digest") or {"content": {"compacted": True, "preview": response.get("preview")}}
+            digest = {**stored, "content": dict(stored["content"])} # Copia: el resumen no debe tocar la referencia
+            if summary:
+                digest["content"]["assistant_summary"] = summary[:settings.HISTORY_DIGEST_SUMMARY_CHARS]
+            function_response["response"] = digest
+        else:
+            function_response["response"] = digest_tool_response(response, summary)
+    return parsed
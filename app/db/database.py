@@ -1,32 +1,62 @@
 # app/db/database.py
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+import asyncio
+from pathlib import Path
+from typing import Set
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
 from app.core.config import settings
+from app.core import jsonutil
+from app.core.process_local import ProcessLocal
+
+# Los engines se crean la primera vez que se usan y una vez por proceso (ver ProcessLocal):
+# así cada worker de gunicorn tiene sus propios pools aunque la app se cargue antes del fork.
 
 # Motor para la base de datos de conversaciones
-async_engine_conv = create_async_engine(
+_conv_engine: ProcessLocal[AsyncEngine] = ProcessLocal(lambda: create_async_engine(
     settings.CONVERSATION_DB_URL,
     pool_recycle=3600, # Opcional: reciclar conexiones
+    json_serializer=jsonutil.dumps, # Columnas JSON (session_data) con orjson
+    json_deserializer=jsonutil.loads,
     echo=False # Poner en True para debugging SQL
-)
-AsyncSessionLocalConversation = sessionmaker(
-    bind=async_engine_conv, class_=AsyncSession, expire_on_commit=False
-)
+))
 BaseConversation = declarative_base() # Los modelos de conversación heredarán de aquí
 
 # Motor para la base de datos externa (si se accede vía SQLAlchemy en alguna tool)
 # A menudo, las tools pueden usar conexiones directas (ej: aiomysql.connect)
 # pero si hay ORM involucrado para la tool, se definiría similar.
-async_engine_external = create_async_engine(
+_external_engine: ProcessLocal[AsyncEngine] = ProcessLocal(lambda: create_async_engine(
     settings.EXTERNAL_DB_URL,
     pool_recycle=3600,
     echo=False
-)
-AsyncSessionLocalExternal = sessionmaker(
-    bind=async_engine_external, class_=AsyncSession, expire_on_commit=False
-)
+))
 BaseExternal = declarative_base() # Los modelos de datos externos heredarán de aquí
 
+
+def get_conv_engine() -> AsyncEngine:
+    return _conv_engine.get()
+
+
+def get_external_engine() -> AsyncEngine:
+    return _external_engine.get()
+
+
+class ProcessLocalSessionmaker:
+    """Se usa igual que un sessionmaker (`AsyncSessionLocalX()`), pero sobre el engine del proceso actual."""
+
+    def __init__(self, engine: ProcessLocal[AsyncEngine]):
+        self._maker = ProcessLocal(
+            lambda: sessionmaker(bind=engine.get(), class_=AsyncSession, expire_on_commit=False)
+        )
+
+    def __call__(self, **kwargs) -> AsyncSession:
+        return self._maker.get()(**kwargs)
+
+
+AsyncSessionLocalConversation = ProcessLocalSessionmaker(_conv_engine)
+AsyncSessionLocalExternal = ProcessLocalSessionmaker(_external_engine)
+
 # Dependencia para obtener sesión de BD de conversaciones en endpoints
 async def get_conv_db() -> AsyncSession:
     async with AsyncSessionLocalConversation() as session:
@@ -39,9 +69,44 @@ async def get_external_db() -> AsyncSession:
 
 # Función para crear tablas (ejecutar en startup)
 async def create_db_and_tables():
-    async with async_engine_conv.begin() as conn:
+    async with get_conv_engine().begin() as conn:
         # await conn.run_sync(BaseConversation.metadata.drop_all) # Para limpiar en desarrollo
         await conn.run_sync(BaseConversation.metadata.create_all)
     # Si tienes modelos para la DB externa y quieres crearlos con SQLAlchemy:
-    # async with async_engine_external.begin() as conn:
-    #     await conn.run_sync(BaseExternal.metadata.create_all)
\ No newline at end of file
+    # async with get_external_engine().begin() as conn:
+    #     await conn.run_sync(BaseExternal.metadata.create_all)
+
+class SchemaVersionError(Exception):
+    """La BD de conversaciones no está en la revisión de Alembic que espera el código."""
+
+
+def _alembic_head_revisions() -> Set[str]:
+    from alembic.config import Config # Import perezoso: solo se usa en el arranque
+    from alembic.script import ScriptDirectory
+    root = Path(__file__).resolve().parents[2]
+    config = Config(str(root / "alembic.ini"))
+    config.set_main_option("script_location", str(root / "alembic"))
+    return set(ScriptDirectory.from_config(config).get_heads())
+
+async def check_schema_version():
+    """
+    Alternativa rápida a create_db_and_tables: una sola consulta a `alembic_version`, sin DDL.
+    Lanza SchemaVersionError si falta aplicar migraciones (`alembic upgrade head`).
+    """
+    heads = await asyncio.to_thread(_alembic_head_revisions)
+    async with get_conv_engine().connect() as conn:
+        try:
+            current = set((await conn.execute(text("SELECT version_num FROM alembic_version"))).scalars().all())
+        except DBAPIError:
+            current = set()
+    if current != heads:
+        raise SchemaVersionError(
+            f"Esquema de conversaciones en revisión {sorted(current) or 'ninguna'}, el código espera {sorted(heads)}. "
+            "Ejecuta `alembic upgrade head`."
+        )
+
+async def dispose_engines():
+    """Cierra los pools de este proceso (en el apagado del worker)."""
+    for engine in (_conv_engine.peek(), _external_engine.peek()):
+        if engine is not None:
+            await engine.dispose()
@@ -1,27 +1,170 @@
 # app/db/models_conversation.py
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, BigInteger, Float, String, Text, DateTime, ForeignKey, Index, LargeBinary, Boolean, JSON, Computed, true
+from sqlalchemy.dialects.mysql import LONGBLOB
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
+from app.core.config import settings
 from app.db.database import BaseConversation
 
+# Claves de session_data con columna generada (virtual) e índice: filtrar sesiones por ellas no recorre
+# la tabla. Añadir una clave requiere su columna `meta_<clave>` aquí y una migración.
+SESSION_METADATA_INDEXED_KEYS = ("tenant_id", "channel")
+# Longitud de esas columnas: la API rechaza (422) valores más largos (ver app/schemas/chat.py)
+SESSION_METADATA_MAX_LENGTH = 64
+
+
+def _metadata_key(key: str) -> Computed:
+    # `->>` (extraer y quitar comillas) existe en MySQL 8 y en SQLite 3.38+. SUBSTR (en ambos) evita que un
+    # valor antiguo más largo que la columna haga fallar el INSERT/UPDATE en modo estricto
+    return Computed(f"SUBSTR(session_data ->> '$.{key}', 1, {SESSION_METADATA_MAX_LENGTH})", persisted=False)
+
+
 class ChatSession(BaseConversation):
     __tablename__ = "chat_sessions"
     id = Column(String(36), primary_key=True, index=True) # UUID o similar
     user_id = Column(String(255), index=True, nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
-    session_data = Column(Text, nullable=True) # RENAMED: Used to be 'metadata'
+    session_data = Column(JSON(none_as_null=True), nullable=True) # Metadata de la sesión (JSON nativo)
+    meta_tenant_id = Column(String(SESSION_METADATA_MAX_LENGTH), _metadata_key("tenant_id"))
+    meta_channel = Column(String(SESSION_METADATA_MAX_LENGTH), _metadata_key("channel"))
+
+    # chat_messages está particionada y MySQL no admite FKs en tablas particionadas: la relación se declara a mano
+    messages = relationship(
+        "ChatMessage",
+        primaryjoin="ChatSession.id == foreign(ChatMessage.session_id)",
+        back_populates="session",
+        cascade="all, delete-orphan",
+        order_by="[ChatMessage.timestamp, ChatMessage.id]"
+    )
 
-    messages = relationship("ChatMessage", back_populates="session", cascade="all, delete-orphan")
+    __table_args__ = (
+        Index("ix_chat_sessions_meta_tenant_id", "meta_tenant_id", "created_at"),
+        Index("ix_chat_sessions_meta_channel", "meta_channel", "created_at"),
+    )
 
 class ChatMessage(BaseConversation):
     __tablename__ = "chat_messages"
+    # La tabla está particionada por mes sobre `timestamp` (ver app/db/partitioning.py), y MySQL exige
+    # que la columna de partición forme parte de la PK: PK (id, timestamp). Para el ORM basta con `id`.
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
-    session_id = Column(String(36), ForeignKey("chat_sessions.id"), nullable=False)
+    session_id = Column(String(36), nullable=False)
     sender = Column(String(50), nullable=False)  # "user" o "assistant"
     message = Column(Text, nullable=False)
-    timestamp = Column(DateTime(timezone=True), server_default=func.now())
+    timestamp = Column(DateTime(timezone=True), primary_key=True, nullable=False, server_default=func.now())
     # tool_calls = Column(Text, nullable=True) # JSON string de tool calls si el modelo pidió una
     # tool_responses = Column(Text, nullable=True) # JSON string de las respuestas de las tools
 
-    session = relationship("ChatSession", back_populates="messages")
\ No newline at end of file
+    session = relationship(
+        "ChatSession",
+        primaryjoin="ChatSession.id == foreign(ChatMessage.session_id)",
+        back_populates="messages"
+    )
+
+    __table_args__ = (
+        Index("ix_chat_messages_session_ts", "session_id", "timestamp"),
+    )
+    __mapper_args__ = {"primary_key": [id]}
+
+class ChatMessageBlob(BaseConversation):
+    """
+    Payload grande de un mensaje (p.ej. la respuesta de una tool) guardado comprimido fuera de
+    chat_messages. El mensaje conserva solo una referencia {"$blob": id, ...} y un extracto.
+    """
+    __tablename__ = "chat_message_blobs"
+    id = Column(String(36), primary_key=True) # UUID generado en la app, antes del INSERT del mensaje
+    session_id = Column(String(36), nullable=False, index=True)
+    codec = Column(String(10), nullable=False) # "zstd" | "zlib"
+    raw_size = Column(Integer, nullable=False) # Bytes del JSON sin comprimir
+    data = Column(LargeBinary().with_variant(LONGBLOB(), "mysql"), nullable=False)
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now(), index=True)
+
+class ChatTurn(BaseConversation):
+    """Turno de chat en modo asíncrono (job): lo ejecuta cualquier worker y sobrevive a reinicios."""
+    __tablename__ = "chat_turns"
+    id = Column(String(36), primary_key=True) # UUID del turno
+    session_id = Column(String(36), ForeignKey("chat_sessions.id"), nullable=False, index=True)
+    user_id = Column(String(255), nullable=True)
+    message = Column(Text, nullable=False) # Mensaje del usuario a procesar
+    status = Column(String(20), nullable=False, default="queued") # queued | running | done | failed
+    response = Column(Text, nullable=True) # ChatMessageResponse serializado como JSON
+    error = Column(Text, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    worker_id = Column(String(100), nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    heartbeat_at = Column(DateTime(timezone=True), nullable=True) # Lease del worker que lo ejecuta
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    batch_id = Column(String(36), nullable=True) # Lote de POST /batch al que pertenece (None: turno interactivo)
+    batch_index = Column(Integer, nullable=True) # Posición de la pregunta en el lote
+
+    __table_args__ = (
+        Index("ix_chat_turns_status_created", "status", "created_at"),
+        Index("ix_chat_turns_batch", "batch_id", "batch_index"),
+    )
+
+class Tenant(BaseConversation):
+    """
+    Empresa cliente con su propia BD externa (mismo esquema que `nilo_db`). Las sesiones indican su
+    tenant con `tenant_id` en session_data; sin tenant se usa EXTERNAL_DB_URL.
+    """
+    __tablename__ = "tenants"
+    id = Column(String(64), primary_key=True)
+    name = Column(String(255), nullable=True)
+    db_url = Column(Text, nullable=False) # Formato SQLAlchemy, como EXTERNAL_DB_URL
+    replica_urls = Column(Text, nullable=True) # Réplicas de lectura separadas por coma
+    max_connections = Column(Integer, nullable=True) # Tope de conexiones por proceso (NULL = TENANT_DB_MAX_CONNECTIONS)
+    active = Column(Boolean, nullable=False, default=True, server_default=true())
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+class MaterializedQueryResult(BaseConversation):
+    """
+    Resultado materializado de una agregación frecuente y costosa de la BD externa (ver
+    app/services/query_materializer.py). Las consultas con la misma forma canónica se responden desde
+    aquí mientras las tablas de origen no cambien (UPDATE_TIME de information_schema).
+    """
+    __tablename__ = "materialized_query_results"
+    id = Column(String(40), primary_key=True) # sha1(BD + consulta canónica)
+    db_key = Column(String(16), nullable=False) # Huella de la URL de la BD externa (nunca la URL: lleva credenciales)
+    db_label = Column(String(255), nullable=True) # host:puerto/bd, para las métricas
+    fingerprint = Column(String(16), nullable=False, index=True)
+    canonical_sql = Column(Text, nullable=False)
+    source_tables = Column(Text, nullable=False) # JSON: tablas de origen
+    source_versions = Column(Text, nullable=False) # JSON: tabla -> UPDATE_TIME al materializar
+    codec = Column(String(10), nullable=False)
+    result = Column(LargeBinary().with_variant(LONGBLOB(), "mysql"), nullable=False) # Resultado de la tool, comprimido
+    row_count = Column(Integer, nullable=False)
+    build_ms = Column(Integer, nullable=False) # Latencia de la consulta en la BD externa
+    score = Column(Integer, nullable=False) # Ejecuciones observadas x build_ms: decide el top-N
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    refreshed_at = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        Index("ix_materialized_query_results_db_score", "db_key", "score"),
+        {"schema": settings.MATERIALIZE_SCHEMA or None}, # Esquema de analítica separado (opcional)
+    )
+
+class ToolQueryLog(BaseConversation):
+    """Una consulta ejecutada por las tools SQL (escrita por lotes con el writer write-behind)."""
+    __tablename__ = "tool_query_log"
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+    fingerprint = Column(String(16), nullable=True) # NULL si la consulta no se pudo analizar
+    normalized_sql = Column(Text, nullable=True) # Forma canónica con los literales como `?`
+    sql_text = Column(Text, nullable=True) # SQL ejecutado (recortado a QUERY_LOG_SQL_MAX_CHARS)
+    engine = Column(String(20), nullable=False) # Nombre de la tool
+    db_label = Column(String(255), nullable=True)
+    tenant_id = Column(String(64), nullable=True)
+    session_id = Column(String(36), nullable=True)
+    source = Column(String(20), nullable=False) # "database" | "materialized" | "rejected"
+    latency_ms = Column(Float, nullable=False)
+    rows_returned = Column(Integer, nullable=True)
+    rows_examined = Column(BigInteger, nullable=True) # Solo con QUERY_LOG_ROWS_EXAMINED (MySQL 8)
+    result_bytes = Column(Integer, nullable=True)
+    error = Column(Text, nullable=True)
+
+    __table_args__ = (
+        Index("ix_tool_query_log_created", "created_at"),
+        Index("ix_tool_query_log_fingerprint_created", "fingerprint", "created_at"),
+    )
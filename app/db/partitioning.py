@@ -0,0 +1,79 @@
+# app/db/partitioning.py
+from datetime import date
+from typing import List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+# Particionado mensual (RANGE sobre TO_DAYS(timestamp)) de chat_messages. Una partición
+# "pmax" al final recoge todo lo posterior y se parte cada mes para crear las siguientes.
+PARTITIONED_TABLE = "chat_messages"
+MAXVALUE_PARTITION = "pmax"
+
+
+def month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def add_months(day: date, months: int) -> date:
+    index = day.year * 12 + (day.month - 1) + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"p{month:%Y%m}"
+
+
+def partition_clause(month: date) -> str:
+    """Partición con las filas del mes `month` (hasta el día 1 del mes siguiente, exclusivo)."""
+    return f"PARTITION {partition_name(month)} VALUES LESS THAN (TO_DAYS('{add_months(month, 1):%Y-%m-%d}'))"
+
+
+def partition_by_clause(first_month: date, last_month: date) -> str:
+    """Cláusula PARTITION BY con un mes por partición entre first_month y last_month, más pmax."""
+    partitions: List[str] = []
+    month = month_start(first_month)
+    while month <= last_month:
+        partitions.append(partition_clause(month))
+        month = add_months(month, 1)
+    partitions.append(f"PARTITION {MAXVALUE_PARTITION} VALUES LESS THAN MAXVALUE")
+    return "PARTITION BY RANGE (TO_DAYS(`timestamp`)) (\n    " + ",\n    ".join(partitions) + "\n)"
+
+
+async def list_partitions(conn: AsyncConnection) -> List[str]:
+    """Nombres de las particiones de la tabla; lista vacía si no está particionada (p.ej. creada con create_all)."""
+    result = await conn.execute(
+        text(
+            "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND PARTITION_NAME IS NOT NULL "
+            "ORDER BY PARTITION_ORDINAL_POSITION"
+        ),
+        {"table": PARTITIONED_TABLE},
+    )
+    return list(result.scalars().all())
+
+
+async def ensure_future_partitions(conn: AsyncConnection, months_ahead: int, today: Optional[date] = None) -> List[str]:
+    """
+    Crea las particiones de los próximos `months_ahead` meses partiendo `pmax`.
+    Mientras pmax esté vacía, REORGANIZE es instantáneo. Retorna las particiones creadas.
+    """
+    existing = await list_partitions(conn)
+    if MAXVALUE_PARTITION not in existing:
+        return []
+    current = month_start(today or date.today())
+    missing = [
+        add_months(current, offset)
+        for offset in range(months_ahead + 1)
+        if partition_name(add_months(current, offset)) not in existing
+    ]
+    # Solo se añaden meses posteriores a la última partición existente (RANGE exige orden creciente)
+    last_existing = max((p for p in existing if p != MAXVALUE_PARTITION), default=None)
+    missing = [m for m in missing if last_existing is None or partition_name(m) > last_existing]
+    if not missing:
+        return []
+    clauses = ", ".join([partition_clause(m) for m in missing] + [f"PARTITION {MAXVALUE_PARTITION} VALUES LESS THAN MAXVALUE"])
+    await conn.execute(text(f"ALTER TABLE {PARTITIONED_TABLE} REORGANIZE PARTITION {MAXVALUE_PARTITION} INTO ({clauses})"))
+    created = [partition_name(m) for m in missing]
+    print(f"INFO:app.db.partitioning:Particiones creadas en {PARTITIONED_TABLE}: {created}")
+    return created
@@ -0,0 +1,246 @@
+# app/db/replica_router.py
+import asyncio
+import itertools
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import text as sa_text
+from sqlalchemy.exc import DBAPIError, TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, create_async_engine
+
+from app.core.config import settings
+from app.core.process_local import ProcessLocal
+
+
+class NoHealthyReplicaError(Exception):
+    """No hay réplica disponible y el failover al primario está deshabilitado."""
+
+
+class _DBNode:
+    """Un destino de lectura (primario o réplica) con su engine y su estado de salud."""
+
+    def __init__(self, url: str, engine: AsyncEngine, is_primary: bool):
+        self.url = url
+        self.engine = engine
+        self.is_primary = is_primary
+        self.healthy = True
+        self.lag_seconds: Optional[float] = None
+        self.last_check = 0.0
+        self.last_error: Optional[str] = None
+
+    @property
+    def label(self) -> str:
+        # Nunca exponer credenciales en logs/estadísticas
+        return self.url.split("@")[-1] if "@" in self.url else self.url
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "target": self.label,
+            "primary": self.is_primary,
+            "healthy": self.healthy,
+            "lag_seconds": self.lag_seconds,
+            "last_error": self.last_error,
+        }
+
+
+class ReplicaRouter:
+    """
+    Reparte las lecturas de las tools entre las réplicas de la BD externa.
+
+    - Round-robin entre réplicas sanas cuyo retraso de replicación no supera el máximo.
+    - Chequeos de salud periódicos en segundo plano (no bloquean la consulta en curso)
+      y chequeo pasivo: un error de conexión marca la réplica como caída.
+    - Failover al primario si no queda ninguna réplica utilizable.
+    - Cada réplica tiene su propio pool con límites (pool_size/max_overflow/pool_timeout).
+    """
+
+    def __init__(
+        self,
+        primary_url: str,
+        replica_urls: Optional[List[str]] = None,
+        pool_size: int = settings.EXTERNAL_DB_REPLICA_POOL_SIZE,
+        max_overflow: int = settings.EXTERNAL_DB_REPLICA_MAX_OVERFLOW,
+        pool_timeout: float = settings.EXTERNAL_DB_REPLICA_POOL_TIMEOUT,
+        max_lag_seconds: float = settings.EXTERNAL_DB_REPLICA_MAX_LAG_SECONDS,
+        health_check_interval: float = settings.EXTERNAL_DB_REPLICA_HEALTH_INTERVAL,
+        health_check_timeout: float = settings.EXTERNAL_DB_REPLICA_HEALTH_TIMEOUT,
+        primary_fallback: bool = settings.EXTERNAL_DB_PRIMARY_FALLBACK,
+        primary_pool_size: int = settings.EXTERNAL_DB_POOL_SIZE,
+        primary_max_overflow: int = settings.EXTERNAL_DB_MAX_OVERFLOW,
+    ):
+        self.primary = _DBNode(
+            primary_url,
+            create_async_engine(
+                primary_url,
+                pool_size=primary_pool_size,
+                max_overflow=primary_max_overflow,
+                pool_recycle=3600,
+                pool_pre_ping=True,
+                echo=False,
+            ),
+            is_primary=True,
+        )
+        self.replicas = [
+            _DBNode(
+                url,
+                create_async_engine(
+                    url,
+                    pool_size=pool_size,
+                    max_overflow=max_overflow,
+                    pool_timeout=pool_timeout,
+                    pool_recycle=3600,
+                    pool_pre_ping=True,
+                    echo=False,
+                ),
+                is_primary=False,
+            )
+            for url in (replica_urls or [])
+        ]
+        self.max_lag_seconds = max_lag_seconds
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self.primary_fallback = primary_fallback
+        self._round_robin = itertools.count()
+        self._health_task: Optional[asyncio.Task] = None
+
+        print(
+            f"INFO:app.db.replica_router:Router inicializado. Primario: {self.primary.label}, "
+            f"réplicas: {[r.label for r in self.replicas]}"
+        )
+
+    # --- Salud de las réplicas ---
+
+    async def _query_replication_lag(self, conn: AsyncConnection) -> Optional[float]:
+        """Devuelve el retraso en segundos, o None si no se puede medir (sin permisos, no es réplica...)."""
+        for statement in ("SHOW REPLICA STATUS", "SHOW SLAVE STATUS"):  # MySQL >= 8.0.22 / anteriores
+            try:
+                row = (await conn.execute(sa_text(statement))).mappings().first()
+            except DBAPIError:
+                continue
+            if row is None:
+                return None  # El servidor no está replicando de nadie
+            lag = row.get("Seconds_Behind_Source", row.get("Seconds_Behind_Master"))
+            # Un lag NULL significa que la replicación está detenida
+            return float(lag) if lag is not None else float("inf")
+        return None
+
+    async def _check_node(self, node: _DBNode) -> None:
+        try:
+            async def _probe():
+                async with node.engine.connect() as conn:
+                    await conn.execute(sa_text("SELECT 1"))
+                    return await self._query_replication_lag(conn)
+
+            node.lag_seconds = await asyncio.wait_for(_probe(), timeout=self.health_check_timeout)
+            node.healthy = True
+            node.last_error = None
+        except Exception as e:
+            if node.healthy:
+                print(f"ERROR:app.db.replica_router:Réplica {node.label} no disponible: {e}")
+            node.healthy = False
+            node.last_error = str(e)
+        finally:
+            node.last_check = time.monotonic()
+
+    async def check_health(self) -> None:
+        """Chequea todas las réplicas en paralelo."""
+        await asyncio.gather(*(self._check_node(node) for node in self.replicas))
+
+    def _schedule_health_check(self) -> None:
+        """Lanza un chequeo en segundo plano si toca; la consulta en curso usa el estado conocido."""
+        if not self.replicas or (self._health_task and not self._health_task.done()):
+            return
+        now = time.monotonic()
+        if any(now - node.last_check >= self.health_check_interval for node in self.replicas):
+            self._health_task = asyncio.create_task(self.check_health())
+
+    def _is_usable(self, node: _DBNode) -> bool:
+        if not node.healthy:
+            return False
+        return node.lag_seconds is None or node.lag_seconds <= self.max_lag_seconds
+
+    def _mark_unhealthy(self, node: _DBNode, error: Exception) -> None:
+        print(f"ERROR:app.db.replica_router:Marcando réplica {node.label} como caída: {error}")
+        node.healthy = False
+        node.last_error = str(error)
+        node.last_check = time.monotonic()
+
+    # --- Selección y ejecución ---
+
+    def pick_read_node(self, exclude: Tuple[_DBNode, ...] = ()) -> _DBNode:
+        self._schedule_health_check()
+        candidates = [n for n in self.replicas if n not in exclude and self._is_usable(n)]
+        if candidates:
+            return candidates[next(self._round_robin) % len(candidates)]
+        if self.replicas and not self.primary_fallback:
+            raise NoHealthyReplicaError("No hay réplicas de lectura disponibles y el failover al primario está deshabilitado.")
+        if self.replicas:
+            print("WARNING:app.db.replica_router:Sin réplicas utilizables, usando el primario para lecturas.")
+        return self.primary
+
+    async def run_read(self, fn: Callable[..., Awaitable[Any]], *args: Any) -> Any:
+        """
+        Ejecuta `fn(conn, *args)` en una conexión de lectura.
+        Si la réplica elegida falla a nivel de conexión (o su pool está agotado),
+        reintenta en otra réplica y, como último recurso, en el primario.
+        """
+        tried: Tuple[_DBNode, ...] = ()
+        while True:
+            node = self.pick_read_node(exclude=tried)
+            try:
+                async with node.engine.connect() as conn:
+                    return await fn(conn, *args)
+            except PoolTimeoutError as e:
+                if node.is_primary:
+                    raise
+                print(f"WARNING:app.db.replica_router:Pool agotado en {node.label}: {e}")
+            except DBAPIError as e:
+                # Solo los errores de conexión justifican un failover; los de SQL se propagan
+                if node.is_primary or not (e.connection_invalidated or _is_connection_error(e)):
+                    raise
+                self._mark_unhealthy(node, e)
+            tried += (node,)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "primary": self.primary.stats(),
+            "replicas": [node.stats() for node in self.replicas],
+            "max_lag_seconds": self.max_lag_seconds,
+        }
+
+    async def dispose(self) -> None:
+        if self._health_task is not None and not self._health_task.done():
+            self._health_task.cancel()
+        await asyncio.gather(self.primary.engine.dispose(), *(node.engine.dispose() for node in self.replicas))
+
+
+def _is_connection_error(error: DBAPIError) -> bool:
+    # pymysql/aiomysql: 2003 (no se puede conectar), 2006 (server gone away), 2013 (conexión perdida)
+    code = getattr(error.orig, "args", (None,))[0] if error.orig is not None else None
+    return code in (2003, 2006, 2013)
+
+
+def parse_url_list(raw: str) -> List[str]:
+    return [url.strip() for url in raw.split(",") if url.strip()]
+
+
+# Un router por combinación primario/réplicas, compartido por todas las instancias de la tool del proceso
+_routers: ProcessLocal[Dict[Tuple[str, Tuple[str, ...]], ReplicaRouter]] = ProcessLocal(dict)
+
+
+def get_replica_router(primary_url: str, replica_urls: Optional[List[str]] = None) -> ReplicaRouter:
+    if replica_urls is None:
+        replica_urls = parse_url_list(settings.EXTERNAL_DB_REPLICA_URLS)
+    routers = _routers.get()
+    key = (primary_url, tuple(replica_urls))
+    router = routers.get(key)
+    if router is None:
+        router = ReplicaRouter(primary_url, replica_urls)
+        routers[key] = router
+    return router
+
+
+async def dispose_replica_routers() -> None:
+    routers = list((_routers.peek() or {}).values())
+    _routers.clear()
+    await asyncio.gather(*(router.dispose() for router in routers))
@@ -0,0 +1,176 @@
+# app/db/write_behind.py
+import asyncio
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import Table, insert
+
+from app.core.config import settings
+from app.db.database import AsyncSessionLocalConversation
+
+_STOP = object()
+
+
+class WriteBehindWriter:
+    """
+    Escritor por lotes (write-behind) para la BD de conversaciones.
+
+    Las filas se encolan en memoria y un único task las vuelca cada pocos milisegundos
+    con un INSERT multi-fila por tabla, en una sola transacción para todas las sesiones.
+    Las filas de telemetría (`try_enqueue`) van en una transacción aparte y sin reintentos:
+    si fallan se descartan sin arrastrar a los mensajes del mismo lote.
+    - Backpressure: si la cola está llena, `enqueue` espera a que haya sitio.
+    - Cada fila de `enqueue` tiene un future que se resuelve al persistirse; `wait_flushed(key)`
+      permite esperar a las filas pendientes de una sesión (durabilidad "flush antes de responder").
+    - `stop()` vacía la cola antes de terminar.
+    """
+
+    def __init__(
+        self,
+        flush_interval_ms: float = settings.WRITE_BEHIND_FLUSH_INTERVAL_MS,
+        max_batch: int = settings.WRITE_BEHIND_MAX_BATCH,
+        queue_size: int = settings.WRITE_BEHIND_QUEUE_SIZE,
+        max_retries: int = 3,
+    ):
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_batch = max_batch
+        self.queue_size = queue_size
+        self.max_retries = max_retries
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._pending: Dict[str, Set[asyncio.Future]] = {}
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._task = asyncio.create_task(self._run())
+        print(f"INFO:app.db.write_behind:Writer iniciado (intervalo {self.flush_interval * 1000:.0f} ms, lote máx. {self.max_batch})")
+
+    async def stop(self) -> None:
+        """Vuelca todo lo pendiente y detiene el writer."""
+        if not self.running:
+            return
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+
+    async def enqueue(self, table: Table, row: Dict[str, Any], key: Optional[str] = None) -> asyncio.Future:
+        """Encola una fila para `table`. `key` (p.ej. session_id) agrupa filas para `wait_flushed`."""
+        future = asyncio.get_running_loop().create_future()
+        if key is not None:
+            self._pending.setdefault(key, set()).add(future)
+            future.add_done_callback(lambda f, k=key: self._forget(k, f))
+        await self._queue.put((table, row, future)) # Bloquea si la cola está llena (backpressure)
+        return future
+
+    def try_enqueue(self, table: Table, row: Dict[str, Any]) -> bool:
+        """
+        Encola una fila sin esperar ni seguimiento (registros de telemetría). Retorna False si el writer
+        no está en marcha o la cola está llena: la fila se descarta en vez de frenar al llamador.
+        """
+        if not self.running:
+            return False
+        try:
+            self._queue.put_nowait((table, row, None)) # Sin future: fila prescindible (ver _flush)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    def _forget(self, key: str, future: asyncio.Future) -> None:
+        pending = self._pending.get(key)
+        if pending is not None:
+            pending.discard(future)
+            if not pending:
+                del self._pending[key]
+
+    def has_pending(self, key: str) -> bool:
+        return key in self._pending
+
+    async def wait_flushed(self, key: str) -> None:
+        """Espera a que todas las filas encoladas con `key` estén persistidas (propaga el error si falló)."""
+        pending = self._pending.get(key)
+        if pending:
+            await asyncio.gather(*list(pending))
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout=remaining)
+                    except asyncio.TimeoutError:
+                        break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+        # Vaciar lo que quede tras la señal de parada
+        remaining_items = []
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not _STOP:
+                remaining_items.append(item)
+        for start in range(0, len(remaining_items), self.max_batch):
+            await self._flush(remaining_items[start:start + self.max_batch])
+
+    async def _insert(self, rows: List[Tuple[Table, Dict[str, Any]]], attempts: int) -> Optional[Exception]:
+        """INSERT multi-fila por tabla (en orden de llegada) en una sola transacción. Retorna el último error o None."""
+        rows_by_table: Dict[Table, List[Dict[str, Any]]] = {}
+        for table, row in rows:
+            rows_by_table.setdefault(table, []).append(row)
+
+        error: Optional[Exception] = None
+        for attempt in range(1, attempts + 1):
+            try:
+                async with AsyncSessionLocalConversation() as db:
+                    for table, table_rows in rows_by_table.items():
+                        await db.execute(insert(table).values(table_rows))
+                    await db.commit()
+                return None
+            except Exception as e:
+                error = e
+                print(f"ERROR:app.db.write_behind:Fallo al volcar {len(rows)} filas (intento {attempt}): {e}")
+                if attempt < attempts:
+                    await asyncio.sleep(0.05 * attempt)
+        return error
+
+    async def _flush(self, batch: List[Tuple[Table, Dict[str, Any], Optional[asyncio.Future]]]) -> None:
+        # Mensajes y sus blobs juntos en una transacción (el mensaje referencia al blob); la telemetría
+        # aparte, después y con un solo intento: una fila suya defectuosa no puede hacer perder mensajes
+        durable = [item for item in batch if item[2] is not None]
+        best_effort = [(table, row) for table, row, future in batch if future is None]
+
+        if durable:
+            error = await self._insert([(table, row) for table, row, _ in durable], self.max_retries)
+            for _, _, future in durable:
+                if future.done():
+                    continue
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+                    # Evita el aviso de "exception never retrieved" si nadie espera este future
+                    future.add_done_callback(lambda f: f.exception())
+
+        if best_effort and await self._insert(best_effort, 1) is not None:
+            print(f"WARNING:app.db.write_behind:{len(best_effort)} filas de telemetría descartadas")
+
+
+message_writer = WriteBehindWriter()
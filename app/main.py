@@ -1,5 +1,9 @@
 # app/main.py
+import asyncio
 import os
+import time
+_IMPORT_STARTED = time.perf_counter() # Start of the import-time budget (see app/core/startup.py)
+
 from dotenv import load_dotenv # Import load_dotenv
 
 # --- Load environment variables from .env file ---
@@ -9,17 +13,31 @@ load_dotenv()
 # --- End .env loading ---
 
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware # Import the CORS middleware
 
 from app.api.v1.endpoints import chat as chat_v1
+from app.api.v1.endpoints import metrics as metrics_v1
 from app.core.config import settings
-from app.db.database import create_db_and_tables # Function to create tables at startup (optional)
-# from app.services.llm_handler import init_llm_client # If the LLM client needs global initialization
+from app.core import jsonutil
+from app.db.database import dispose_engines
+from app.core.startup import startup_state, warm_up
+from app.core.shared_state import close_shared_state
+from app.db.replica_router import dispose_replica_routers
+from app.crud.crud_external_data import close_external_pool
+from app.tools.postgres_tool import close_postgres_pools
+from app.tools.tenant_tools import tenant_tool_cache
+from app.services.turn_worker import turn_worker_pool
+from app.db.write_behind import message_writer
+from app.services.retention import retention_job
+from app.services.session_cleanup import bulk_session_deleter
 
 app = FastAPI(
     title=settings.PROJECT_NAME,
     version="1.0.0",
-    openapi_url=f"{settings.API_V1_STR}/openapi.json" # Good practice to include openapi_url
+    openapi_url=f"{settings.API_V1_STR}/openapi.json", # Good practice to include openapi_url
+    # orjson renders responses several times faster than the stdlib encoder (falls back if not installed)
+    default_response_class=ORJSONResponse if jsonutil.orjson is not None else JSONResponse
 )
 
 # --- CORS Configuration ---
@@ -42,14 +60,54 @@ app.add_middleware(
 # --- End CORS Configuration ---
 
 
+_warm_up_task = None
+
+def _start_background_workers():
+    turn_worker_pool.start()
+    tenant_tool_cache.start() # Closes idle tenant DB pools
+    # Partition maintenance always runs; archive/purge only with RETENTION_ENABLED. A MySQL named lock keeps it to one worker
+    retention_job.start()
+
 @app.on_event("startup")
 async def on_startup():
-    # await init_llm_client() # Example: initialize Gemini client
-    await create_db_and_tables() # Create conversation DB tables if they don't exist
+    global _warm_up_task
+    if settings.MESSAGE_WRITE_MODE != "sync" or settings.QUERY_LOG_ENABLED:
+        message_writer.start() # Batched write-behind persistence of chat messages and the tool query log
+    # Schema check/creation, pool and LLM warm-up run concurrently in the background;
+    # /ready reports 503 until they finish. Turn workers and retention need the schema, so they start afterwards.
+    _warm_up_task = asyncio.create_task(warm_up(on_ready=_start_background_workers))
     print("FastAPI application startup complete.")
 
+@app.on_event("shutdown")
+async def on_shutdown():
+    if _warm_up_task is not None and not _warm_up_task.done():
+        _warm_up_task.cancel()
+    await retention_job.stop()
+    await bulk_session_deleter.stop() # Deleted chunks are already committed; the job reports "cancelled"
+    await turn_worker_pool.stop() # Let running turns finish; unfinished ones are recovered by their lease
+    await message_writer.stop() # Guaranteed flush of queued messages before closing pools
+    await tenant_tool_cache.stop() # Per-tenant external DB pools
+    await dispose_replica_routers() # Close external DB pools (primary and read replicas)
+    await close_external_pool() # Dedicated aiomysql pool, if it was ever created
+    await close_postgres_pools() # asyncpg pools of PostgresTool, if any
+    await dispose_engines() # This worker's conversation/external engines
+    await close_shared_state()
+
 app.include_router(chat_v1.router, prefix=settings.API_V1_STR, tags=["Chat V1"])
+app.include_router(metrics_v1.router, prefix=settings.API_V1_STR, tags=["Metrics"])
+
+startup_state.mark_imported(_IMPORT_STARTED)
 
 @app.get("/", tags=["Root"])
 async def read_root():
-    return {"message": f"Welcome to {settings.PROJECT_NAME}"}
\ No newline at end of file
+    return {"message": f"Welcome to {settings.PROJECT_NAME}"}
+
+@app.get("/health", tags=["Root"])
+async def liveness():
+    return {"status": "ok"}
+
+@app.get("/ready", tags=["Root"])
+async def readiness():
+    """Readiness: 200 only once warm-up has finished (schema checked, pools and LLM client ready)."""
+    snapshot = startup_state.snapshot()
+    return JSONResponse(status_code=200 if snapshot["ready"] else 503, content=snapshot)
\ No newline at end of file
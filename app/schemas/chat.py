@@ -1,8 +1,26 @@
 # app/schemas/chat.py
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
 from typing import Optional, List, Dict, Any
 from datetime import datetime
 
+from app.db.models_conversation import SESSION_METADATA_INDEXED_KEYS, SESSION_METADATA_MAX_LENGTH
+
+
+def check_indexed_metadata(metadata: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    Las claves indexadas de la metadata (tenant_id, channel) van a columnas generadas de longitud fija:
+    deben ser texto o número de como mucho SESSION_METADATA_MAX_LENGTH caracteres (o null). Lanza ValueError.
+    """
+    for key in SESSION_METADATA_INDEXED_KEYS:
+        value = (metadata or {}).get(key)
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, (str, int)):
+            raise ValueError(f"metadata.{key} debe ser texto.")
+        if len(str(value)) > SESSION_METADATA_MAX_LENGTH:
+            raise ValueError(f"metadata.{key} admite como mucho {SESSION_METADATA_MAX_LENGTH} caracteres.")
+    return metadata
+
 class ChatMessageBase(BaseModel):
     message: str
 
@@ -21,8 +39,83 @@ class SessionCreate(BaseModel):
     user_id: Optional[str] = None
     metadata: Optional[Dict[str, Any]] = None
 
+    @field_validator("metadata")
+    @classmethod
+    def check_metadata(cls, value: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        return check_indexed_metadata(value)
+
 class SessionResponse(BaseModel):
     session_id: str
     user_id: Optional[str]
     created_at: datetime
-    metadata: Optional[Dict[str, Any]]
\ No newline at end of file
+    metadata: Optional[Dict[str, Any]]
+
+class TurnAcceptedResponse(BaseModel):
+    turn_id: str
+    session_id: str
+    status: str = "queued"
+    status_url: str
+
+class TurnStatusResponse(BaseModel):
+    turn_id: str
+    session_id: str
+    status: str # queued | running | done | failed
+    created_at: Optional[datetime] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    result: Optional[ChatMessageResponse] = None
+    error: Optional[str] = None
+
+class BulkDeleteRequest(BaseModel):
+    session_ids: List[str] = Field(..., min_length=1)
+
+class BulkDeleteStatusResponse(BaseModel):
+    job_id: str
+    status: str # queued | running | done | failed | cancelled
+    filters: Dict[str, Any]
+    sessions_deleted: int = 0
+    messages_deleted: int = 0
+    created_at: datetime
+    updated_at: datetime
+    finished_at: Optional[datetime] = None
+    error: Optional[str] = None
+    status_url: Optional[str] = None
+
+class BatchQuestion(BaseModel):
+    message: str = Field(..., min_length=1)
+    session_id: Optional[str] = None # Sin sesión se crea una nueva; con la misma sesión, en orden y con su historial
+    id: Optional[str] = None # Identificador del cliente, se devuelve con el resultado
+
+class BatchRequest(BaseModel):
+    questions: List[BatchQuestion] = Field(..., min_length=1)
+    user_id: Optional[str] = None
+    metadata: Optional[Dict[str, Any]] = None # Metadata de las sesiones nuevas (p. ej. tenant_id)
+    concurrency: Optional[int] = Field(None, ge=1) # Acotada por BATCH_MAX_CONCURRENCY
+
+    @field_validator("metadata")
+    @classmethod
+    def check_metadata(cls, value: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        return check_indexed_metadata(value)
+
+class BatchItemResult(BaseModel):
+    index: int
+    id: Optional[str] = None
+    session_id: Optional[str] = None
+    turn_id: Optional[str] = None
+    status: str # queued | running | done | failed
+    result: Optional[ChatMessageResponse] = None
+    error: Optional[str] = None
+    elapsed_ms: Optional[float] = None
+
+class BatchAcceptedResponse(BaseModel):
+    batch_id: str
+    total: int
+    status: str = "queued"
+    status_url: str
+
+class BatchStatusResponse(BaseModel):
+    batch_id: str
+    status: str # queued | running | done
+    total: int
+    counts: Dict[str, int]
+    results: List[BatchItemResult]
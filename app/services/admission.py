@@ -0,0 +1,190 @@
+# app/services/admission.py
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict, List
+
+from app.core.config import settings
+from app.core.shared_state import get_shared_state
+
+
+class AdmissionRejected(Exception):
+    """El turno no fue admitido; el endpoint lo traduce a 429/503 con Retry-After."""
+
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Control de admisión de turnos de chat.
+
+    - Límite global de turnos concurrentes y límite por usuario.
+    - Cola de espera acotada (global y por usuario); si está llena se rechaza de inmediato.
+    - Cuando se libera un hueco se reparte en round-robin entre los usuarios que esperan,
+      para que un cliente con muchos mensajes encolados no acapare el servicio.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = settings.ADMISSION_MAX_CONCURRENT_TURNS,
+        max_per_user: int = settings.ADMISSION_MAX_TURNS_PER_USER,
+        max_queue: int = settings.ADMISSION_MAX_QUEUE,
+        max_queue_per_user: int = settings.ADMISSION_MAX_QUEUE_PER_USER,
+        queue_timeout: float = settings.ADMISSION_QUEUE_TIMEOUT,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self.queue_timeout = queue_timeout
+
+        self._active_total = 0
+        self._active_by_user: Dict[str, int] = {}
+        # Usuarios con turnos en espera, en orden de round-robin
+        self._waiters: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        self._queued_total = 0
+        self._avg_turn_seconds = 5.0  # Media móvil de la duración de un turno, para Retry-After
+
+    def _has_room(self, user_key: str) -> bool:
+        return (
+            self._active_total < self.max_concurrent
+            and self._active_by_user.get(user_key, 0) < self.max_per_user
+        )
+
+    def _grant(self, user_key: str) -> None:
+        self._active_total += 1
+        self._active_by_user[user_key] = self._active_by_user.get(user_key, 0) + 1
+
+    def _retry_after(self) -> int:
+        waves = (self._queued_total + 1) / max(self.max_concurrent, 1)
+        return max(1, math.ceil(self._avg_turn_seconds * waves))
+
+    def _dispatch(self) -> None:
+        """Entrega los huecos libres a los usuarios en espera, uno por usuario y vuelta."""
+        granted = True
+        while granted and self._active_total < self.max_concurrent and self._waiters:
+            granted = False
+            for user_key in list(self._waiters.keys()):
+                if self._active_total >= self.max_concurrent:
+                    break
+                if self._active_by_user.get(user_key, 0) >= self.max_per_user:
+                    continue
+                queue = self._waiters[user_key]
+                future = queue.popleft()
+                self._queued_total -= 1
+                if queue:
+                    self._waiters.move_to_end(user_key)
+                else:
+                    del self._waiters[user_key]
+                self._grant(user_key)
+                future.set_result(None)
+                granted = True
+
+    def _release(self, user_key: str, started_at: float) -> None:
+        self._active_total -= 1
+        remaining = self._active_by_user.get(user_key, 1) - 1
+        if remaining > 0:
+            self._active_by_user[user_key] = remaining
+        else:
+            self._active_by_user.pop(user_key, None)
+        self._avg_turn_seconds = 0.9 * self._avg_turn_seconds + 0.1 * (time.monotonic() - started_at)
+        self._dispatch()
+
+    def _remove_waiter(self, user_key: str, future: asyncio.Future) -> None:
+        queue = self._waiters.get(user_key)
+        if queue and future in queue:
+            queue.remove(future)
+            self._queued_total -= 1
+            if not queue:
+                del self._waiters[user_key]
+
+    async def _acquire(self, user_key: str) -> None:
+        if user_key not in self._waiters and self._has_room(user_key):
+            self._grant(user_key)
+            return
+
+        user_queue = self._waiters.get(user_key)
+        if user_queue is not None and len(user_queue) >= self.max_queue_per_user:
+            raise AdmissionRejected(429, "Demasiados mensajes en curso para este usuario.", self._retry_after())
+        if self._queued_total >= self.max_queue:
+            raise AdmissionRejected(503, "El servicio está saturado, intenta de nuevo en unos segundos.", self._retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(user_key, deque()).append(future)
+        self._queued_total += 1
+        try:
+            # asyncio.wait no cancela el future, así distinguimos "admitido justo a tiempo" de timeout
+            await asyncio.wait({future}, timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            if future.done():
+                self._release(user_key, time.monotonic())
+            else:
+                self._remove_waiter(user_key, future)
+            raise
+        if not future.done():
+            self._remove_waiter(user_key, future)
+            raise AdmissionRejected(503, "Tiempo de espera agotado en la cola de turnos.", self._retry_after())
+
+    @asynccontextmanager
+    async def admit(self, user_key: str) -> AsyncIterator[None]:
+        await self._acquire(user_key)
+        started_at = time.monotonic()
+        shared_state = get_shared_state()
+        shared_key = None
+        try:
+            if shared_state.distributed:
+                # Con varios workers, el límite por usuario también se comprueba en el almacén compartido.
+                # El TTL evita que un worker caído deje el contador inflado para siempre.
+                shared_key = f"admission:user:{user_key}"
+                active = await shared_state.incr(shared_key, 1, ttl=settings.ADMISSION_SHARED_COUNTER_TTL)
+                if active > self.max_per_user:
+                    raise AdmissionRejected(429, "Demasiados mensajes en curso para este usuario.", self._retry_after())
+            yield
+        finally:
+            if shared_key is not None:
+                await shared_state.incr(shared_key, -1, ttl=settings.ADMISSION_SHARED_COUNTER_TTL)
+            self._release(user_key, started_at)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "active": self._active_total,
+            "queued": self._queued_total,
+            "users_active": len(self._active_by_user),
+            "users_waiting": len(self._waiters),
+        }
+
+
+class SessionLocks:
+    """Un lock por sesión para que dos mensajes concurrentes no intercalen su historial."""
+
+    def __init__(self, timeout: float = settings.ADMISSION_QUEUE_TIMEOUT):
+        self.timeout = timeout
+        self._locks: Dict[str, List] = {}  # session_id -> [lock, referencias]
+
+    @asynccontextmanager
+    async def hold(self, session_id: str) -> AsyncIterator[None]:
+        entry = self._locks.setdefault(session_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            try:
+                await asyncio.wait_for(entry[0].acquire(), timeout=self.timeout)
+            except asyncio.TimeoutError:
+                raise AdmissionRejected(429, "Ya hay un mensaje en curso para esta sesión.", math.ceil(self.timeout))
+            try:
+                yield
+            finally:
+                entry[0].release()
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[session_id]
+
+
+admission_controller = AdmissionController()
+session_locks = SessionLocks()
@@ -0,0 +1,256 @@
+# app/services/batch_runner.py
+import asyncio
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from app.core import jsonutil
+from app.core.config import settings
+from app.core.process_local import ProcessLocal
+from app.core.shared_state import get_shared_state
+from app.crud import crud_conversation, crud_turn
+from app.db.database import AsyncSessionLocalConversation
+from app.schemas.chat import BatchItemResult, BatchQuestion, ChatMessageResponse
+from app.services.admission import session_locks
+from app.services.chat_orchestrator import ChatOrchestrator
+
+# Preguntas de una misma conversación: (posición en el lote, pregunta)
+_Items = List[Tuple[int, BatchQuestion]]
+
+
+class _SharedTools:
+    """Tool SQL y handler del LLM de la BD por defecto, compartidos por todas las conversaciones de un lote."""
+
+    def __init__(self):
+        self.sql_tool = None
+        self.llm_handler = None
+
+    def apply(self, orchestrator: ChatOrchestrator) -> None:
+        # Las sesiones de un tenant no los usan: su tool es otra y el orquestador crea su propio handler
+        if self.sql_tool is not None:
+            orchestrator.sql_tool = self.sql_tool
+            orchestrator.llm_handler = self.llm_handler
+
+    def remember(self, orchestrator: ChatOrchestrator) -> None:
+        if self.sql_tool is None and orchestrator.tenant_id is None and orchestrator.llm_handler is not None:
+            self.sql_tool = orchestrator.sql_tool
+            self.llm_handler = orchestrator.llm_handler
+
+
+class BatchRunner:
+    """
+    Ejecución de lotes de preguntas (POST /batch) con el ChatOrchestrator de siempre.
+
+    - Modo stream: el lote corre en este proceso y cada resultado se emite como una línea NDJSON en
+      cuanto termina. Las preguntas de una misma sesión van en orden sobre un orquestador con el
+      historial en memoria; sesiones distintas corren en paralelo (hasta `concurrency` por lote).
+    - Modo job: las preguntas se guardan como turnos en chat_turns con el batch_id y las ejecutan los
+      workers de turnos (sobrevive a reinicios). El estado se consulta con GET /batch/{batch_id}.
+
+    En ambos modos cada turno ocupa un hueco de `slot()`: como mucho `max_concurrency` turnos de lotes
+    por proceso (el resto de la capacidad queda para el tráfico interactivo) y, si se configura, no más
+    de `turns_per_minute` turnos de lotes por minuto entre todos los workers (cuota del LLM). En modo
+    job el hueco y la cuota se toman antes de reclamar el turno, en un carril de workers propio
+    (ver TurnWorkerPool), para que la espera nunca retenga a los workers de turnos interactivos.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = settings.BATCH_MAX_CONCURRENCY,
+        turns_per_minute: int = settings.BATCH_MAX_TURNS_PER_MINUTE,
+    ):
+        self.max_concurrency = max(1, max_concurrency)
+        self.turns_per_minute = turns_per_minute
+        self._slots: ProcessLocal[asyncio.Semaphore] = ProcessLocal(lambda: asyncio.Semaphore(self.max_concurrency))
+
+    # --- Límites ---
+
+    @asynccontextmanager
+    async def capacity(self) -> AsyncIterator[None]:
+        """Hueco de concurrencia de lotes de este proceso, sin consumir cuota por minuto."""
+        async with self._slots.get():
+            yield
+
+    async def reserve(self) -> Optional[str]:
+        """
+        Consume un turno de la cuota por minuto (esperando a la siguiente ventana si está agotada).
+        Retorna la clave de la ventana para poder devolverlo con release(), o None si no hay límite.
+        """
+        if self.turns_per_minute <= 0:
+            return None
+        while True:
+            key = f"batch:turns:{int(time.time() // 60)}"
+            started = await get_shared_state().incr(key, ttl=120)
+            if started <= self.turns_per_minute:
+                return key
+            await asyncio.sleep(60 - time.time() % 60) # Cuota del minuto agotada: esperar a la siguiente ventana
+
+    async def release(self, reservation: Optional[str]) -> None:
+        """Devuelve a la cuota un turno reservado que al final no se ejecutó."""
+        if reservation is not None:
+            await get_shared_state().incr(reservation, amount=-1, ttl=120)
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        async with self.capacity():
+            await self.reserve()
+            yield
+
+    # --- Modo stream ---
+
+    @staticmethod
+    def _conversations(questions: List[BatchQuestion]) -> List[Tuple[Optional[str], _Items]]:
+        """Agrupa por sesión (en orden); cada pregunta sin sesión es una conversación nueva."""
+        by_session: Dict[str, _Items] = {}
+        conversations: List[Tuple[Optional[str], _Items]] = []
+        for index, question in enumerate(questions):
+            if question.session_id is None:
+                conversations.append((None, [(index, question)]))
+            elif question.session_id in by_session:
+                by_session[question.session_id].append((index, question))
+            else:
+                by_session[question.session_id] = [(index, question)]
+                conversations.append((question.session_id, by_session[question.session_id]))
+        return conversations
+
+    async def stream(
+        self,
+        batch_id: str,
+        questions: List[BatchQuestion],
+        user_id: Optional[str] = None,
+        metadata: Optional[Dict[str, Any]] = None,
+        concurrency: Optional[int] = None,
+    ) -> AsyncIterator[str]:
+        """Ejecuta el lote y emite una línea NDJSON (BatchItemResult) por pregunta, en orden de finalización."""
+        results: "asyncio.Queue[BatchItemResult]" = asyncio.Queue()
+        limit = asyncio.Semaphore(min(concurrency or self.max_concurrency, self.max_concurrency))
+        shared = _SharedTools()
+
+        async def run(session_id: Optional[str], items: _Items) -> None:
+            async with limit:
+                await self._run_conversation(batch_id, session_id, items, user_id, metadata, shared, results)
+
+        tasks = [asyncio.create_task(run(session_id, items)) for session_id, items in self._conversations(questions)]
+        started = time.perf_counter()
+        try:
+            for _ in range(len(questions)):
+                yield jsonutil.dumps((await results.get()).model_dump(mode="json")) + "\n"
+            print(f"INFO:app.services.batch_runner:Lote {batch_id} completado: {len(questions)} preguntas "
+                  f"en {time.perf_counter() - started:.1f} s")
+        finally:
+            # Si el cliente se desconecta, las conversaciones pendientes se cancelan
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run_conversation(
+        self, batch_id: str, session_id: Optional[str], items: _Items, user_id: Optional[str],
+        metadata: Optional[Dict[str, Any]], shared: _SharedTools, results: "asyncio.Queue[BatchItemResult]",
+    ) -> None:
+        pending = list(items)
+        try:
+            async with AsyncSessionLocalConversation() as db:
+                if session_id is None:
+                    session_id = str(uuid.uuid4())
+                    await crud_conversation.create_chat_sessions(
+                        db, [session_id], user_id=user_id, metadata={**(metadata or {}), "batch_id": batch_id}
+                    )
+                elif await crud_conversation.get_chat_session(db, session_id) is None:
+                    raise LookupError("Sesión de chat no encontrada.")
+                orchestrator = ChatOrchestrator(db_session=db, session_id=session_id, user_id=user_id, keep_history=True)
+                shared.apply(orchestrator)
+                await db.rollback() # La conexión a la BD solo se usa durante los turnos
+
+                while pending:
+                    index, question = pending[0]
+                    started = time.perf_counter()
+                    try:
+                        async with self.slot(), session_locks.hold(session_id):
+                            response = await orchestrator.handle_user_message(question.message)
+                        item = _item(index, question, session_id, started, result=response)
+                    except Exception as e:
+                        print(f"ERROR:app.services.batch_runner:Pregunta {index} del lote {batch_id} falló: {e}")
+                        item = _item(index, question, session_id, started, error=str(e))
+                    await db.rollback()
+                    shared.remember(orchestrator)
+                    pending.pop(0)
+                    await results.put(item)
+        except Exception as e:
+            for index, question in pending:
+                await results.put(_item(index, question, session_id, time.perf_counter(), error=str(e)))
+
+    # --- Modo job ---
+
+    async def submit(
+        self,
+        batch_id: str,
+        questions: List[BatchQuestion],
+        user_id: Optional[str] = None,
+        metadata: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """Crea las sesiones que falten y encola una fila de chat_turns por pregunta para los workers."""
+        async with AsyncSessionLocalConversation() as db:
+            new_sessions = {
+                index: str(uuid.uuid4()) for index, question in enumerate(questions) if question.session_id is None
+            }
+            if new_sessions:
+                await crud_conversation.create_chat_sessions(
+                    db, list(new_sessions.values()), user_id=user_id, metadata={**(metadata or {}), "batch_id": batch_id}
+                )
+            await crud_turn.create_batch_turns(db, [
+                {
+                    "id": str(uuid.uuid4()),
+                    "session_id": question.session_id or new_sessions[index],
+                    "user_id": user_id,
+                    "message": question.message,
+                    "batch_id": batch_id,
+                    "batch_index": index,
+                }
+                for index, question in enumerate(questions)
+            ])
+
+    async def status(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        async with AsyncSessionLocalConversation() as db:
+            turns = await crud_turn.get_batch_turns(db, batch_id)
+        if not turns:
+            return None
+        counts = {"queued": 0, "running": 0, "done": 0, "failed": 0}
+        results = []
+        for turn in turns:
+            counts[turn.status] = counts.get(turn.status, 0) + 1
+            elapsed = (turn.finished_at - turn.started_at).total_seconds() * 1000 if turn.finished_at and turn.started_at else None
+            results.append(BatchItemResult(
+                index=turn.batch_index,
+                session_id=turn.session_id,
+                turn_id=turn.id,
+                status=turn.status,
+                result=ChatMessageResponse.model_validate_json(turn.response) if turn.response else None,
+                error=turn.error,
+                elapsed_ms=round(elapsed, 1) if elapsed is not None else None,
+            ))
+        if counts["done"] + counts["failed"] == len(turns):
+            status = "done"
+        elif counts["queued"] == len(turns):
+            status = "queued"
+        else:
+            status = "running"
+        return {"batch_id": batch_id, "status": status, "total": len(turns), "counts": counts, "results": results}
+
+
+def _item(
+    index: int, question: BatchQuestion, session_id: Optional[str], started: float,
+    result: Optional[ChatMessageResponse] = None, error: Optional[str] = None,
+) -> BatchItemResult:
+    return BatchItemResult(
+        index=index,
+        id=question.id,
+        session_id=session_id,
+        status="done" if error is None else "failed",
+        result=result,
+        error=error,
+        elapsed_ms=round((time.perf_counter() - started) * 1000, 1),
+    )
+
+
+batch_runner = BatchRunner()
@@ -1,44 +1,90 @@
 # app/services/chat_orchestrator.py
-import json
-from typing import List, Dict, Any, Optional
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, List, Dict, Any, Optional
 from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime # ¡Asegúrate de importar datetime!
 
 from app.crud import crud_conversation
+from app.db.blob_store import blob_ids_in_message, decode_blob, resolve_blob_refs, compact_function_responses
 from app.services.llm_handler import GeminiLLMHandler
+from app.services.model_router import model_router
 from app.schemas.chat import ChatMessageResponse
 
 # NUEVAS IMPORTACIONES
-from app.tools.mysql_tool import MySQLTool 
+from app.tools.base_tool import BaseTool
+from app.tools.tenant_tools import sql_tool_for, tenant_id_from_session_data
 from app.core.config import settings
+from app.core import jsonutil
+from app.core.tool_context import bind_tool_context
+
+# Progreso de un turno para canales en streaming (WebSocket): {"type": "chunk" | "tool_call" | "tool_result", ...}
+EventCallback = Callable[[Dict[str, Any]], Awaitable[None]]
 
 class ChatOrchestrator:
-    def __init__(self, db_session: AsyncSession, session_id: str, user_id: Optional[str] = None):
+    def __init__(
+        self, db_session: AsyncSession, session_id: str, user_id: Optional[str] = None, keep_history: bool = False
+    ):
         self.db_session = db_session
         self.session_id = session_id
         self.user_id = user_id
 
-        # --- CAMBIO AQUI: Instanciar la herramienta de MySQL ---
-        self.mysql_tool = MySQLTool(db_url=settings.EXTERNAL_DB_URL)
-        self.available_tools = [self.mysql_tool] # Ahora contiene nuestra herramienta de MySQL
+        # Con keep_history (un orquestador por conexión WebSocket) el historial formateado se carga de la BD
+        # en el primer turno y después se mantiene en memoria con lo que produce cada turno.
+        self.keep_history = keep_history
+        self._history: Optional[List[Dict[str, Any]]] = None
+        self.tenant_id: Optional[str] = None
+        self._tenant_resolved = False
+
+        # La tool SQL (y con ella el handler del LLM) depende del tenant de la sesión: se resuelven al
+        # empezar el turno (ver _session_sql_tool)
+        self.sql_tool: Optional[BaseTool] = None
+        self.available_tools: List[BaseTool] = []
+        self.llm_handler: Optional[GeminiLLMHandler] = None
+        self.max_tool_iterations = 5 # Permitir hasta 5 llamadas a herramientas en un turno
+
+    @asynccontextmanager
+    async def _session_sql_tool(self):
+        """
+        Tool SQL de la BD de la sesión (la del tenant indicado en su metadata, ver sql_tool_for).
+        Durante el turno, las consultas de la tool quedan registradas con la sesión y el tenant.
+        """
+        if not self._tenant_resolved:
+            session = await crud_conversation.get_chat_session(self.db_session, self.session_id)
+            self.tenant_id = tenant_id_from_session_data(session.session_data) if session is not None else None
+            self._tenant_resolved = True
+        with bind_tool_context(self.session_id, self.tenant_id):
+            if self.tenant_id is None and self.sql_tool is not None:
+                # Tool de EXTERNAL_DB_URL (pools compartidos del proceso): se reutiliza entre turnos
+                yield self.sql_tool
+                return
+            async with sql_tool_for(self.db_session, self.tenant_id) as tool:
+                yield tool
 
-        self.llm_handler = GeminiLLMHandler(
-            model_name="gemini-2.0-flash-lite",
+    def _create_llm_handler(self, sql_tool: BaseTool) -> GeminiLLMHandler:
+        self.sql_tool = sql_tool
+        self.available_tools = [sql_tool]
+        tool_name = sql_tool.name
+        # Motor, nombre de la BD y receta de esquema salen de la tool: la BD de un tenant puede ser PostgreSQL
+        engine, db_name = sql_tool.engine, sql_tool.database_name
+
+        return GeminiLLMHandler(
+            model_name=settings.GEMINI_LLM_MODEL,
             tools=self.available_tools,
+            router=model_router,
             system_instruction=(
-                "Eres un asistente virtual experto en la base de datos MySQL `nilo_db`. "
-                "Tu ÚNICA FUNCIÓN Y HABILIDAD PRINCIPAL es utilizar la herramienta `mysql_tool` "
-                "para ejecutar consultas SQL (SOLO SELECT) y obtener información DIRECTAMENTE de `nilo_db`. "
-                "Siempre que una pregunta requiera información de la base de datos, DEBES SÍ O SÍ usar la herramienta `mysql_tool`. "
+                f"Eres un asistente virtual experto en la base de datos {engine} `{db_name}`. "
+                f"Tu ÚNICA FUNCIÓN Y HABILIDAD PRINCIPAL es utilizar la herramienta `{tool_name}` "
+                f"para ejecutar consultas SQL (SOLO SELECT) y obtener información DIRECTAMENTE de `{db_name}`. "
+                f"Siempre que una pregunta requiera información de la base de datos, DEBES SÍ O SÍ usar la herramienta `{tool_name}`. "
                 "Esta herramienta es COMPLETAMENTE FUNCIONAL y tiene ACCESO REAL a la base de datos.\n\n"
 
                 "**Manejo del Esquema de la Base de Datos:**\n"
-                "No tienes precargado el esquema completo de todas las tablas de `nilo_db`. "
-                "Si necesitas conocer las columnas de una tabla específica para generar una consulta SQL, **debes usar la herramienta `mysql_tool` para ejecutar la consulta `DESCRIBE table_name;` o `SHOW COLUMNS FROM table_name;`**. "
+                f"No tienes precargado el esquema completo de todas las tablas de `{db_name}`. "
+                f"Si necesitas conocer las columnas de una tabla específica para generar una consulta SQL, **debes usar la herramienta `{tool_name}` para ejecutar la consulta {sql_tool.schema_lookup}**. "
                 "Una vez que obtengas la estructura de la tabla, utiliza esa información para construir la consulta SELECT que responde a la pregunta del usuario.\n\n"
 
-                "**Tablas Disponibles en `nilo_db`:**\n"
-                "Las siguientes son las **tablas reales** disponibles en la base de datos `nilo_db`. Considera **todas** estas tablas al momento de formular tus consultas, y consulta su estructura si no la conoces:\n"
+                f"**Tablas Disponibles en `{db_name}`:**\n"
+                f"Las siguientes son las **tablas reales** disponibles en la base de datos `{db_name}`. Considera **todas** estas tablas al momento de formular tus consultas, y consulta su estructura si no la conoces:\n"
                 " - `accounting_account_balances`\n"
                 " - `accounting_accounts`\n"
                 " - `accounting_configurations`\n"
@@ -161,7 +207,6 @@ class ChatOrchestrator:
                 "Si una pregunta no se relaciona con estas tablas o no requiere datos de la DB, responde sin usar la herramienta. PERO PRIORIZA el uso de la herramienta si la pregunta puede ser respondida por la DB."
             )
         )
-        self.max_tool_iterations = 5 # Permitir hasta 5 llamadas a herramientas en un turno
 
     async def _load_conversation_history(self) -> List[Dict[str, Any]]:
         """
@@ -172,12 +217,31 @@ class ChatOrchestrator:
             self.db_session, session_id=self.session_id, limit=20, ascending_order=True
         )
         
+        # Compactación: las respuestas de tools anteriores al último mensaje del usuario (turnos ya
+        # resumidos por el asistente) se envían como digest; solo las del turno en curso van completas.
+        current_turn_start = 0
+        if settings.HISTORY_COMPACT_TOOL_RESULTS:
+            for index, msg in enumerate(raw_history):
+                if msg.sender == "user":
+                    current_turn_start = index
+        summaries = self._assistant_summaries(raw_history)
+
+        # Los payloads grandes de tools (chat_message_blobs) se traen en una sola consulta y solo
+        # para los mensajes que se envían completos
+        blob_ids = [
+            blob_id for msg in raw_history[current_turn_start:] for blob_id in blob_ids_in_message(msg.message)
+        ]
+        blob_payloads = {
+            blob.id: decode_blob(blob)
+            for blob in await crud_conversation.get_message_blobs(self.db_session, blob_ids)
+        }
+
         formatted_history = []
         
         # El historial de Gemini DEBE empezar con "user" y alternar "model", "tool", "model", "user", etc.
         # Si la DB guarda sender="tool", esto es más fácil. Si no, inferimos el rol "tool" del contenido.
 
-        for msg in raw_history:
+        for index, msg in enumerate(raw_history):
             parts_for_llm = []
             
             # Determinar el rol para la API de Gemini
@@ -187,7 +251,11 @@ class ChatOrchestrator:
 
             # Intentar parsear el contenido si es JSON (tool_calls/responses)
             try:
-                parsed_content = json.loads(msg.message)
+                parsed_content = jsonutil.loads(msg.message)
+                if index < current_turn_start:
+                    compact_function_responses(parsed_content, summaries[index])
+                elif blob_payloads:
+                    resolve_blob_refs(parsed_content, blob_payloads)
                 
                 if isinstance(parsed_content, list): # Contenido de múltiples partes (ej. texto + función, o múltiples respuestas de función)
                     for part in parsed_content:
@@ -206,9 +274,9 @@ class ChatOrchestrator:
                     parts_for_llm.append({"function_response": parsed_content["function_response"]})
                     gemini_role = "tool"
                 else: # Contenido JSON genérico no estructurado como tool part
-                    parts_for_llm.append({"text": json.dumps(parsed_content)})
+                    parts_for_llm.append({"text": jsonutil.dumps(parsed_content)})
             
-            except (json.JSONDecodeError, TypeError): # Contenido es texto plano o JSON inválido
+            except (jsonutil.JSONDecodeError, TypeError): # Contenido es texto plano o JSON inválido
                 parts_for_llm = [{"text": msg.message}]
             
             # Asegurar que haya partes si el parseo no generó nada útil pero el mensaje existía
@@ -225,7 +293,9 @@ class ChatOrchestrator:
                 # O si el último fue 'tool' y este también es 'tool' (si hubieran varias respuestas de tools en el mismo turno)
                 if last_entry_role == gemini_role:
                     # Si ambos son 'model' y ambos son texto, podemos fusionarlos.
-                    if gemini_role == "model" and parts_for_llm[0].get("text") is not None and formatted_history[-1]["parts"][0].get("text") is not None:
+                    # Dos 'user' seguidos: el primero es de un turno que falló sin respuesta (el error del LLM
+                    # no se guarda); se fusionan para no perder la pregunta ni romper la alternancia.
+                    if gemini_role in ("model", "user") and parts_for_llm[0].get("text") is not None and formatted_history[-1]["parts"][0].get("text") is not None:
                         formatted_history[-1]["parts"][0]["text"] += "\n" + parts_for_llm[0]["text"]
                         continue # No añadir un nuevo elemento, solo fusionar
                     else:
@@ -249,26 +319,83 @@ class ChatOrchestrator:
             print(f"ADVERTENCIA: Primer mensaje del historial cargado es de rol '{formatted_history[0]['role']}'. Ignorando.")
             formatted_history.pop(0)
 
-        print(f"\n[Orchestrator] Historial cargado y FORMATEADO para LLM (con tools): {json.dumps(formatted_history, indent=2)}")
+        if settings.LLM_DEBUG_LOGGING:
+            print(f"\n[Orchestrator] Historial cargado y FORMATEADO para LLM (con tools): {jsonutil.dumps(formatted_history)}")
         return formatted_history
 
-    async def handle_user_message(self, user_message_text: str) -> ChatMessageResponse:
+    @staticmethod
+    def _assistant_summaries(raw_history) -> List[Optional[str]]:
+        """Para cada mensaje, el siguiente texto del asistente (el resumen que dio de los resultados de tools)."""
+        summaries: List[Optional[str]] = [None] * len(raw_history)
+        next_text = None
+        for index in range(len(raw_history) - 1, -1, -1):
+            msg = raw_history[index]
+            if msg.sender == "user":
+                next_text = None # El resumen de un turno no se atribuye a tools de turnos anteriores
+            elif msg.sender == "assistant" and not msg.message.lstrip().startswith(("[", "{")):
+                next_text = msg.message
+            summaries[index] = next_text
+        return summaries
+
+    async def handle_user_message(
+        self, user_message_text: str, on_event: Optional[EventCallback] = None
+    ) -> ChatMessageResponse:
+        """
+        Procesa un turno. Con `on_event` la respuesta del LLM se genera en streaming y se notifican
+        los fragmentos de texto y las llamadas/resultados de tools según ocurren.
+        """
+        async with self._session_sql_tool() as sql_tool:
+            if self.llm_handler is None or sql_tool is not self.sql_tool:
+                self.llm_handler = self._create_llm_handler(sql_tool)
+            try:
+                return await self._handle_turn(user_message_text, on_event)
+            except BaseException:
+                self._history = None # Turno a medias: el historial en memoria ya no es fiable, se relee de la BD
+                raise
+
+    def _remember_turn(
+        self, previous: List[Dict[str, Any]], user_message_text: str,
+        turn_entries: List[Dict[str, Any]], assistant_response_text: Optional[str]
+    ) -> None:
+        """Añade el turno terminado al historial en memoria, con la misma forma que daría _load_conversation_history."""
+        if settings.HISTORY_COMPACT_TOOL_RESULTS:
+            # Las respuestas de tools de turnos ya resumidos viajan como digest (igual que al leerlas de la BD)
+            for entry in turn_entries:
+                if entry["role"] == "tool":
+                    compact_function_responses(entry["parts"], assistant_response_text)
+        history = previous + [{"role": "user", "parts": [{"text": user_message_text}]}] + turn_entries
+        if assistant_response_text:
+            history.append({"role": "model", "parts": [{"text": assistant_response_text}]})
+        history = history[-settings.WS_HISTORY_MAX_ENTRIES:]
+        while history and history[0]["role"] != "user":
+            history.pop(0)
+        self._history = history
+
+    async def _handle_turn(self, user_message_text: str, on_event: Optional[EventCallback] = None) -> ChatMessageResponse:
         # 1. Guardar el mensaje del usuario en la base de datos inmediatamente
         await crud_conversation.create_chat_message(
             db=self.db_session, session_id=self.session_id, sender="user", message=user_message_text
         )
 
-        # 2. Obtener el historial de conversación (incluyendo el mensaje actual del usuario)
-        # _load_conversation_history ahora ya no quita el último mensaje, lo formatea directamente.
-        full_conversation_history = await self._load_conversation_history()
-        
-        # El historial para el LLM son todos los mensajes MENOS el último (que es el mensaje actual del usuario)
-        # Esto es crucial para que el user_prompt se envíe por separado en generate_content_async
-        history_for_llm = full_conversation_history[:-1] if full_conversation_history else []
-        
         # El prompt actual es el mensaje del usuario original
         current_prompt = user_message_text
 
+        # 2. Obtener el historial de conversación (incluyendo el mensaje actual del usuario)
+        if self._history is not None:
+            # Conexión WebSocket: el historial de los turnos anteriores ya está en memoria
+            history_for_llm = list(self._history)
+        else:
+            # _load_conversation_history ahora ya no quita el último mensaje, lo formatea directamente.
+            full_conversation_history = await self._load_conversation_history()
+
+            # El historial para el LLM son todos los mensajes MENOS el último (que es el mensaje actual del usuario)
+            # Esto es crucial para que el user_prompt se envíe por separado en generate_content_async
+            history_for_llm = full_conversation_history[:-1] if full_conversation_history else []
+            if full_conversation_history and full_conversation_history[-1]["role"] == "user":
+                # Incluye delante las preguntas sin respuesta de turnos fallidos, si se fusionaron con esta
+                current_prompt = full_conversation_history[-1]["parts"][0].get("text") or user_message_text
+        previous_history = list(history_for_llm)
+
         assistant_response_text = None
         final_tool_used_name = None # Puede ser útil si solo una herramienta se usa y queremos mostrarla
         final_tool_input_args = None # Ídem
@@ -276,10 +403,17 @@ class ChatOrchestrator:
         # 3. Entrar en el bucle de ejecución de herramientas
         for i in range(self.max_tool_iterations):
             print(f"[Orchestrator] Iteración de LLM (nº {i+1}). Historial len: {len(history_for_llm)}")
-            llm_output = await self.llm_handler.generate_response(
-                chat_history=history_for_llm,
-                user_prompt=current_prompt # El prompt del usuario es el mismo para cada iteración de tool
-            )
+            if on_event is None:
+                llm_output = await self.llm_handler.generate_response(
+                    chat_history=history_for_llm,
+                    user_prompt=current_prompt # El prompt del usuario es el mismo para cada iteración de tool
+                )
+            else:
+                llm_output = await self.llm_handler.stream_response(
+                    chat_history=history_for_llm,
+                    user_prompt=current_prompt,
+                    on_text=lambda text: on_event({"type": "chunk", "text": text})
+                )
 
             response_text_from_llm = llm_output.get("text")
             tool_calls_requested = llm_output.get("tool_calls", [])
@@ -301,7 +435,7 @@ class ChatOrchestrator:
                 # Guardar la llamada a la herramienta del asistente
                 await crud_conversation.create_chat_message(
                     db=self.db_session, session_id=self.session_id, sender="assistant", # Guardar como 'assistant'
-                    message=json.dumps(tool_call_parts_for_db) # Guardar como JSON serializado
+                    message=tool_call_parts_for_db # Se serializa una sola vez al guardar
                 )
                 
                 # Añadir la llamada a la herramienta al historial para la siguiente iteración del LLM
@@ -313,18 +447,29 @@ class ChatOrchestrator:
                 for tool_call in tool_calls_requested:
                     tool_name = tool_call["name"]
                     tool_args = tool_call["args"]
+                    if on_event is not None:
+                        await on_event({"type": "tool_call", "name": tool_name, "args": tool_args})
                     
+                    # Resultado estructurado: el mismo objeto va al historial del LLM y a la BD, sin ida y vuelta por JSON
                     tool_response_content = await self.llm_handler.execute_tool(tool_name, tool_args)
-                    print(f"[Orchestrator] Respuesta de la herramienta '{tool_name}': {tool_response_content}")
+                    if on_event is not None:
+                        await on_event({
+                            "type": "tool_result",
+                            "name": tool_name,
+                            "success": tool_response_content.get("success", "error" not in tool_response_content),
+                            "row_count": tool_response_content.get("row_count"),
+                        })
+                    if settings.LLM_DEBUG_LOGGING:
+                        print(f"[Orchestrator] Respuesta de la herramienta '{tool_name}': {tool_response_content}")
 
-                    response_part = {"function_response": {"name": tool_name, "response": {"content": json.loads(tool_response_content)}}}
+                    response_part = {"function_response": {"name": tool_name, "response": {"content": tool_response_content}}}
                     tool_responses_for_db.append(response_part)
                     tool_responses_for_llm_history.append(response_part)
                 
                 # --- CAMBIO AQUI: Ahora podemos usar sender="tool" ---
                 await crud_conversation.create_chat_message(
                     db=self.db_session, session_id=self.session_id, sender="tool", # ¡Guardar como "tool"!
-                    message=json.dumps(tool_responses_for_db)
+                    message=tool_responses_for_db
                 )
                 # -----------------------------------------------------
                 
@@ -360,6 +505,14 @@ class ChatOrchestrator:
                 db=self.db_session, session_id=self.session_id, sender="assistant", message=assistant_response_text
             )
 
+        # En write-behind con durabilidad "flush antes de responder", esperar a que el turno esté en la BD
+        await crud_conversation.flush_session_messages(self.session_id)
+
+        if self.keep_history:
+            self._remember_turn(
+                previous_history, user_message_text, history_for_llm[len(previous_history):], assistant_response_text
+            )
+
         # 5. Devolver la respuesta formateada al frontend
         return ChatMessageResponse(
             session_id=self.session_id,
@@ -0,0 +1,195 @@
+# app/services/chat_socket.py
+import asyncio
+import time
+from typing import Any, Dict, Optional
+
+from fastapi import WebSocket, WebSocketDisconnect
+from fastapi.websockets import WebSocketState
+
+from app.core import jsonutil
+from app.core.config import settings
+from app.crud import crud_conversation
+from app.db.database import AsyncSessionLocalConversation
+from app.services.admission import admission_controller, session_locks, AdmissionRejected
+from app.services.chat_orchestrator import ChatOrchestrator
+from app.services.llm_rate_limiter import LLMUnavailableError
+from app.tools.tenant_tools import TenantNotFoundError
+
+# Protocolo (mensajes JSON de texto):
+#   cliente -> servidor: {"type": "message", "message": "...", "id": "<opcional>"} | {"type": "pong"}
+#   servidor -> cliente: ready, accepted, tool_call, tool_result, chunk, done, error, ping
+# Cada "done"/"error" de un turno lleva el `id` que envió el cliente con su mensaje.
+
+# Códigos de cierre propios (rango 4000-4999 reservado a aplicaciones)
+CLOSE_SESSION_NOT_FOUND = 4404
+CLOSE_IDLE = 4408
+CLOSE_SLOW_CONSUMER = 4429
+
+
+class ChatSocketConnection:
+    """
+    Una conexión WebSocket de chat sobre una sesión: valida la sesión una vez y mantiene el orquestador
+    (tool SQL, handler del LLM e historial formateado) en memoria mientras dure la conexión.
+
+    - Los turnos se procesan de uno en uno, en orden; mientras uno está en curso se aceptan hasta
+      `max_pending` mensajes más y el resto se rechaza con un error `busy`.
+    - Cada turno pasa por el control de admisión y el lock de sesión, igual que por HTTP, y se
+      persiste con la capa CRUD de siempre.
+    - Los envíos esperan a que el cliente lea (backpressure sobre el streaming del LLM); si no lee en
+      `send_timeout` segundos se cierra la conexión. Un ping cada `ping_interval` mantiene vivos los
+      proxies y se cierra la conexión tras `idle_timeout` sin mensajes ni pongs.
+    - Con la conexión abierta, el historial en memoria asume que los mensajes de la sesión solo
+      llegan por ella; si falla un turno se vuelve a leer de la BD.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        session_id: str,
+        user_id: Optional[str] = None,
+        ping_interval: float = settings.WS_PING_INTERVAL_SECONDS,
+        idle_timeout: float = settings.WS_IDLE_TIMEOUT_SECONDS,
+        max_pending: int = settings.WS_MAX_PENDING_MESSAGES,
+        send_timeout: float = settings.WS_SEND_TIMEOUT_SECONDS,
+    ):
+        self.websocket = websocket
+        self.session_id = session_id
+        self.user_id = user_id
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.max_pending = max_pending
+        self.send_timeout = send_timeout
+        self.orchestrator: Optional[ChatOrchestrator] = None
+        # Sin tope propio: el límite de pendientes se aplica al recibir, así la señal de fin siempre cabe
+        self._inbox: "asyncio.Queue[Optional[Dict[str, Any]]]" = asyncio.Queue()
+        self._send_lock = asyncio.Lock()
+        self._open = True
+        self._busy = False
+        self._last_seen = time.monotonic()
+
+    async def serve(self) -> None:
+        await self.websocket.accept()
+        async with AsyncSessionLocalConversation() as db:
+            session = await crud_conversation.get_chat_session(db, self.session_id)
+            if session is None:
+                await self.websocket.close(code=CLOSE_SESSION_NOT_FOUND, reason="Sesión de chat no encontrada.")
+                return
+            self.user_id = self.user_id or session.user_id
+            self.orchestrator = ChatOrchestrator(
+                db_session=db, session_id=self.session_id, user_id=self.user_id, keep_history=True
+            )
+            await db.rollback() # La conexión a la BD solo se usa durante los turnos
+            await self._send({"type": "ready", "session_id": self.session_id})
+
+            receiver = asyncio.create_task(self._receive_loop())
+            pinger = asyncio.create_task(self._ping_loop())
+            try:
+                await self._turn_loop()
+            finally:
+                for task in (receiver, pinger):
+                    task.cancel()
+                await asyncio.gather(receiver, pinger, return_exceptions=True)
+                await self._close(1000)
+
+    # --- Recepción ---
+
+    async def _receive_loop(self) -> None:
+        try:
+            while True:
+                data = await self.websocket.receive_text()
+                self._last_seen = time.monotonic()
+                try:
+                    frame = jsonutil.loads(data)
+                except jsonutil.JSONDecodeError:
+                    await self._send({"type": "error", "detail": "Mensaje no es JSON válido."})
+                    continue
+                if not isinstance(frame, dict) or frame.get("type") == "pong":
+                    continue
+                if frame.get("type") != "message" or not isinstance(frame.get("message"), str) or not frame["message"].strip():
+                    await self._send({"type": "error", "id": frame.get("id"), "detail": "Se esperaba {\"type\": \"message\", \"message\": \"...\"}."})
+                    continue
+                pending = self._inbox.qsize()
+                if pending >= self.max_pending:
+                    await self._send({"type": "error", "id": frame.get("id"), "code": "busy",
+                                      "detail": "Demasiados mensajes pendientes en esta conexión."})
+                    continue
+                await self._inbox.put(frame)
+                await self._send({"type": "accepted", "id": frame.get("id"), "pending": pending})
+        except (WebSocketDisconnect, RuntimeError):
+            pass # Cliente desconectado (RuntimeError: el socket ya estaba cerrado por el servidor)
+        finally:
+            self._open = False
+            self._inbox.put_nowait(None) # El turno en curso termina y se persiste; los pendientes se descartan
+
+    async def _ping_loop(self) -> None:
+        while self._open:
+            await asyncio.sleep(self.ping_interval)
+            if not self._busy and time.monotonic() - self._last_seen > self.idle_timeout:
+                await self._close(CLOSE_IDLE, "Conexión inactiva.")
+                return
+            await self._send({"type": "ping", "ts": time.time()})
+
+    # --- Turnos ---
+
+    async def _turn_loop(self) -> None:
+        while True:
+            frame = await self._inbox.get()
+            if frame is None or not self._open:
+                return
+            self._busy = True
+            try:
+                await self._run_turn(frame)
+            finally:
+                self._busy = False
+
+    async def _run_turn(self, frame: Dict[str, Any]) -> None:
+        message_id = frame.get("id")
+        # Sin user_id, los límites por usuario se aplican por IP del cliente
+        client = self.websocket.client
+        user_key = self.user_id or f"ip:{client.host if client else 'unknown'}"
+        try:
+            async with admission_controller.admit(user_key), session_locks.hold(self.session_id):
+                response = await self.orchestrator.handle_user_message(frame["message"], on_event=self._send)
+        except AdmissionRejected as e:
+            await self._send({"type": "error", "id": message_id, "code": "rejected", "status": e.status_code,
+                              "detail": e.detail, "retry_after": e.retry_after})
+            return
+        except TenantNotFoundError as e:
+            await self._send({"type": "error", "id": message_id, "code": "tenant_not_found", "detail": str(e)})
+            return
+        except LLMUnavailableError as e:
+            await self._send({"type": "error", "id": message_id, "code": "llm_unavailable", "detail": e.detail,
+                              "retry_after": e.retry_after_seconds})
+            return
+        except Exception as e:
+            print(f"ERROR:app.services.chat_socket:Error en el turno de la sesión {self.session_id}: {e}")
+            await self._send({"type": "error", "id": message_id, "code": "internal",
+                              "detail": "Ocurrió un error interno en el servidor."})
+            return
+        finally:
+            await self.orchestrator.db_session.rollback() # Devuelve la conexión al pool entre turnos
+        await self._send({"type": "done", "id": message_id, "response": response.model_dump(mode="json")})
+
+    # --- Envío ---
+
+    async def _send(self, event: Dict[str, Any]) -> None:
+        """Envía un evento; si el cliente ya no está se descarta (el turno sigue y se persiste igual)."""
+        if not self._open:
+            return
+        try:
+            async with self._send_lock:
+                await asyncio.wait_for(self.websocket.send_text(jsonutil.dumps(event)), self.send_timeout)
+        except asyncio.TimeoutError:
+            print(f"WARNING:app.services.chat_socket:El cliente de la sesión {self.session_id} no lee; se cierra la conexión")
+            await self._close(CLOSE_SLOW_CONSUMER, "El cliente no consume los mensajes.")
+        except Exception:
+            self._open = False
+
+    async def _close(self, code: int, reason: str = "") -> None:
+        self._open = False
+        if WebSocketState.DISCONNECTED in (self.websocket.client_state, self.websocket.application_state):
+            return
+        try:
+            await asyncio.wait_for(self.websocket.close(code=code, reason=reason), self.send_timeout)
+        except Exception:
+            pass # Ya cerrado por el cliente o el transporte no responde
@@ -0,0 +1,73 @@
+# app/services/conversation_export.py
+import zlib
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, Optional
+
+from app.core import jsonutil
+from app.core.config import settings
+from app.crud import crud_conversation
+from app.db.blob_store import blob_ids_in_message, decode_blob
+from app.db.database import AsyncSessionLocalConversation
+
+
+def _row_to_line(row, blob_payloads: Dict[str, Any]) -> bytes:
+    record = {
+        "id": row.id,
+        "session_id": row.session_id,
+        "user_id": row.user_id,
+        "sender": row.sender,
+        "message": row.message,
+        "timestamp": row.timestamp.isoformat() if row.timestamp else None,
+    }
+    referenced = [blob_id for blob_id in blob_ids_in_message(row.message) if blob_id in blob_payloads]
+    if referenced:
+        record["blobs"] = {blob_id: blob_payloads[blob_id] for blob_id in referenced}
+    return jsonutil.dumps_bytes(record) + b"\n"
+
+
+async def _ndjson_chunks(session_id: Optional[str], user_id: Optional[str], since: Optional[datetime]) -> AsyncIterator[bytes]:
+    # El generador abre su propia sesión: la de la dependencia del endpoint se cierra antes de enviar el cuerpo
+    # La conexión del cursor del servidor no admite otras consultas mientras se lee: los blobs
+    # referenciados se traen por otra sesión, un fetch por partición (memoria acotada)
+    async with AsyncSessionLocalConversation() as db, AsyncSessionLocalConversation() as blob_db:
+        if session_id is not None:
+            result = await crud_conversation.stream_session_messages(db, session_id)
+        else:
+            result = await crud_conversation.stream_messages_for_export(db, user_id=user_id, since=since)
+
+        buffer = bytearray()
+        async for partition in result.partitions():
+            blob_ids = [blob_id for row in partition for blob_id in blob_ids_in_message(row.message)]
+            blob_payloads = {
+                blob.id: decode_blob(blob) for blob in await crud_conversation.get_message_blobs(blob_db, blob_ids)
+            }
+            for row in partition:
+                buffer += _row_to_line(row, blob_payloads)
+            if len(buffer) >= settings.EXPORT_CHUNK_BYTES:
+                yield bytes(buffer)
+                buffer.clear()
+        if buffer:
+            yield bytes(buffer)
+
+
+async def export_ndjson(
+    session_id: Optional[str] = None,
+    user_id: Optional[str] = None,
+    since: Optional[datetime] = None,
+    compress: bool = False,
+) -> AsyncIterator[bytes]:
+    """
+    Exporta mensajes como NDJSON (una línea JSON por mensaje) en trozos de ~EXPORT_CHUNK_BYTES.
+    Con `compress` el flujo sale en formato gzip, comprimido trozo a trozo.
+    """
+    if not compress:
+        async for chunk in _ndjson_chunks(session_id, user_id, since):
+            yield chunk
+        return
+
+    compressor = zlib.compressobj(wbits=31) # wbits=31: cabecera y checksum gzip
+    async for chunk in _ndjson_chunks(session_id, user_id, since):
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
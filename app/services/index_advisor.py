@@ -0,0 +1,164 @@
+# app/services/index_advisor.py
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlglot import exp
+
+from app.core.config import settings
+from app.crud import crud_query_log
+from app.tools.sql_rewriter import AnalyzedQuery, UnsafeQueryError, analyze_sql
+from app.tools.tenant_tools import sql_tool_for
+
+# Asesor de índices a partir del registro de consultas (tool_query_log):
+#   - toma las huellas con más tiempo acumulado y, de cada una, su última ejecución real;
+#   - extrae del AST las columnas de igualdad, rango, GROUP BY y ORDER BY de cada tabla;
+#   - pide el plan (EXPLAIN) a la BD de la consulta y, para cada tabla recorrida entera sobre muchas
+#     filas, propone un índice compuesto: columnas de igualdad primero y después la primera de rango.
+# Son sugerencias para revisar a mano: no se crea nada en la BD externa.
+
+_EQUALITY = (exp.EQ, exp.In, exp.Is)
+_RANGE = (exp.GT, exp.GTE, exp.LT, exp.LTE, exp.Between, exp.Like)
+_KINDS = ("equality", "range", "group", "order")
+_DIALECTS = {"mysql_tool": "mysql", "postgres_query_tool": "postgres"}
+
+# tabla -> {"equality" | "range" | "group" | "order" -> columnas en orden de aparición}
+TableColumns = Dict[str, Dict[str, List[str]]]
+
+
+def _aliases(expression: exp.Expression) -> Dict[str, str]:
+    return {table.alias_or_name.lower(): table.name.lower() for table in expression.find_all(exp.Table)}
+
+
+def predicate_columns(analyzed: AnalyzedQuery) -> TableColumns:
+    """Columnas filtradas, agrupadas y ordenadas de cada tabla base de la consulta."""
+    aliases = _aliases(analyzed.expression)
+    base_tables = set(analyzed.tables)
+    columns: TableColumns = {}
+
+    def collect(kind: str, column: exp.Expression) -> None:
+        if not isinstance(column, exp.Column):
+            return
+        if column.table:
+            table = aliases.get(column.table.lower())
+        else:
+            # Sin calificar solo se atribuye si la consulta usa una única tabla
+            table = next(iter(base_tables)) if len(base_tables) == 1 else None
+        if table not in base_tables:
+            return
+        names = columns.setdefault(table, {kind: [] for kind in _KINDS})[kind]
+        if column.name.lower() not in names:
+            names.append(column.name.lower())
+
+    for select in analyzed.expression.find_all(exp.Select):
+        conditions = [select.args.get("where")] + [join.args.get("on") for join in select.args.get("joins") or []]
+        for condition in filter(None, conditions):
+            for node in condition.find_all(*_EQUALITY, *_RANGE):
+                kind = "equality" if isinstance(node, _EQUALITY) else "range"
+                # Ambos lados: en un JOIN (a.x = b.y) las dos columnas son de igualdad
+                collect(kind, node.this)
+                collect(kind, node.args.get("expression"))
+        if select.args.get("group"):
+            for column in select.args["group"].expressions:
+                collect("group", column)
+        if select.args.get("order"):
+            for ordered in select.args["order"].expressions:
+                collect("order", ordered.this)
+    return columns
+
+
+def index_columns(columns: Dict[str, List[str]]) -> List[str]:
+    """Columnas del índice propuesto: igualdad (hasta 3) + la primera de rango; si no hay, GROUP/ORDER BY."""
+    chosen = list(columns["equality"][:3])
+    for column in columns["range"][:1]:
+        if column not in chosen:
+            chosen.append(column)
+    if not chosen:
+        chosen = list(columns["group"][:3]) or list(columns["order"][:2])
+    return chosen
+
+
+def _mysql_scans(rows: List[Dict[str, Any]], aliases: Dict[str, str], min_rows: int) -> Iterator[Tuple[str, int, str]]:
+    # type=ALL (recorrido completo) o index (recorrido completo del índice), o sin índice elegido
+    for row in rows:
+        access = str(row.get("type") or "").upper()
+        estimated = int(row.get("rows") or 0)
+        full_scan = access in ("ALL", "INDEX") or (row.get("key") is None and access not in ("", "CONST", "SYSTEM"))
+        table = aliases.get(str(row.get("table") or "").lower())
+        if full_scan and table and estimated >= min_rows:
+            yield table, estimated, f"type={access}, key={row.get('key')}"
+
+
+def _postgres_scans(plan: List[Dict[str, Any]], min_rows: int) -> Iterator[Tuple[str, int, str]]:
+    # Seq Scan sobre muchas filas. Sin ANALYZE no se conocen las filas descartadas por el filtro: el coste
+    # de un Seq Scan es al menos cpu_tuple_cost (0.01) por fila leída, así que se usa como cota.
+    stack = [entry["Plan"] for entry in plan if "Plan" in entry]
+    while stack:
+        node = stack.pop()
+        stack.extend(node.get("Plans") or [])
+        if node.get("Node Type") != "Seq Scan" or not node.get("Relation Name"):
+            continue
+        estimated = max(int(node.get("Plan Rows") or 0), int(float(node.get("Total Cost") or 0) / 0.01))
+        if estimated >= min_rows:
+            yield node["Relation Name"].lower(), estimated, f"Seq Scan, filter={node.get('Filter')}"
+
+
+def _create_index_sql(table: str, columns: List[str], dialect: str) -> str:
+    name = f"ix_{table}_{'_'.join(columns)}"[:60] # MySQL admite 64 caracteres, PostgreSQL 63
+    def quote(identifier: str) -> str:
+        return exp.to_identifier(identifier).sql(dialect)
+
+    return f"CREATE INDEX {quote(name)} ON {quote(table)} ({', '.join(quote(column) for column in columns)})"
+
+
+class IndexAdvisor:
+    def __init__(self, min_rows: int = settings.INDEX_ADVISOR_MIN_ROWS):
+        self.min_rows = min_rows
+
+    async def suggest(self, db: AsyncSession, since: datetime, limit: int) -> List[Dict[str, Any]]:
+        """Índices sugeridos para las `limit` consultas con más tiempo acumulado desde `since`."""
+        suggestions: List[Dict[str, Any]] = []
+        for entry in await crud_query_log.get_fingerprint_report(db, since, "total", limit):
+            sample = await crud_query_log.get_latest_sample(db, entry["fingerprint"], since)
+            dialect = _DIALECTS.get(sample.engine) if sample is not None else None
+            if dialect is None:
+                continue
+            try:
+                # El texto registrado puede venir recortado (QUERY_LOG_SQL_MAX_CHARS): entonces no se analiza
+                analyzed = analyze_sql(sample.sql_text, dialect)
+            except UnsafeQueryError:
+                continue
+            columns = predicate_columns(analyzed) if analyzed.kind in ("select", "set_operation") else {}
+            if not columns:
+                continue
+            try:
+                async with sql_tool_for(db, sample.tenant_id) as tool:
+                    plan = await tool.explain(sample.sql_text)
+            except Exception as e:
+                print(f"WARNING:app.services.index_advisor:No se pudo obtener el plan de [{entry['fingerprint']}]: {e}")
+                continue
+            if plan["format"] == "mysql":
+                scans = _mysql_scans(plan["rows"], _aliases(analyzed.expression), self.min_rows)
+            else:
+                scans = _postgres_scans(plan["plan"], self.min_rows)
+            for table, estimated, access in scans:
+                chosen = index_columns(columns[table]) if table in columns else []
+                if not chosen:
+                    continue
+                suggestions.append({
+                    "fingerprint": entry["fingerprint"],
+                    "normalized_sql": entry["normalized_sql"],
+                    "calls": entry["calls"],
+                    "total_ms": round(entry["total_ms"] or 0, 1),
+                    "avg_ms": round(entry["avg_ms"] or 0, 1),
+                    "tenant_id": sample.tenant_id,
+                    "table": table,
+                    "access": access,
+                    "estimated_rows": estimated,
+                    "columns": chosen,
+                    "create_index": _create_index_sql(table, chosen, dialect),
+                })
+        return suggestions
+
+
+index_advisor = IndexAdvisor()
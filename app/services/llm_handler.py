@@ -1,26 +1,111 @@
 # app/services/llm_handler.py
-import json
-import google.generativeai as genai
-from typing import List, Dict, Any, Optional
+import time
+from typing import Awaitable, Callable, List, Dict, Any, Optional, Tuple
 from app.tools.base_tool import BaseTool
+from app.core.config import settings
+from app.core import jsonutil
+from app.core.process_local import ProcessLocal
+from app.services.model_router import ModelRouter
+from app.services.llm_rate_limiter import LLMUnavailableError, llm_rate_limiter
+
+
+def _load_genai():
+    # El SDK de Gemini es pesado de importar: se carga la primera vez que se necesita (o en el warm-up),
+    # no al importar la app. Su cliente (gRPC) no sobrevive a un fork: se configura una vez por proceso.
+    import google.generativeai as genai
+    if settings.GEMINI_API_KEY and settings.GEMINI_API_KEY != "YOUR_GEMINI_API_KEY":
+        genai.configure(api_key=settings.GEMINI_API_KEY)
+    return genai
+
+_genai_client = ProcessLocal(_load_genai)
+
+
+def get_genai():
+    """Módulo google.generativeai ya configurado para este proceso."""
+    return _genai_client.get()
+
+
+# (modelo, instrucción de sistema) -> GenerativeModel: los handlers de cada petición reutilizan los del proceso.
+# Hay una instrucción por nombre de tool, así que las entradas son pocas.
+_generative_models: ProcessLocal[Dict[Tuple[str, Optional[str]], Any]] = ProcessLocal(dict)
+
+
+def get_generative_model(model_name: str, system_instruction: Optional[str] = None):
+    models = _generative_models.get()
+    key = (model_name, system_instruction)
+    model = models.get(key)
+    if model is None:
+        model = models[key] = get_genai().GenerativeModel(model_name=model_name, system_instruction=system_instruction)
+    return model
+
+
+def _error_result(error: Exception) -> Dict[str, Any]:
+    # El texto del error no es una respuesta: no llega al historial (ver _raise_if_failed)
+    return {
+        "text": None,
+        "tool_calls": [],
+        "finish_reason": "ERROR",
+        "error": str(error),
+        "retry_after": getattr(error, "retry_after", None),
+    }
+
+
+def _usage_tokens(response) -> Optional[int]:
+    usage = getattr(response, "usage_metadata", None)
+    return getattr(usage, "total_token_count", None) or None
+
+
+def _raise_if_failed(result: Dict[str, Any]) -> None:
+    if result.get("finish_reason") == "ERROR":
+        raise LLMUnavailableError(f"El modelo no está disponible: {result.get('error')}", result.get("retry_after"))
+
+
+def _failed(result: Dict[str, Any]) -> bool:
+    """La llamada falló o el modelo no devolvió nada utilizable (p. ej. MALFORMED_FUNCTION_CALL)."""
+    if result.get("finish_reason") == "ERROR" or "MALFORMED" in str(result.get("finish_reason")):
+        return True
+    return not result.get("text") and not result.get("tool_calls")
+
 
 class GeminiLLMHandler:
-    def __init__(self, model_name: str, tools: List[BaseTool], system_instruction: str = None):
+    def __init__(
+        self, model_name: str, tools: List[BaseTool], system_instruction: str = None, router: Optional[ModelRouter] = None
+    ):
         self.model_name = model_name
         self.tools = tools
         self.system_instruction = system_instruction
+        # Con router, cada llamada usa el modelo que elija (ver model_router); sin él, siempre model_name
+        self.router = router
         
         # Crear herramientas en formato Gemini
         self.gemini_tools = self._convert_tools_to_gemini_format()
         
         # Configurar modelo SIN herramientas inicialmente
-        self.model = genai.GenerativeModel(
-            model_name=model_name,
-            system_instruction=system_instruction
-        )
+        self.model = get_generative_model(model_name, system_instruction)
         
         print(f"INFO:app.services.llm_handler:Gemini Handler inicializado con modelo: {model_name} y tools: {[tool.name for tool in tools]}")
 
+    def _route(self, chat_history: List[Dict[str, Any]], user_prompt: str) -> str:
+        if self.router is None:
+            return self.model_name
+        model_name, reason = self.router.route(chat_history, user_prompt)
+        print(f"[LLM Handler] Modelo elegido: {model_name} ({reason})")
+        return model_name
+
+    def _observe(self, model_name: str, started: Optional[float], result: Dict[str, Any]) -> None:
+        result["model"] = model_name
+        # Sin `started` la llamada no llegó a hacerse (rechazada por el limitador de cuota)
+        if self.router is not None and started is not None:
+            self.router.observe(model_name, (time.perf_counter() - started) * 1000, ok=not _failed(result))
+
+    def _fallback(self, model_name: str, result: Dict[str, Any]) -> Optional[str]:
+        if self.router is None or not _failed(result):
+            return None
+        fallback = self.router.fallback(model_name)
+        if fallback is not None:
+            print(f"WARNING:app.services.llm_handler:{model_name} no dio una respuesta utilizable; se reintenta con {fallback}")
+        return fallback
+
     def _convert_tools_to_gemini_format(self) -> List[Dict[str, Any]]:
         """Convierte las herramientas BaseTool al formato esperado por Gemini"""
         if not self.tools:
@@ -37,35 +122,127 @@ class GeminiLLMHandler:
         return [{"function_declarations": function_declarations}]
 
     async def generate_response(self, chat_history: List[Dict[str, Any]], user_prompt: str) -> Dict[str, Any]:
-        """Genera una respuesta usando Gemini con soporte para herramientas"""
-        try:
-            # Preparar el historial completo
-            full_history = chat_history + [{"role": "user", "parts": [{"text": user_prompt}]}]
-            
-            print(f"[LLM Handler] Enviando a Gemini (historial + prompt): {json.dumps(full_history, indent=2)}")
-            
-            # **CAMBIO CLAVE: Pasar las herramientas en generate_content**
-            response = self.model.generate_content(
+        """
+        Genera una respuesta usando Gemini con soporte para herramientas. Si el modelo no responde (cuota
+        agotada o error de la API, también tras el reintento con el modelo fuerte) lanza LLMUnavailableError.
+        """
+        # Preparar el historial completo
+        full_history = chat_history + [{"role": "user", "parts": [{"text": user_prompt}]}]
+
+        if settings.LLM_DEBUG_LOGGING:
+            print(f"[LLM Handler] Enviando a Gemini (historial + prompt): {jsonutil.dumps(full_history)}")
+
+        model_name = self._route(chat_history, user_prompt)
+        result = await self._generate(model_name, full_history)
+        fallback = self._fallback(model_name, result)
+        if fallback is not None:
+            result = await self._generate(fallback, full_history)
+
+        print(f"[LLM Handler] Respuesta de Gemini ({result['model']}): Texto='{result.get('text', '')}', Tools='{result.get('tool_calls', [])}', FinishReason='{result.get('finish_reason', '')}'")
+        _raise_if_failed(result)
+        return result
+
+    async def _generate(self, model_name: str, full_history: List[Dict[str, Any]]) -> Dict[str, Any]:
+        model = get_generative_model(model_name, self.system_instruction)
+        estimated_tokens = llm_rate_limiter.estimate_tokens(full_history, self.system_instruction)
+        started: Optional[float] = None
+
+        async def call():
+            nonlocal started
+            started = time.perf_counter() # La latencia del modelo no incluye la espera por cuota
+            # **CAMBIO CLAVE: Pasar las herramientas en generate_content** (asíncrono: las esperas de cuota no bloquean el loop)
+            return await model.generate_content_async(
                 full_history,
                 tools=self.gemini_tools if self.gemini_tools else None
             )
+
+        try:
+            response = await llm_rate_limiter.run(model_name, estimated_tokens, call)
+            await llm_rate_limiter.settle(model_name, estimated_tokens, _usage_tokens(response))
             
             # Procesar la respuesta
             result = self._process_gemini_response(response)
             
-            print(f"[LLM Handler] Respuesta de Gemini: Texto='{result.get('text', '')}', Tools='{result.get('tool_calls', [])}', FinishReason='{result.get('finish_reason', '')}'")
-            
-            return result
-            
         except Exception as e:
-            print(f"ERROR:app.services.llm_handler:Error generando respuesta: {e}")
-            import traceback
-            traceback.print_exc()
-            return {
-                "text": f"Error al generar respuesta: {str(e)}",
-                "tool_calls": [],
-                "finish_reason": "ERROR"
-            }
+            print(f"ERROR:app.services.llm_handler:Error generando respuesta con {model_name}: {e}")
+            if not isinstance(e, LLMUnavailableError):
+                import traceback
+                traceback.print_exc()
+            result = _error_result(e)
+        self._observe(model_name, started, result)
+        return result
+
+    async def stream_response(
+        self, chat_history: List[Dict[str, Any]], user_prompt: str, on_text: Callable[[str], Awaitable[None]]
+    ) -> Dict[str, Any]:
+        """
+        Como generate_response, pero en streaming: cada fragmento de texto se entrega a `on_text` según
+        llega. Retorna el mismo resultado (texto completo, tool_calls y finish_reason) y falla igual.
+        """
+        full_history = chat_history + [{"role": "user", "parts": [{"text": user_prompt}]}]
+        model_name = self._route(chat_history, user_prompt)
+        result, emitted = await self._stream(model_name, full_history, on_text)
+        # Solo se reintenta si el cliente aún no recibió texto de la respuesta fallida
+        fallback = None if emitted else self._fallback(model_name, result)
+        if fallback is not None:
+            result, _ = await self._stream(fallback, full_history, on_text)
+        print(f"[LLM Handler] Respuesta de Gemini (streaming, {result['model']}): Texto='{result['text'] or ''}', Tools='{result['tool_calls']}', FinishReason='{result['finish_reason']}'")
+        _raise_if_failed(result)
+        return result
+
+    async def _stream(
+        self, model_name: str, full_history: List[Dict[str, Any]], on_text: Callable[[str], Awaitable[None]]
+    ) -> Tuple[Dict[str, Any], bool]:
+        result = {"text": None, "tool_calls": [], "finish_reason": "STOP"}
+        text_parts: List[str] = []
+        model = get_generative_model(model_name, self.system_instruction)
+        estimated_tokens = llm_rate_limiter.estimate_tokens(full_history, self.system_instruction)
+        used_tokens: Optional[int] = None
+        started: Optional[float] = None
+        reserved = False # Tokens reservados por run() aún sin liquidar
+
+        async def call():
+            nonlocal started
+            started = time.perf_counter()
+            return await model.generate_content_async(
+                full_history,
+                tools=self.gemini_tools if self.gemini_tools else None,
+                stream=True
+            )
+
+        try:
+            response = await llm_rate_limiter.run(model_name, estimated_tokens, call)
+            reserved = True
+            async for chunk in response:
+                used_tokens = _usage_tokens(chunk) or used_tokens # El último fragmento trae el uso total
+                if not chunk.candidates:
+                    continue
+                candidate = chunk.candidates[0]
+                if candidate.finish_reason:
+                    result["finish_reason"] = str(candidate.finish_reason)
+                for part in candidate.content.parts:
+                    if part.text:
+                        text_parts.append(part.text)
+                        await on_text(part.text)
+                    elif part.function_call and part.function_call.name:
+                        result["tool_calls"].append({
+                            "name": part.function_call.name,
+                            "args": dict(part.function_call.args) if part.function_call.args else {}
+                        })
+            result["text"] = "".join(text_parts) or None
+            reserved = False
+            await llm_rate_limiter.settle(model_name, estimated_tokens, used_tokens)
+        except Exception as e:
+            print(f"ERROR:app.services.llm_handler:Error generando respuesta en streaming con {model_name}: {e}")
+            if reserved:
+                # El stream falló a medias: se liquida lo que llegó a informar el servidor, o se devuelve todo
+                if used_tokens:
+                    await llm_rate_limiter.settle(model_name, estimated_tokens, used_tokens)
+                else:
+                    await llm_rate_limiter.refund(model_name, estimated_tokens)
+            result = _error_result(e)
+        self._observe(model_name, started, result)
+        return result, bool(text_parts)
 
     def _process_gemini_response(self, response) -> Dict[str, Any]:
         """Procesa la respuesta de Gemini y extrae texto y/o llamadas a herramientas"""
@@ -76,12 +253,15 @@ class GeminiLLMHandler:
         }
         
         try:
-            print(f"[LLM Handler] Debug - Response type: {type(response)}")
-            print(f"[LLM Handler] Debug - Response dir: {dir(response)}")
+            debug = settings.LLM_DEBUG_LOGGING
+            if debug:
+                print(f"[LLM Handler] Debug - Response type: {type(response)}")
+                print(f"[LLM Handler] Debug - Response dir: {dir(response)}")
             
             if hasattr(response, 'candidates') and response.candidates:
                 candidate = response.candidates[0]
-                print(f"[LLM Handler] Debug - Candidate: {candidate}")
+                if debug:
+                    print(f"[LLM Handler] Debug - Candidate: {candidate}")
                 
                 # Verificar finish_reason
                 if hasattr(candidate, 'finish_reason'):
@@ -89,20 +269,24 @@ class GeminiLLMHandler:
                 
                 # Procesar las partes del contenido
                 if hasattr(candidate, 'content') and hasattr(candidate.content, 'parts'):
-                    print(f"[LLM Handler] Debug - Parts count: {len(candidate.content.parts)}")
+                    if debug:
+                        print(f"[LLM Handler] Debug - Parts count: {len(candidate.content.parts)}")
                     
                     for i, part in enumerate(candidate.content.parts):
-                        print(f"[LLM Handler] Debug - Part {i}: {type(part)}, {dir(part)}")
+                        if debug:
+                            print(f"[LLM Handler] Debug - Part {i}: {type(part)}, {dir(part)}")
                         
                         # Verificar si es texto
                         if hasattr(part, 'text') and part.text:
                             result["text"] = part.text
-                            print(f"[LLM Handler] Debug - Found text: {part.text}")
+                            if debug:
+                                print(f"[LLM Handler] Debug - Found text: {part.text}")
                         
                         # Verificar si es una llamada a función
                         elif hasattr(part, 'function_call'):
                             func_call = part.function_call
-                            print(f"[LLM Handler] Debug - Found function_call: {func_call}")
+                            if debug:
+                                print(f"[LLM Handler] Debug - Found function_call: {func_call}")
                             
                             tool_call = {
                                 "name": func_call.name,
@@ -129,8 +313,11 @@ class GeminiLLMHandler:
         
         return result
 
-    async def execute_tool(self, tool_name: str, tool_args: Dict[str, Any]) -> str:
-        """Ejecuta una herramienta específica"""
+    async def execute_tool(self, tool_name: str, tool_args: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Ejecuta una herramienta específica. Retorna el resultado estructurado (sin serializar):
+        cada destino (BD, historial del LLM) lo serializa una sola vez.
+        """
         try:
             # Buscar la herramienta por nombre
             tool = None
@@ -142,18 +329,19 @@ class GeminiLLMHandler:
             if not tool:
                 error_msg = f"Herramienta '{tool_name}' no encontrada"
                 print(f"ERROR:app.services.llm_handler:{error_msg}")
-                return json.dumps({"error": error_msg})
+                return {"error": error_msg}
             
             # Ejecutar la herramienta
             print(f"[LLM Handler] Ejecutando herramienta '{tool_name}' con args: {tool_args}")
             result = await tool.run(**tool_args)
             
-            print(f"[LLM Handler] Resultado de herramienta '{tool_name}': {result}")
-            return json.dumps(result)
+            if settings.LLM_DEBUG_LOGGING:
+                print(f"[LLM Handler] Resultado de herramienta '{tool_name}': {result}")
+            return result
             
         except Exception as e:
             error_msg = f"Error ejecutando herramienta '{tool_name}': {str(e)}"
             print(f"ERROR:app.services.llm_handler:{error_msg}")
             import traceback
             traceback.print_exc()
-            return json.dumps({"error": error_msg})
\ No newline at end of file
+            return {"error": error_msg}
\ No newline at end of file
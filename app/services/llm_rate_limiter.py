@@ -0,0 +1,325 @@
+# app/services/llm_rate_limiter.py
+import asyncio
+import math
+import re
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+from app.core import jsonutil
+from app.core.config import settings
+from app.core.process_local import ProcessLocal
+from app.core.shared_state import get_shared_state
+
+T = TypeVar("T")
+
+# Pista de espera de un 429 de Gemini: "retry_delay { seconds: 37 }" (gRPC) o "retryDelay": "37s" (REST)
+_RETRY_DELAY_RE = re.compile(r'retry_?delay"?\s*[:{]\s*"?(?:seconds:\s*)?(\d+(?:\.\d+)?)', re.IGNORECASE)
+
+
+class LLMUnavailableError(Exception):
+    """El LLM no respondió (cuota agotada más allá de la espera máxima, o error de la API); el turno no se completa."""
+
+    def __init__(self, detail: str, retry_after: Optional[float] = None):
+        super().__init__(detail)
+        self.detail = detail
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_seconds(self) -> int:
+        """Para la cabecera Retry-After."""
+        return max(1, math.ceil(self.retry_after or settings.LLM_RATE_LIMIT_BACKOFF_SECONDS))
+
+
+def is_quota_error(error: BaseException) -> bool:
+    """429 / RESOURCE_EXHAUSTED del SDK de Gemini (google.api_core.exceptions.ResourceExhausted)."""
+    if type(error).__name__ in ("ResourceExhausted", "TooManyRequests"):
+        return True
+    if getattr(error, "code", None) == 429:
+        return True
+    text = str(error)
+    return text.startswith("429") or "RESOURCE_EXHAUSTED" in text
+
+
+def retry_after_from(error: BaseException) -> Optional[float]:
+    match = _RETRY_DELAY_RE.search(str(error))
+    return float(match.group(1)) if match else None
+
+
+def _parse_limits(value: str) -> Dict[str, Tuple[int, int]]:
+    """"modelo=rpm:tpm,..." -> {modelo: (rpm, tpm)}"""
+    limits = {}
+    for item in (value or "").split(","):
+        if "=" not in item:
+            continue
+        model, quota = item.split("=", 1)
+        rpm, _, tpm = quota.partition(":")
+        limits[model.strip()] = (int(rpm or 0), int(tpm or 0))
+    return limits
+
+
+class _TokenBucket:
+    """Cubo de tokens del proceso: se rellena a `per_minute / 60` por segundo, hasta `per_minute`."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def take(self, amount: int) -> float:
+        """Consume `amount` y retorna 0, o retorna los segundos a esperar sin consumir nada."""
+        self._refill()
+        amount = min(amount, self.capacity) # Una llamada mayor que toda la cuota pasa con el cubo lleno
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    async def adjust(self, amount: int) -> None:
+        """Corrige lo consumido (positivo: se gastó más de lo estimado; negativo: se devuelve)."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+    def available(self) -> Optional[int]:
+        self._refill()
+        return int(self.tokens)
+
+
+class _SharedWindow:
+    """
+    Equivalente del cubo compartido entre workers (SharedStateBackend distribuido, p. ej. Redis): ventana
+    deslizante sobre contadores por minuto, que solo necesita `incr` atómico. Lo consumido en el minuto
+    anterior cuenta en proporción a lo que queda de él en la ventana.
+    """
+
+    def __init__(self, key: str, per_minute: int):
+        self.key = key
+        self.per_minute = per_minute
+
+    async def take(self, amount: int) -> float:
+        amount = min(amount, self.per_minute)
+        state = get_shared_state()
+        now = time.time()
+        window = int(now // 60)
+        elapsed = now - window * 60
+        used = await state.incr(f"{self.key}:{window}", amount, ttl=120)
+        previous = int(await state.get(f"{self.key}:{window - 1}") or 0)
+        estimated = previous * (60 - elapsed) / 60 + used
+        if estimated <= self.per_minute:
+            return 0.0
+        await state.incr(f"{self.key}:{window}", -amount, ttl=120) # No cabe: se devuelve y se espera
+        excess = estimated - self.per_minute
+        wait = excess * 60 / previous if previous else 60 - elapsed
+        return max(0.05, min(wait, 60 - elapsed))
+
+    async def adjust(self, amount: int) -> None:
+        if amount:
+            await get_shared_state().incr(f"{self.key}:{int(time.time() // 60)}", amount, ttl=120)
+
+    def available(self) -> Optional[int]:
+        return None # Vive en el almacén compartido: no se consulta para las métricas
+
+
+class _ModelQuota:
+    def __init__(self, model: str, rpm: int, tpm: int, shared: bool):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.shared = shared
+
+        def bucket(kind: str, per_minute: int):
+            if per_minute <= 0:
+                return None
+            return _SharedWindow(f"llm:quota:{model}:{kind}", per_minute) if shared else _TokenBucket(per_minute)
+
+        self.requests = bucket("rpm", rpm)
+        self.tokens = bucket("tpm", tpm)
+        self.blocked_until = 0.0 # time.time() hasta el que el servidor pidió no llamar (429)
+        self.lock = asyncio.Lock() # Cola FIFO de las llamadas que esperan cuota para este modelo
+
+
+class _LimiterState:
+    def __init__(self):
+        self.quotas: Dict[str, _ModelQuota] = {}
+        self.waiting = 0
+        self.max_waiting = 0
+        self.wait_total_ms = 0.0
+        self.wait_max_ms = 0.0
+        self.counters = {
+            "acquired": 0,
+            "queued": 0, # Llamadas que tuvieron que esperar cuota
+            "rejected": 0, # Superaron la espera máxima
+            "quota_errors": 0, # 429 del servidor
+            "retries": 0,
+        }
+
+
+class LLMRateLimiter:
+    """
+    Limitador de las llamadas a Gemini según la cuota por minuto de peticiones (RPM) y de tokens (TPM)
+    de cada modelo, para encolar llamadas en lugar de que fallen con 429.
+
+    - Cada llamada reserva 1 petición y los tokens estimados (prompt + salida esperada); al terminar se
+      corrige con el uso real que informa la API. Si no hay cuota, espera en una cola FIFO por modelo
+      hasta `max_wait` segundos; pasado ese tiempo falla con LLMUnavailableError.
+    - Un 429 bloquea el modelo durante el retry_delay que indique el servidor (o un backoff exponencial)
+      y la llamada se reintenta hasta `max_retries` veces.
+    - Con un SharedStateBackend distribuido (SHARED_STATE_BACKEND=redis) la cuota y los bloqueos se
+      comparten entre workers; con `memory`, cada proceso lleva su propio cubo.
+    """
+
+    def __init__(
+        self,
+        rpm: int = settings.LLM_RATE_LIMIT_RPM,
+        tpm: int = settings.LLM_RATE_LIMIT_TPM,
+        per_model: str = settings.LLM_RATE_LIMITS,
+        max_wait: float = settings.LLM_RATE_LIMIT_MAX_WAIT_SECONDS,
+        max_retries: int = settings.LLM_RATE_LIMIT_MAX_RETRIES,
+        backoff: float = settings.LLM_RATE_LIMIT_BACKOFF_SECONDS,
+        output_tokens: int = settings.LLM_ESTIMATED_OUTPUT_TOKENS,
+        chars_per_token: float = settings.LLM_CHARS_PER_TOKEN,
+    ):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.limits = _parse_limits(per_model)
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.output_tokens = output_tokens
+        self.chars_per_token = chars_per_token
+        self._state: ProcessLocal[_LimiterState] = ProcessLocal(_LimiterState)
+
+    def estimate_tokens(self, contents: Any, system_instruction: Optional[str] = None) -> int:
+        chars = len(jsonutil.dumps_bytes(contents)) + len(system_instruction or "")
+        return int(chars / self.chars_per_token) + self.output_tokens
+
+    def _quota(self, model: str) -> _ModelQuota:
+        quotas = self._state.get().quotas
+        quota = quotas.get(model)
+        if quota is None:
+            rpm, tpm = self.limits.get(model, (self.rpm, self.tpm))
+            quota = quotas[model] = _ModelQuota(model, rpm, tpm, shared=get_shared_state().distributed)
+        return quota
+
+    async def _blocked_for(self, model: str, quota: _ModelQuota) -> float:
+        until = quota.blocked_until
+        if quota.shared:
+            until = max(until, float(await get_shared_state().get(f"llm:blocked:{model}") or 0))
+        return max(0.0, until - time.time())
+
+    async def _try_take(self, model: str, quota: _ModelQuota, tokens: int) -> float:
+        wait = await self._blocked_for(model, quota)
+        if wait > 0:
+            return wait
+        if quota.requests is not None:
+            wait = await quota.requests.take(1)
+            if wait > 0:
+                return wait
+        if quota.tokens is not None:
+            wait = await quota.tokens.take(tokens)
+            if wait > 0:
+                if quota.requests is not None:
+                    await quota.requests.adjust(-1)
+                return wait
+        return 0.0
+
+    async def acquire(self, model: str, tokens: int) -> None:
+        """Espera en la cola del modelo hasta tener cuota para una petición de `tokens` tokens estimados."""
+        state = self._state.get()
+        quota = self._quota(model)
+        started = time.monotonic()
+        state.waiting += 1
+        state.max_waiting = max(state.max_waiting, state.waiting)
+        try:
+            async with quota.lock:
+                while True:
+                    wait = await self._try_take(model, quota, tokens)
+                    if wait <= 0:
+                        break
+                    if time.monotonic() - started + wait > self.max_wait:
+                        state.counters["rejected"] += 1
+                        raise LLMUnavailableError(
+                            f"Cuota del modelo {model} agotada; se superó la espera máxima de {self.max_wait:.0f} s.",
+                            retry_after=wait,
+                        )
+                    await asyncio.sleep(wait)
+        finally:
+            state.waiting -= 1
+        waited_ms = (time.monotonic() - started) * 1000
+        state.counters["acquired"] += 1
+        if waited_ms >= 1:
+            state.counters["queued"] += 1
+            state.wait_total_ms += waited_ms
+            state.wait_max_ms = max(state.wait_max_ms, waited_ms)
+
+    async def settle(self, model: str, estimated_tokens: int, used_tokens: Optional[int]) -> None:
+        """Corrige los tokens reservados con el uso real de la respuesta (usage_metadata)."""
+        quota = self._quota(model)
+        if used_tokens and quota.tokens is not None:
+            await quota.tokens.adjust(used_tokens - estimated_tokens)
+
+    async def refund(self, model: str, estimated_tokens: int) -> None:
+        """Devuelve los tokens reservados para una llamada que falló sin respuesta (la petición sí cuenta en RPM)."""
+        quota = self._quota(model)
+        if quota.tokens is not None:
+            await quota.tokens.adjust(-estimated_tokens)
+
+    async def penalize(self, model: str, retry_after: Optional[float], attempt: int = 0) -> float:
+        """Bloquea el modelo tras un 429 durante el retry_delay del servidor (o backoff exponencial). Retorna la espera."""
+        state = self._state.get()
+        quota = self._quota(model)
+        delay = retry_after if retry_after else self.backoff * 2 ** attempt
+        quota.blocked_until = max(quota.blocked_until, time.time() + delay)
+        state.counters["quota_errors"] += 1
+        if quota.shared:
+            await get_shared_state().set(f"llm:blocked:{model}", str(quota.blocked_until), ttl=delay)
+        print(f"WARNING:app.services.llm_rate_limiter:Cuota de {model} agotada (429); se espera {delay:.1f} s")
+        return delay
+
+    async def run(self, model: str, estimated_tokens: int, call: Callable[[], Awaitable[T]]) -> T:
+        """
+        Ejecuta `call` con cuota reservada; tras un 429 espera lo indicado y reintenta. Si `call` falla,
+        los tokens reservados se devuelven; si termina bien, el llamador los corrige con settle().
+        """
+        for attempt in range(self.max_retries + 1):
+            await self.acquire(model, estimated_tokens)
+            try:
+                return await call()
+            except Exception as e:
+                # Una ráfaga de errores no debe vaciar el cubo de TPM y frenar a las llamadas sanas
+                await self.refund(model, estimated_tokens)
+                if not is_quota_error(e):
+                    raise
+                delay = await self.penalize(model, retry_after_from(e), attempt)
+                if attempt >= self.max_retries:
+                    raise LLMUnavailableError(f"Cuota del modelo {model} agotada (429).", retry_after=delay) from e
+                self._state.get().counters["retries"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        state = self._state.peek() or _LimiterState()
+        queued = state.counters["queued"]
+        return {
+            **state.counters,
+            "queue_depth": state.waiting,
+            "max_queue_depth": state.max_waiting,
+            "avg_wait_ms": round(state.wait_total_ms / queued, 1) if queued else None,
+            "max_wait_ms": round(state.wait_max_ms, 1),
+            "models": {
+                model: {
+                    "rpm": quota.rpm,
+                    "tpm": quota.tpm,
+                    "shared": quota.shared,
+                    "blocked_for_seconds": round(max(0.0, quota.blocked_until - time.time()), 1),
+                    "requests_available": quota.requests.available() if quota.requests is not None else None,
+                    "tokens_available": quota.tokens.available() if quota.tokens is not None else None,
+                }
+                for model, quota in state.quotas.items()
+            },
+        }
+
+
+llm_rate_limiter = LLMRateLimiter()
@@ -0,0 +1,248 @@
+# app/services/model_router.py
+import re
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+from app.core.process_local import ProcessLocal
+
+FAST = "fast"
+STRONG = "strong"
+
+# Saludos, agradecimientos y confirmaciones cortas: nunca requieren planificar SQL
+_SIMPLE_RE = re.compile(
+    r"^\s*(hola|buen[oa]s|hey|gracias|muchas gracias|ok|okey|vale|perfecto|genial|listo|entendido|adi[oó]s|chao)\b",
+    re.IGNORECASE,
+)
+_SIMPLE_MAX_CHARS = 60
+_MAX_ERROR_COOLDOWN_SECONDS = 600
+
+# Señales de planificación SQL compleja: agregaciones, agrupaciones, comparaciones, rankings y rangos
+_COMPLEX_SIGNALS = [re.compile(pattern, re.IGNORECASE) for pattern in (
+    r"\b(promedio|media|suma|sumatoria|total(es)?)\b",
+    r"\bpor (mes|año|semana|d[ií]a|trimestre|cliente|producto|vendedor|bodega|sede|categor[ií]a|ciudad|empleado)\b",
+    r"\b(compar\w*|versus|vs\.?|frente a)\b",
+    r"\b(top\s*\d+|ranking|m[aá]s vendid\w*|mayor(es)?|menor(es)?|m[aá]ximo|m[ií]nimo)\b",
+    r"\b(porcentaje|proporci[oó]n|tendencia|evoluci[oó]n|crecimiento|variaci[oó]n)\b",
+    r"\b(entre .+ y |desde .+ hasta|[uú]ltim[oa]s? (\d+|año|mes|semana|trimestre)|cada)\b",
+    r"\b(join|group by|having|subconsulta)\b",
+)]
+
+# Exploración del esquema: tras ella todavía falta planificar la consulta de datos. En PostgreSQL
+# (sin DESCRIBE / SHOW) las columnas se consultan con un SELECT sobre information_schema
+_SCHEMA_STATEMENTS = ("DESCRIBE", "DESC", "SHOW", "EXPLAIN")
+_SCHEMA_CATALOG_RE = re.compile(r"\binformation_schema\.", re.IGNORECASE)
+
+
+def _models_from(value: str, default: str) -> List[str]:
+    return [name.strip() for name in (value or default).split(",") if name.strip()]
+
+
+def _current_turn_steps(chat_history: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Llamadas a tools y respuestas del turno en curso: las entradas del final del historial desde la última respuesta de texto."""
+    steps = []
+    for entry in reversed(chat_history):
+        parts = [part for part in entry.get("parts") or [] if isinstance(part, dict)]
+        if entry.get("role") == "tool" or (entry.get("role") == "model" and any("function_call" in p for p in parts)):
+            steps.append(entry)
+        else:
+            break
+    steps.reverse()
+    return steps
+
+
+def _parts_of(steps: List[Dict[str, Any]], role: str, key: str) -> List[Dict[str, Any]]:
+    return [
+        part[key] for entry in steps if entry.get("role") == role
+        for part in entry.get("parts") or [] if isinstance(part, dict) and key in part
+    ]
+
+
+def _is_tool_error(function_response: Dict[str, Any]) -> bool:
+    response = function_response.get("response")
+    content = response.get("content") if isinstance(response, dict) else None
+    return isinstance(content, dict) and (bool(content.get("error")) or content.get("success") is False)
+
+
+def _is_schema_call(function_call: Dict[str, Any]) -> bool:
+    query = str((function_call.get("args") or {}).get("query", "")).lstrip()
+    if not query:
+        return False
+    return query.split(None, 1)[0].upper() in _SCHEMA_STATEMENTS or bool(_SCHEMA_CATALOG_RE.search(query))
+
+
+def _has_repeated_call(function_calls: List[Dict[str, Any]]) -> bool:
+    seen = set()
+    for call in function_calls:
+        key = (call.get("name"), repr(sorted((call.get("args") or {}).items())))
+        if key in seen:
+            return True
+        seen.add(key)
+    return False
+
+
+class _ModelStats:
+    def __init__(self, samples: int):
+        self.calls = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.cooldown_until = 0.0 # Tras un error no se elige hasta entonces (si hay alternativa)
+        self.ewma_ms: Optional[float] = None
+        self.latencies: Deque[float] = deque(maxlen=samples)
+
+
+class _RouterState:
+    def __init__(self, samples: int):
+        self.samples = samples
+        self.models: Dict[str, _ModelStats] = {}
+        self.decisions: Dict[str, int] = {} # "<nivel>:<motivo>" -> llamadas
+
+    def model(self, name: str) -> _ModelStats:
+        stats = self.models.get(name)
+        if stats is None:
+            stats = self.models[name] = _ModelStats(self.samples)
+        return stats
+
+
+def _percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))], 1)
+
+
+class ModelRouter:
+    """
+    Elige el modelo de Gemini de cada llamada al LLM dentro de un turno.
+
+    - Rápido: saludos y preguntas sencillas, y la redacción de la respuesta tras un resultado de datos.
+    - Fuerte: planificación de SQL compleja (preguntas largas o con varias señales de agregación,
+      agrupación o comparación) y escalado automático cuando, en el turno en curso, una tool devolvió
+      error, el bucle se atasca (la misma llamada repetida o `stall_calls` llamadas sin respuesta) o
+      la llamada al modelo rápido falla o no devuelve nada (se reintenta con el fuerte).
+
+    La decisión se toma solo con el historial que recibe el handler (sin estado por turno), así que
+    un mismo handler puede atender a varias conversaciones a la vez. Dentro de cada nivel se usa el
+    modelo con menor latencia observada (media móvil de las llamadas correctas); los que aún no tienen
+    muestras se prueban antes. Un modelo que falla queda en cuarentena `error_cooldown` segundos (el
+    doble con cada error seguido) y solo se elige si no hay otro del nivel disponible: así un modelo
+    que falla al instante (nombre erróneo, 4xx) no acaba pareciendo el más rápido.
+    Decisiones y latencias por modelo son de este proceso (ver stats()).
+    """
+
+    def __init__(
+        self,
+        enabled: bool = settings.LLM_ROUTING_ENABLED,
+        fast_models: str = settings.LLM_FAST_MODELS,
+        strong_models: str = settings.LLM_STRONG_MODELS,
+        complex_min_chars: int = settings.LLM_ROUTER_COMPLEX_MIN_CHARS,
+        complex_min_signals: int = settings.LLM_ROUTER_COMPLEX_MIN_SIGNALS,
+        stall_calls: int = settings.LLM_ROUTER_STALL_CALLS,
+        latency_samples: int = settings.LLM_ROUTER_LATENCY_SAMPLES,
+        error_cooldown: float = settings.LLM_ROUTER_ERROR_COOLDOWN_SECONDS,
+    ):
+        self.fast_models = _models_from(fast_models, settings.GEMINI_LLM_MODEL)
+        self.strong_models = _models_from(strong_models, "")
+        self.enabled = enabled and bool(self.strong_models)
+        self.complex_min_chars = complex_min_chars
+        self.complex_min_signals = complex_min_signals
+        self.stall_calls = stall_calls
+        self.error_cooldown = error_cooldown
+        self._state: ProcessLocal[_RouterState] = ProcessLocal(lambda: _RouterState(latency_samples))
+
+    def is_complex(self, user_prompt: str) -> bool:
+        if len(user_prompt) <= _SIMPLE_MAX_CHARS and _SIMPLE_RE.match(user_prompt):
+            return False
+        if len(user_prompt) >= self.complex_min_chars:
+            return True
+        return sum(1 for signal in _COMPLEX_SIGNALS if signal.search(user_prompt)) >= self.complex_min_signals
+
+    def _classify(self, chat_history: List[Dict[str, Any]], user_prompt: str) -> Tuple[str, str]:
+        steps = _current_turn_steps(chat_history)
+        calls = _parts_of(steps, "model", "function_call")
+        responses = _parts_of(steps, "tool", "function_response")
+        if any(_is_tool_error(response) for response in responses):
+            return STRONG, "tool_error"
+        if len(calls) >= self.stall_calls or _has_repeated_call(calls):
+            return STRONG, "stall"
+        if calls and not _is_schema_call(calls[-1]):
+            return FAST, "answer" # Ya hay datos: falta redactar la respuesta
+        if self.is_complex(user_prompt):
+            return STRONG, "complex"
+        return FAST, "simple"
+
+    def _pick(self, models: List[str]) -> str:
+        state = self._state.get()
+        now = time.monotonic()
+        available = [name for name in models if state.model(name).cooldown_until <= now]
+        if not available:
+            # Todos en cuarentena: el que sale antes de ella
+            return min(models, key=lambda name: state.model(name).cooldown_until)
+        models = available
+        untried = [name for name in models if state.model(name).ewma_ms is None]
+        if untried:
+            return untried[0]
+        return min(models, key=lambda name: state.model(name).ewma_ms)
+
+    def _count(self, tier: str, reason: str) -> None:
+        decisions = self._state.get().decisions
+        key = f"{tier}:{reason}"
+        decisions[key] = decisions.get(key, 0) + 1
+
+    def route(self, chat_history: List[Dict[str, Any]], user_prompt: str) -> Tuple[str, str]:
+        """(modelo, motivo) para la próxima llamada del turno."""
+        if not self.enabled:
+            self._count(FAST, "disabled")
+            return self._pick(self.fast_models), "disabled"
+        tier, reason = self._classify(chat_history, user_prompt)
+        self._count(tier, reason)
+        return self._pick(self.fast_models if tier == FAST else self.strong_models), reason
+
+    def fallback(self, model_name: str) -> Optional[str]:
+        """Modelo fuerte con el que reintentar una llamada fallida a `model_name`, o None si ya lo era."""
+        if not self.enabled or model_name in self.strong_models:
+            return None
+        self._count(STRONG, "retry")
+        return self._pick(self.strong_models)
+
+    def observe(self, model_name: str, latency_ms: float, ok: bool) -> None:
+        stats = self._state.get().model(model_name)
+        stats.calls += 1
+        if not ok:
+            # La latencia de un fallo no cuenta: un error inmediato haría parecer rápido al modelo
+            stats.errors += 1
+            stats.consecutive_errors += 1
+            cooldown = min(self.error_cooldown * 2 ** (stats.consecutive_errors - 1), _MAX_ERROR_COOLDOWN_SECONDS)
+            stats.cooldown_until = time.monotonic() + cooldown
+            return
+        stats.consecutive_errors = 0
+        stats.cooldown_until = 0.0
+        stats.latencies.append(latency_ms)
+        stats.ewma_ms = latency_ms if stats.ewma_ms is None else 0.8 * stats.ewma_ms + 0.2 * latency_ms
+
+    def stats(self) -> Dict[str, Any]:
+        state = self._state.peek() or _RouterState(0)
+        escalations = sum(count for key, count in state.decisions.items()
+                          if key in ("strong:tool_error", "strong:stall", "strong:retry"))
+        return {
+            "enabled": self.enabled,
+            "fast_models": self.fast_models,
+            "strong_models": self.strong_models,
+            "decisions": dict(state.decisions),
+            "escalations": escalations,
+            "models": {
+                name: {
+                    "calls": stats.calls,
+                    "errors": stats.errors,
+                    "cooldown_seconds": round(max(0.0, stats.cooldown_until - time.monotonic()), 1),
+                    "ewma_ms": round(stats.ewma_ms, 1) if stats.ewma_ms is not None else None,
+                    "p50_ms": _percentile(list(stats.latencies), 0.5),
+                    "p95_ms": _percentile(list(stats.latencies), 0.95),
+                }
+                for name, stats in state.models.items()
+            },
+        }
+
+
+model_router = ModelRouter()
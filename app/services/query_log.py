@@ -0,0 +1,72 @@
+# app/services/query_log.py
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from app.core.config import settings
+from app.core.tool_context import current_tool_context
+from app.db.models_conversation import ToolQueryLog
+from app.db.write_behind import message_writer
+from app.tools.sql_rewriter import AnalyzedQuery
+
+
+class QueryTrace:
+    """Lo que una tool SQL sabe de una consulta mientras la ejecuta, para el registro."""
+
+    __slots__ = ("query", "sql", "analyzed", "source", "rows_examined", "result_bytes")
+
+    def __init__(self, query: str):
+        self.query = query # Texto que envió el modelo
+        self.sql: Optional[str] = None # SQL ejecutado (tras la reescritura)
+        self.analyzed: Optional[AnalyzedQuery] = None
+        self.source = "database" # "database" | "materialized" | "rejected"
+        self.rows_examined: Optional[int] = None
+        self.result_bytes: Optional[int] = None # Tamaño JSON de las filas, si la tool lo midió (ver capped_result)
+
+
+class QueryLogger:
+    """
+    Registra cada consulta de las tools SQL en tool_query_log: huella, tenant y sesión del turno,
+    latencia, filas devueltas/examinadas, bytes del resultado y error.
+
+    Las filas van al writer write-behind sin esperar (try_enqueue): si la cola está llena o el writer
+    no está en marcha se descartan y se cuentan, nunca frenan a la tool.
+    """
+
+    def __init__(self, enabled: bool = settings.QUERY_LOG_ENABLED, sql_max_chars: int = settings.QUERY_LOG_SQL_MAX_CHARS):
+        self.enabled = enabled
+        self.sql_max_chars = sql_max_chars
+        self.recorded = 0
+        self.dropped = 0
+
+    def record(self, engine: str, db_label: Optional[str], trace: QueryTrace, result: Dict[str, Any], latency_ms: float) -> None:
+        if not self.enabled:
+            return
+        context = current_tool_context()
+        analyzed = trace.analyzed
+        rows = result.get("rows")
+        row = {
+            "created_at": datetime.utcnow(),
+            "fingerprint": analyzed.fingerprint if analyzed else None,
+            "normalized_sql": analyzed.normalized if analyzed else None,
+            "sql_text": (trace.sql or trace.query)[:self.sql_max_chars],
+            "engine": engine,
+            "db_label": db_label,
+            "tenant_id": context.tenant_id,
+            "session_id": context.session_id,
+            "source": trace.source,
+            "latency_ms": round(latency_ms, 3),
+            "rows_returned": len(rows) if isinstance(rows, list) else None,
+            "rows_examined": trace.rows_examined,
+            "result_bytes": trace.result_bytes if rows else 0,
+            "error": None if result.get("success", True) else str(result.get("error"))[:2000],
+        }
+        if message_writer.try_enqueue(ToolQueryLog.__table__, row):
+            self.recorded += 1
+        else:
+            self.dropped += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, "recorded": self.recorded, "dropped": self.dropped}
+
+
+query_log = QueryLogger()
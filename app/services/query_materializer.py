@@ -0,0 +1,208 @@
+# app/services/query_materializer.py
+import asyncio
+import hashlib
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+from app.core import jsonutil
+from app.core.config import settings
+from app.core.process_local import ProcessLocal
+from app.core.shared_state import get_shared_state
+from app.crud import crud_materialized
+from app.db.blob_store import compress_payload, decompress_payload
+from app.db.database import AsyncSessionLocalConversation
+from app.tools.sql_rewriter import AnalyzedQuery
+
+# tabla (minúsculas) -> UPDATE_TIME en ISO (None si MySQL no lo conoce)
+TableVersions = Dict[str, Optional[str]]
+
+
+def db_key_for(db_url: str) -> str:
+    """Huella de la URL de una BD externa: identifica la BD (y el tenant) sin guardar credenciales."""
+    return hashlib.sha1(db_url.encode("utf-8")).hexdigest()[:16]
+
+
+def _result_id(db_key: str, canonical_sql: str) -> str:
+    return hashlib.sha1(f"{db_key}\n{canonical_sql}".encode("utf-8")).hexdigest()
+
+
+class _MaterializerState:
+    def __init__(self):
+        self.index: Set[str] = set() # IDs materializados (se relee cada MATERIALIZE_INDEX_TTL_SECONDS)
+        self.index_expires = 0.0
+        self.index_lock = asyncio.Lock()
+        self.versions: Dict[str, Tuple[float, TableVersions]] = {}
+        self.counters = {
+            "lookups": 0,
+            "hits": 0,
+            "stale": 0,
+            "materialized": 0,
+            "refreshed": 0,
+            "evicted": 0,
+            "errors": 0,
+        }
+
+
+class QueryMaterializer:
+    """
+    Materialización de las agregaciones más frecuentes y costosas de MySQLTool.
+
+    - Cada agregación (GROUP BY o funciones de agregación) que tarda más de `min_query_ms` cuenta una
+      ejecución para su forma canónica (contador compartido entre workers, en una ventana de `window`).
+    - Al llegar a `min_hits`, su resultado se guarda comprimido en materialized_query_results junto con
+      el UPDATE_TIME de sus tablas de origen. Solo se conservan las `top_n` de más score
+      (ejecuciones x latencia) por BD.
+    - Una consulta con la misma forma canónica se responde desde la copia mientras las tablas de origen
+      no hayan cambiado y la copia no supere `max_age`. Si cambiaron, se ejecuta contra la BD externa y
+      el resultado nuevo reemplaza a la copia (refresco bajo demanda, solo de lo que cambió).
+    """
+
+    def __init__(
+        self,
+        enabled: bool = settings.MATERIALIZE_ENABLED,
+        top_n: int = settings.MATERIALIZE_TOP_N,
+        min_hits: int = settings.MATERIALIZE_MIN_HITS,
+        window: float = settings.MATERIALIZE_HIT_WINDOW_SECONDS,
+        min_query_ms: float = settings.MATERIALIZE_MIN_QUERY_MS,
+        max_rows: int = settings.MATERIALIZE_MAX_ROWS,
+        max_age: float = settings.MATERIALIZE_MAX_AGE_SECONDS,
+        version_ttl: float = settings.MATERIALIZE_VERSION_CHECK_SECONDS,
+        index_ttl: float = settings.MATERIALIZE_INDEX_TTL_SECONDS,
+    ):
+        self.enabled = enabled
+        self.top_n = top_n
+        self.min_hits = min_hits
+        self.window = window
+        self.min_query_ms = min_query_ms
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.version_ttl = version_ttl
+        self.index_ttl = index_ttl
+        self._state: ProcessLocal[_MaterializerState] = ProcessLocal(_MaterializerState)
+
+    def is_candidate(self, analyzed: AnalyzedQuery) -> bool:
+        return self.enabled and analyzed.is_aggregate and bool(analyzed.tables)
+
+    async def _index(self) -> Set[str]:
+        state = self._state.get()
+        if state.index_expires > time.monotonic():
+            return state.index
+        async with state.index_lock:
+            if state.index_expires <= time.monotonic():
+                async with AsyncSessionLocalConversation() as db:
+                    state.index = set(await crud_materialized.list_materialized_ids(db))
+                state.index_expires = time.monotonic() + self.index_ttl
+        return state.index
+
+    async def source_versions(
+        self, db_url: str, tables: Tuple[str, ...], loader: Callable[[], Awaitable[TableVersions]]
+    ) -> Optional[TableVersions]:
+        """UPDATE_TIME de `tables`, con la foto de la BD cacheada `version_ttl` segundos. None si no se pudo leer."""
+        state = self._state.get()
+        db_key = db_key_for(db_url)
+        cached = state.versions.get(db_key)
+        if cached is None or cached[0] <= time.monotonic():
+            try:
+                snapshot = await loader()
+            except Exception as e:
+                print(f"WARNING:app.services.query_materializer:No se pudo leer UPDATE_TIME de las tablas: {e}")
+                return None
+            cached = (time.monotonic() + self.version_ttl, snapshot)
+            state.versions[db_key] = cached
+        return {table: cached[1].get(table) for table in tables}
+
+    def _is_fresh(self, row, versions: Optional[TableVersions]) -> bool:
+        if versions is None:
+            return False
+        if (datetime.utcnow() - row.refreshed_at.replace(tzinfo=None)).total_seconds() > self.max_age:
+            return False
+        return jsonutil.loads(row.source_versions) == versions
+
+    async def lookup(self, db_url: str, analyzed: AnalyzedQuery, versions: Optional[TableVersions]) -> Optional[Dict[str, Any]]:
+        """Resultado materializado y vigente de la consulta, o None si hay que ejecutarla."""
+        state = self._state.get()
+        result_id = _result_id(db_key_for(db_url), analyzed.canonical)
+        try:
+            if result_id not in await self._index():
+                return None
+            state.counters["lookups"] += 1
+            async with AsyncSessionLocalConversation() as db:
+                row = await crud_materialized.get_materialized(db, result_id)
+            if row is None:
+                state.index.discard(result_id)
+                return None
+            if not self._is_fresh(row, versions):
+                state.counters["stale"] += 1
+                return None
+            result = jsonutil.loads(decompress_payload(row.codec, row.result))
+        except Exception as e:
+            state.counters["errors"] += 1
+            print(f"ERROR:app.services.query_materializer:Error leyendo la materialización {result_id}: {e}")
+            return None
+        state.counters["hits"] += 1
+        result["materialized_at"] = row.refreshed_at.isoformat()
+        print(f"INFO:app.services.query_materializer:Consulta [{analyzed.fingerprint}] respondida desde la materialización")
+        return result
+
+    async def observe(
+        self, db_url: str, analyzed: AnalyzedQuery, result: Dict[str, Any], elapsed_ms: float,
+        versions: Optional[TableVersions], db_label: Optional[str] = None
+    ) -> None:
+        """Cuenta la ejecución y materializa (o refresca) la consulta si está entre las frecuentes y costosas."""
+        if versions is None or not result.get("success") or result.get("truncated"):
+            return
+        if not result.get("columns") or result.get("row_count", 0) > self.max_rows:
+            return
+        state = self._state.get()
+        db_key = db_key_for(db_url)
+        result_id = _result_id(db_key, analyzed.canonical)
+        try:
+            refresh = result_id in await self._index()
+            if not refresh and elapsed_ms < self.min_query_ms:
+                return
+            executions = await get_shared_state().incr(f"matview:seen:{result_id}", ttl=self.window)
+            if not refresh and executions < self.min_hits:
+                return
+            codec, data = compress_payload(jsonutil.dumps_bytes(result))
+            values = {
+                "id": result_id,
+                "db_key": db_key,
+                "db_label": db_label,
+                "fingerprint": analyzed.fingerprint,
+                "canonical_sql": analyzed.canonical,
+                "source_tables": jsonutil.dumps(list(analyzed.tables)),
+                "source_versions": jsonutil.dumps(versions),
+                "codec": codec,
+                "result": data,
+                "row_count": result.get("row_count", 0),
+                "build_ms": int(elapsed_ms),
+                "score": int(executions * elapsed_ms),
+                "refreshed_at": datetime.utcnow(),
+            }
+            async with AsyncSessionLocalConversation() as db:
+                await crud_materialized.upsert_materialized(db, values)
+                evicted = await crud_materialized.trim_materialized(db, db_key, self.top_n)
+        except Exception as e:
+            state.counters["errors"] += 1
+            print(f"ERROR:app.services.query_materializer:Error materializando la consulta [{analyzed.fingerprint}]: {e}")
+            return
+        state.counters["refreshed" if refresh else "materialized"] += 1
+        state.counters["evicted"] += len(evicted)
+        state.index.add(result_id)
+        state.index.difference_update(evicted)
+        if not refresh:
+            print(f"INFO:app.services.query_materializer:Consulta [{analyzed.fingerprint}] materializada "
+                  f"({executions} ejecuciones, {elapsed_ms:.0f} ms)")
+
+    def stats(self) -> Dict[str, Any]:
+        state = self._state.peek() or _MaterializerState()
+        return {
+            **state.counters,
+            "enabled": self.enabled,
+            "top_n": self.top_n,
+            "hit_ratio": round(state.counters["hits"] / state.counters["lookups"], 4) if state.counters["lookups"] else None,
+        }
+
+
+query_materializer = QueryMaterializer()
@@ -0,0 +1,169 @@
+# app/services/retention.py
+import asyncio
+import gzip
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import text
+
+from app.core import jsonutil
+from app.core.config import settings
+from app.crud import crud_conversation, crud_query_log
+from app.db.blob_store import blob_ids_in_message, decode_blob
+from app.db.database import AsyncSessionLocalConversation, get_conv_engine
+from app.db.partitioning import ensure_future_partitions
+
+# Lock con nombre de MySQL: con varios workers/réplicas de la API solo uno ejecuta la retención
+_RETENTION_LOCK = "chatbot_message_retention"
+
+
+class RetentionJob:
+    """
+    Mantenimiento y retención de chat_messages en segundo plano.
+
+    En cada pasada crea siempre las particiones mensuales de los próximos meses (sin ellas las filas
+    nuevas acabarían todas en `pmax`) y, si el registro de consultas está activo (QUERY_LOG_ENABLED),
+    borra las entradas de tool_query_log más antiguas que QUERY_LOG_RETENTION_DAYS (sin archivar).
+    Si la purga está activada (RETENTION_ENABLED), además archiva los mensajes más antiguos que
+    MESSAGE_RETENTION_DAYS en ficheros JSONL comprimidos (gzip) en disco y después los borra en lotes
+    pequeños, cada uno en su propia transacción, para no mantener locks largos sobre la tabla
+    caliente. Por último elimina las sesiones que quedaron vacías.
+    """
+
+    def __init__(
+        self,
+        retention_days: int = settings.MESSAGE_RETENTION_DAYS,
+        batch_size: int = settings.RETENTION_BATCH_SIZE,
+        batch_pause: float = settings.RETENTION_BATCH_PAUSE_SECONDS,
+        interval: float = settings.RETENTION_INTERVAL_SECONDS,
+        archive_dir: str = settings.RETENTION_ARCHIVE_DIR,
+        query_log_days: int = settings.QUERY_LOG_RETENTION_DAYS,
+        purge_enabled: bool = settings.RETENTION_ENABLED,
+        query_log_enabled: bool = settings.QUERY_LOG_ENABLED,
+    ):
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.interval = interval
+        self.archive_dir = archive_dir
+        self.query_log_days = query_log_days
+        self.purge_enabled = purge_enabled
+        self.query_log_enabled = query_log_enabled
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"ERROR:app.services.retention:Error en la pasada de retención: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self) -> Dict[str, Any]:
+        async with get_conv_engine().connect() as lock_conn:
+            acquired = (await lock_conn.execute(text("SELECT GET_LOCK(:name, 0)"), {"name": _RETENTION_LOCK})).scalar()
+            if not acquired:
+                return {"skipped": True}
+            try:
+                await ensure_future_partitions(lock_conn, settings.PARTITION_MONTHS_AHEAD)
+                await lock_conn.commit()
+                stats: Dict[str, Any] = {"messages": 0, "sessions": 0, "query_log": 0, "archive": None}
+                if self.query_log_enabled:
+                    stats["query_log"] = await self._purge_query_log()
+                if self.purge_enabled:
+                    stats.update(await self._purge_expired())
+            finally:
+                await lock_conn.execute(text("SELECT RELEASE_LOCK(:name)"), {"name": _RETENTION_LOCK})
+        if stats["messages"] or stats["sessions"] or stats["query_log"]:
+            print(f"INFO:app.services.retention:Retención completada: {stats}")
+        return stats
+
+    async def _purge_expired(self) -> Dict[str, Any]:
+        cutoff = datetime.utcnow() - timedelta(days=self.retention_days)
+        stats: Dict[str, Any] = {"messages": 0, "sessions": 0, "archive": None}
+        archive_path = None
+
+        while True:
+            async with AsyncSessionLocalConversation() as db:
+                batch = await crud_conversation.get_expired_messages(db, cutoff, self.batch_size)
+                if not batch:
+                    break
+                # Los payloads fuera de línea se archivan junto a su mensaje, ya descomprimidos
+                blob_ids = [blob_id for m in batch for blob_id in blob_ids_in_message(m.message)]
+                blobs = {b.id: b for b in await crud_conversation.get_message_blobs(db, blob_ids)}
+                rows = [_message_row(m, blobs) for m in batch]
+                if archive_path is None:
+                    archive_path = self._new_archive_path()
+                # El archivo se escribe y sincroniza a disco ANTES de borrar el lote
+                await asyncio.to_thread(_append_archive, archive_path, rows)
+                stats["messages"] += await crud_conversation.delete_messages_by_ids(
+                    db, [m.id for m in batch], before=cutoff
+                )
+                await crud_conversation.delete_message_blobs(db, list(blobs))
+            await asyncio.sleep(self.batch_pause) # Cede hueco a las escrituras del chat entre lotes
+
+        while True:
+            async with AsyncSessionLocalConversation() as db:
+                deleted = await crud_conversation.delete_expired_sessions(db, cutoff, self.batch_size)
+            stats["sessions"] += deleted
+            if deleted < self.batch_size:
+                break
+            await asyncio.sleep(self.batch_pause)
+
+        stats["archive"] = archive_path
+        return stats
+
+    async def _purge_query_log(self) -> int:
+        cutoff = datetime.utcnow() - timedelta(days=self.query_log_days)
+        total = 0
+        while True:
+            async with AsyncSessionLocalConversation() as db:
+                deleted = await crud_query_log.delete_query_log_before(db, cutoff, self.batch_size)
+            total += deleted
+            if deleted < self.batch_size:
+                return total
+            await asyncio.sleep(self.batch_pause)
+
+    def _new_archive_path(self) -> str:
+        os.makedirs(self.archive_dir, exist_ok=True)
+        return os.path.join(self.archive_dir, f"chat_messages_{datetime.utcnow():%Y%m%dT%H%M%S}_{os.getpid()}.jsonl.gz")
+
+
+def _message_row(message, blobs: Dict[str, Any]) -> Dict[str, Any]:
+    row = {
+        "id": message.id,
+        "session_id": message.session_id,
+        "sender": message.sender,
+        "message": message.message,
+        "timestamp": message.timestamp.isoformat() if message.timestamp else None,
+    }
+    referenced = [blob_id for blob_id in blob_ids_in_message(message.message) if blob_id in blobs]
+    if referenced:
+        row["blobs"] = {blob_id: decode_blob(blobs[blob_id]) for blob_id in referenced}
+    return row
+
+
+def _append_archive(path: str, rows: List[Dict[str, Any]]) -> None:
+    # Cada lote es un miembro gzip independiente: el fichero sigue siendo un .gz válido (zcat lo lee entero)
+    with open(path, "ab") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="ab") as gz:
+            for row in rows:
+                gz.write(jsonutil.dumps_bytes(row) + b"\n")
+        raw.flush()
+        os.fsync(raw.fileno())
+
+
+retention_job = RetentionJob()
@@ -0,0 +1,145 @@
+# app/services/session_cleanup.py
+import asyncio
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set
+
+from app.core import jsonutil
+from app.core.config import settings
+from app.core.shared_state import get_shared_state
+from app.crud import crud_conversation
+from app.db.database import AsyncSessionLocalConversation
+from app.db.write_behind import message_writer
+
+_STATUS_KEY = "bulk_delete:{job_id}"
+
+
+class BulkSessionDeleter:
+    """
+    Borrado masivo de sesiones en segundo plano.
+
+    Las sesiones se recorren por páginas (BULK_DELETE_SESSION_CHUNK) y sus mensajes se borran en
+    lotes de BULK_DELETE_MESSAGE_CHUNK filas, cada lote en su propia transacción y con una pausa
+    entre lotes: los locks duran milisegundos y las escrituras del chat no quedan bloqueadas.
+    El progreso se guarda en el estado compartido, así que cualquier worker puede consultarlo.
+    """
+
+    def __init__(
+        self,
+        session_chunk: int = settings.BULK_DELETE_SESSION_CHUNK,
+        message_chunk: int = settings.BULK_DELETE_MESSAGE_CHUNK,
+        pause: float = settings.BULK_DELETE_PAUSE_SECONDS,
+        status_ttl: int = settings.BULK_DELETE_STATUS_TTL,
+    ):
+        self.session_chunk = session_chunk
+        self.message_chunk = message_chunk
+        self.pause = pause
+        self.status_ttl = status_ttl
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def submit(
+        self,
+        user_id: Optional[str] = None,
+        before: Optional[datetime] = None,
+        session_ids: Optional[List[str]] = None,
+    ) -> Dict[str, Any]:
+        """Registra el trabajo, lo lanza en segundo plano y retorna su estado inicial."""
+        job_id = str(uuid.uuid4())
+        job = {
+            "job_id": job_id,
+            "status": "queued",
+            "filters": {
+                "user_id": user_id,
+                "before": before.isoformat() if before else None,
+                "session_ids": len(session_ids) if session_ids is not None else None,
+            },
+            "sessions_deleted": 0,
+            "messages_deleted": 0,
+            "created_at": datetime.utcnow().isoformat(),
+            "updated_at": datetime.utcnow().isoformat(),
+            "finished_at": None,
+            "error": None,
+        }
+        await self._save(job)
+        task = asyncio.create_task(self._run(job, user_id, before, session_ids))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    async def get_status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        raw = await get_shared_state().get(_STATUS_KEY.format(job_id=job_id))
+        return jsonutil.loads(raw) if raw else None
+
+    async def stop(self) -> None:
+        """Cancela los trabajos en curso (en el apagado). Lo ya borrado queda confirmado lote a lote."""
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _save(self, job: Dict[str, Any]) -> None:
+        job["updated_at"] = datetime.utcnow().isoformat()
+        await get_shared_state().set(_STATUS_KEY.format(job_id=job["job_id"]), jsonutil.dumps(job), ttl=self.status_ttl)
+
+    async def _run(
+        self,
+        job: Dict[str, Any],
+        user_id: Optional[str],
+        before: Optional[datetime],
+        session_ids: Optional[List[str]],
+    ) -> None:
+        job["status"] = "running"
+        await self._save(job)
+        try:
+            after_id = None
+            while True:
+                async with AsyncSessionLocalConversation() as db:
+                    page = await crud_conversation.get_session_ids_page(
+                        db, user_id=user_id, before=before, session_ids=session_ids,
+                        after_id=after_id, limit=self.session_chunk
+                    )
+                if not page:
+                    break
+                after_id = page[-1]
+                await self._delete_page(job, page)
+                await self._save(job)
+            job["status"] = "done"
+        except asyncio.CancelledError:
+            job["status"] = "cancelled"
+            job["error"] = "Interrumpido por el apagado del worker."
+            raise
+        except Exception as e:
+            print(f"ERROR:app.services.session_cleanup:Error en el borrado masivo {job['job_id']}: {e}")
+            job["status"] = "failed"
+            job["error"] = str(e)
+        finally:
+            job["finished_at"] = datetime.utcnow().isoformat()
+            await asyncio.shield(self._save(job))
+
+    async def _delete_page(self, job: Dict[str, Any], session_ids: List[str]) -> None:
+        # Los mensajes aún en cola del write-behind se persisten antes, para no dejar huérfanos
+        for session_id in session_ids:
+            if message_writer.has_pending(session_id):
+                await message_writer.wait_flushed(session_id)
+
+        while True:
+            async with AsyncSessionLocalConversation() as db:
+                deleted = await crud_conversation.delete_messages_chunk(db, session_ids, self.message_chunk)
+            job["messages_deleted"] += deleted
+            if deleted < self.message_chunk:
+                break
+            await asyncio.sleep(self.pause)
+
+        # Los blobs (payloads grandes) también por trozos, en transacciones cortas
+        while True:
+            async with AsyncSessionLocalConversation() as db:
+                deleted = await crud_conversation.delete_message_blobs_chunk(db, session_ids, self.message_chunk)
+            if deleted < self.message_chunk:
+                break
+            await asyncio.sleep(self.pause)
+
+        async with AsyncSessionLocalConversation() as db:
+            job["sessions_deleted"] += await crud_conversation.delete_sessions_by_ids(db, session_ids)
+        await asyncio.sleep(self.pause)
+
+
+bulk_session_deleter = BulkSessionDeleter()
@@ -0,0 +1,210 @@
+# app/services/turn_worker.py
+import asyncio
+import os
+import socket
+import time
+from typing import List, Optional
+
+from app.core.config import settings
+from app.crud import crud_turn
+from app.db.database import AsyncSessionLocalConversation
+from app.db.models_conversation import ChatTurn
+from app.services.admission import session_locks, AdmissionRejected
+from app.services.batch_runner import batch_runner
+from app.services.chat_orchestrator import ChatOrchestrator
+
+
+class TurnWorkerPool:
+    """
+    Pool de workers que ejecuta los turnos encolados en `chat_turns`.
+
+    Los workers reclaman turnos de la BD (SKIP LOCKED), así que pueden correr dentro del
+    proceso de la API o en procesos dedicados (`python -m app.services.turn_worker`) y
+    escalarse por separado de las conexiones HTTP. Un lease con heartbeat permite
+    recuperar los turnos de un worker que se cayó o se reinició.
+
+    Hay dos carriles: `concurrency` workers para los turnos interactivos (?async=true) y
+    `batch_concurrency` para los de lotes (POST /batch). Los de lotes toman el hueco y la
+    cuota por minuto de batch_runner antes de reclamar, así que un lote nunca retiene un
+    turno reclamado ni deja sin workers al tráfico interactivo.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = settings.TURN_WORKERS,
+        poll_interval: float = settings.TURN_POLL_INTERVAL,
+        lease_seconds: float = settings.TURN_LEASE_SECONDS,
+        max_attempts: int = settings.TURN_MAX_ATTEMPTS,
+        batch_concurrency: int = settings.BATCH_MAX_CONCURRENCY,
+    ):
+        self.concurrency = concurrency
+        self.batch_concurrency = batch_concurrency
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_prefix = f"{socket.gethostname()}:{os.getpid()}"
+        self._tasks: List[asyncio.Task] = []
+        self._stopping = False
+        self._new_work = asyncio.Event()
+        # Se reemplaza en cada turno terminado: despierta a los long-polls de este proceso
+        self._turn_finished = asyncio.Event()
+
+    # --- Notificaciones dentro del proceso (los demás procesos se enteran por polling) ---
+
+    def notify_new_turn(self) -> None:
+        self._new_work.set()
+
+    def _notify_turn_finished(self) -> None:
+        finished, self._turn_finished = self._turn_finished, asyncio.Event()
+        finished.set()
+
+    # --- Ciclo de vida ---
+
+    def start(self) -> None:
+        if self._tasks or self.concurrency <= 0:
+            return
+        self._stopping = False
+        self._tasks = [
+            asyncio.create_task(self._worker_loop(f"{self.worker_prefix}:{i}")) for i in range(self.concurrency)
+        ]
+        self._tasks += [
+            asyncio.create_task(self._worker_loop(f"{self.worker_prefix}:batch:{i}", batch=True))
+            for i in range(self.batch_concurrency)
+        ]
+        self._tasks.append(asyncio.create_task(self._recovery_loop()))
+        print(f"INFO:app.services.turn_worker:{self.concurrency} workers de turnos y {self.batch_concurrency} "
+              f"de lotes iniciados ({self.worker_prefix})")
+
+    async def stop(self, grace_seconds: float = 10.0) -> None:
+        """Deja de reclamar turnos y espera a los que están en curso; los que no terminen los recupera otro worker."""
+        self._stopping = True
+        self._new_work.set()
+        if not self._tasks:
+            return
+        _, pending = await asyncio.wait(self._tasks, timeout=grace_seconds)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        self._tasks = []
+
+    # --- Workers ---
+
+    async def _claim(self, worker_id: str, batch: bool = False) -> Optional[ChatTurn]:
+        async with AsyncSessionLocalConversation() as db:
+            return await crud_turn.claim_next_turn(db, worker_id, batch=batch)
+
+    async def _claim_and_run_batch(self, worker_id: str) -> bool:
+        """Hueco y cuota de lotes primero; después reclama. Si no hay turno, la cuota se devuelve."""
+        async with batch_runner.capacity():
+            reservation = await batch_runner.reserve()
+            turn = await self._claim(worker_id, batch=True)
+            if turn is None:
+                await batch_runner.release(reservation)
+                return False
+            await self._run_turn(turn)
+            return True
+
+    async def _worker_loop(self, worker_id: str, batch: bool = False) -> None:
+        while not self._stopping:
+            try:
+                if batch:
+                    claimed = await self._claim_and_run_batch(worker_id)
+                else:
+                    turn = await self._claim(worker_id)
+                    claimed = turn is not None
+                    if claimed:
+                        await self._run_turn(turn)
+                if not claimed:
+                    self._new_work.clear()
+                    try:
+                        await asyncio.wait_for(self._new_work.wait(), timeout=self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"ERROR:app.services.turn_worker:Error en el worker {worker_id}: {e}")
+                await asyncio.sleep(self.poll_interval)
+
+    async def _heartbeat(self, turn_id: str) -> None:
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                async with AsyncSessionLocalConversation() as db:
+                    await crud_turn.heartbeat_turn(db, turn_id)
+            except Exception as e:
+                print(f"ERROR:app.services.turn_worker:No se pudo renovar el lease del turno {turn_id}: {e}")
+
+    async def _run_turn(self, turn: ChatTurn) -> None:
+        print(f"INFO:app.services.turn_worker:Ejecutando turno {turn.id} (sesión {turn.session_id}, intento {turn.attempts})")
+        heartbeat = asyncio.create_task(self._heartbeat(turn.id))
+        try:
+            # El orden por sesión entre procesos lo da claim_next_turn; el lock cubre las peticiones síncronas de este proceso
+            async with session_locks.hold(turn.session_id):
+                async with AsyncSessionLocalConversation() as db:
+                    orchestrator = ChatOrchestrator(db_session=db, session_id=turn.session_id, user_id=turn.user_id)
+                    response = await orchestrator.handle_user_message(turn.message)
+            async with AsyncSessionLocalConversation() as db:
+                await crud_turn.finish_turn(db, turn.id, "done", response=response.model_dump_json())
+        except AdmissionRejected:
+            # Otro mensaje de la misma sesión sigue en curso en este proceso: reintentar más tarde
+            async with AsyncSessionLocalConversation() as db:
+                await crud_turn.requeue_turn(db, turn.id)
+        except asyncio.CancelledError:
+            raise # El lease caduca y el turno se recupera en otro worker
+        except Exception as e:
+            print(f"ERROR:app.services.turn_worker:El turno {turn.id} falló: {e}")
+            async with AsyncSessionLocalConversation() as db:
+                await crud_turn.finish_turn(db, turn.id, "failed", error=str(e))
+        finally:
+            heartbeat.cancel()
+            self._notify_turn_finished()
+
+    async def _recovery_loop(self) -> None:
+        while not self._stopping:
+            try:
+                async with AsyncSessionLocalConversation() as db:
+                    recovered = await crud_turn.recover_stale_turns(db, self.lease_seconds, self.max_attempts)
+                if recovered:
+                    print(f"INFO:app.services.turn_worker:{recovered} turnos huérfanos devueltos a la cola")
+                    self.notify_new_turn()
+            except Exception as e:
+                print(f"ERROR:app.services.turn_worker:Error recuperando turnos huérfanos: {e}")
+            await asyncio.sleep(self.lease_seconds / 2)
+
+    # --- Long-poll ---
+
+    async def wait_for_turn(self, turn_id: str, timeout: float) -> Optional[ChatTurn]:
+        """
+        Espera hasta `timeout` segundos a que el turno termine y lo devuelve (None si no existe).
+        Se despierta enseguida si el turno lo termina este proceso; si lo ejecuta otro, por polling.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            finished = self._turn_finished
+            async with AsyncSessionLocalConversation() as db:
+                turn = await crud_turn.get_turn(db, turn_id)
+            remaining = deadline - time.monotonic()
+            if turn is None or turn.status in crud_turn.TURN_FINAL_STATUSES or remaining <= 0:
+                return turn
+            try:
+                await asyncio.wait_for(finished.wait(), timeout=min(remaining, self.poll_interval))
+            except asyncio.TimeoutError:
+                pass
+
+
+turn_worker_pool = TurnWorkerPool()
+
+
+async def _run_standalone() -> None:
+    """Ejecuta solo los workers, sin servidor HTTP."""
+    pool = TurnWorkerPool(concurrency=max(settings.TURN_WORKERS, 1), batch_concurrency=max(settings.BATCH_MAX_CONCURRENCY, 1))
+    pool.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await pool.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(_run_standalone())
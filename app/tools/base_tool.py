@@ -8,8 +8,16 @@ class BaseTool(ABC):
     name: str
     description: str
     parameters: Dict[str, Any]
+    # Solo tools SQL (ver MySQLTool / PostgresTool): se usan en el prompt de sistema del LLM
+    engine: str
+    schema_lookup: str
+    database_name: str
     
     @abstractmethod
     async def run(self, **kwargs) -> Dict[str, Any]:
         """Ejecuta la herramienta con los argumentos proporcionados"""
-        pass
\ No newline at end of file
+        pass
+
+    async def close(self) -> None:
+        """Libera los recursos propios de la tool (pools dedicados). Por defecto no hay ninguno."""
+        pass
@@ -1,12 +1,56 @@
 # app/tools/mysql_tool.py
-import json
-from typing import Dict, Any
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
+import time
+from typing import Dict, Any, List, Optional
+from sqlalchemy.ext.asyncio import AsyncConnection
 from sqlalchemy import text as sa_text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError
 import logging
 
 from app.tools.base_tool import BaseTool
+from app.tools.sql_result import mysql_converters, convert_rows, capped_result, tabular_result
+from app.tools.sql_rewriter import (
+    AnalyzedQuery, Catalog, StarColumns, UnsafeQueryError, analyze_sql, rewrite_sql, schema_catalog, star_columns_for
+)
+from app.core.config import settings
+from app.db.replica_router import ReplicaRouter, get_replica_router, NoHealthyReplicaError
+from app.services.query_materializer import query_materializer, TableVersions
+from app.services.query_log import QueryTrace, query_log
+
+_CATALOG_QUERY = sa_text(
+    "SELECT TABLE_NAME, COLUMN_NAME, DATA_TYPE FROM information_schema.COLUMNS "
+    "WHERE TABLE_SCHEMA = DATABASE() ORDER BY TABLE_NAME, ORDINAL_POSITION"
+)
+
+
+async def _fetch_catalog(conn: AsyncConnection) -> Catalog:
+    catalog: Catalog = {}
+    for table, column, data_type in (await conn.execute(_CATALOG_QUERY)).all():
+        catalog.setdefault(table.lower(), []).append((column, data_type))
+    return catalog
+
+
+async def _fetch_table_versions(conn: AsyncConnection) -> TableVersions:
+    try:
+        # MySQL 8 cachea las estadísticas de information_schema.TABLES (24 h por defecto): se piden al día
+        await conn.execute(sa_text("SET SESSION information_schema_stats_expiry = 0"))
+    except DBAPIError:
+        pass # MySQL 5.7 / MariaDB: no existe la variable y UPDATE_TIME no se cachea
+    result = await conn.execute(sa_text(
+        "SELECT TABLE_NAME, UPDATE_TIME FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE()"
+    ))
+    return {table.lower(): updated.isoformat() if updated else None for table, updated in result.all()}
+
+
+async def _fetch_rows_examined(conn: AsyncConnection) -> Optional[int]:
+    # Última sentencia de esta conexión según performance_schema (MySQL 8.0.16+)
+    result = await conn.execute(sa_text(
+        "SELECT ROWS_EXAMINED FROM performance_schema.events_statements_history "
+        "WHERE THREAD_ID = PS_CURRENT_THREAD_ID() AND SQL_TEXT NOT LIKE 'SELECT ROWS_EXAMINED%' "
+        "ORDER BY EVENT_ID DESC LIMIT 1"
+    ))
+    return result.scalar()
+
 
 class MySQLTool(BaseTool):
     name: str = "mysql_tool"
@@ -21,75 +65,155 @@ class MySQLTool(BaseTool):
         },
         "required": ["query"]
     }
+    # Para el prompt de sistema del LLM: motor y cómo consultar las columnas de una tabla con esta tool
+    engine: str = "MySQL"
+    schema_lookup: str = "`DESCRIBE table_name;` o `SHOW COLUMNS FROM table_name;`"
+
+    # Se desactiva en el proceso si performance_schema no está disponible o no hay permisos
+    _rows_examined_enabled: bool = settings.QUERY_LOG_ROWS_EXAMINED
 
-    def __init__(self, db_url: str):
-        self.db_url = db_url 
-        self.engine = create_async_engine(db_url, echo=False)  # echo=False para menos ruido
-        self.AsyncSessionLocal = sessionmaker(
-            self.engine, expire_on_commit=False, class_=AsyncSession
-        )
+    def __init__(self, db_url: str, replica_urls: Optional[List[str]] = None, max_connections: Optional[int] = None):
+        self.db_url = db_url
+        self.database_name = make_url(db_url).database or "nilo_db"
+        if max_connections is None:
+            # El router (engines y pools) se comparte entre todas las instancias de la tool;
+            # las lecturas van a las réplicas configuradas y el primario queda como respaldo.
+            self.router = get_replica_router(db_url, replica_urls)
+            self._owns_router = False
+        else:
+            # Router propio con pools acotados (BD de un tenant): se cierra con close()
+            self.router = ReplicaRouter(
+                db_url,
+                replica_urls or [],
+                pool_size=max_connections,
+                max_overflow=0,
+                primary_pool_size=max_connections,
+                primary_max_overflow=0,
+            )
+            self._owns_router = True
         print(f"INFO:app.tools.mysql_tool:MySQLTool inicializado para DB: {db_url.split('@')[-1] if '@' in db_url else db_url}")
 
+    async def close(self) -> None:
+        if self._owns_router:
+            await self.router.dispose()
+
+    async def _star_columns(self, analyzed: AnalyzedQuery) -> StarColumns:
+        """Columnas del catálogo para expandir los `SELECT *` de la consulta (vacío si no hay o falla)."""
+        if not analyzed.has_star or not settings.SQL_REWRITE_EXPAND_STAR:
+            return ()
+        try:
+            catalog = await schema_catalog.get(self.db_url, lambda: self.router.run_read(_fetch_catalog))
+        except Exception as e:
+            print(f"WARNING:app.tools.mysql_tool:No se pudo leer el catálogo de columnas: {e}")
+            return ()
+        return star_columns_for(analyzed, catalog)
+
+    async def _execute_query(self, conn: AsyncConnection, query: str, trace: Optional[QueryTrace] = None) -> Dict[str, Any]:
+        result = await conn.execute(sa_text(query))
+
+        if result.returns_rows:
+            # Los conversores se eligen una vez por columna con los tipos del cursor (el cursor se
+            # cierra al agotar las filas, así que la descripción se lee antes del fetch)
+            converters = mysql_converters(result.cursor.description)
+            column_names = list(result.keys())
+            raw_rows = result.fetchmany(settings.SQL_TOOL_MAX_ROWS + 1)
+            more_rows = len(raw_rows) > settings.SQL_TOOL_MAX_ROWS
+            rows = convert_rows(raw_rows[:settings.SQL_TOOL_MAX_ROWS], converters)
+            result.close()
+            if trace is not None:
+                await self._record_rows_examined(conn, trace)
+
+            print(f"INFO:app.tools.mysql_tool:Consulta exitosa. {len(rows)} filas retornadas")
+            return capped_result(column_names, rows, more_rows, trace)
+        else:
+            return tabular_result([], [], message="Consulta ejecutada exitosamente sin resultados")
+
+    async def _record_rows_examined(self, conn: AsyncConnection, trace: QueryTrace) -> None:
+        if not MySQLTool._rows_examined_enabled:
+            return
+        try:
+            trace.rows_examined = await _fetch_rows_examined(conn)
+        except DBAPIError as e:
+            MySQLTool._rows_examined_enabled = False
+            print(f"WARNING:app.tools.mysql_tool:ROWS_EXAMINED no disponible, se deja de leer: {e}")
+
+    async def explain(self, sql: str) -> Dict[str, Any]:
+        """Plan de ejecución (EXPLAIN tradicional, sin ejecutar la consulta) para el asesor de índices."""
+        async def _explain(conn: AsyncConnection) -> List[Dict[str, Any]]:
+            result = await conn.execute(sa_text(f"EXPLAIN {sql}"))
+            return [dict(row) for row in result.mappings().all()]
+
+        return {"format": "mysql", "rows": await self.router.run_read(_explain)}
+
     async def run(self, query: str) -> Dict[str, Any]:
         """
-        Ejecuta una consulta SQL SELECT contra la base de datos MySQL.
-        Solo se permiten consultas SELECT por seguridad.
+        Ejecuta una consulta SQL de lectura contra la base de datos MySQL.
+        Solo se permiten SELECT (también UNION), DESCRIBE y SHOW por seguridad (ver sql_rewriter).
         """
-        # Validar que sea SELECT
-        query_stripped = query.strip()
-        if not query_stripped.upper().startswith("SELECT"):
+        trace = QueryTrace(query)
+        started = time.perf_counter()
+        result = await self._run(query, trace)
+        query_log.record(self.name, self.router.primary.label, trace, result, (time.perf_counter() - started) * 1000)
+        return result
+
+    async def _run(self, query: str, trace: QueryTrace) -> Dict[str, Any]:
+        # Validación sobre el AST: una sola sentencia, de solo lectura
+        try:
+            analyzed = analyze_sql(query, "mysql")
+        except UnsafeQueryError as e:
+            trace.source = "rejected"
+            print(f"WARNING:app.tools.mysql_tool:Consulta rechazada: {e}")
+            return {
+                "success": False,
+                "error": str(e),
+                "rows": []
+            }
+        trace.analyzed = analyzed
+
+        star_columns: StarColumns = ()
+        try:
+            star_columns = await self._star_columns(analyzed)
+            # +1 fila para saber si el resultado se recortó (ver capped_result)
+            sql = trace.sql = rewrite_sql(analyzed, settings.SQL_TOOL_MAX_ROWS + 1, star_columns)
+
+            # Agregaciones frecuentes y costosas: se responden desde su materialización si sigue vigente
+            versions: Optional[TableVersions] = None
+            materialize = query_materializer.is_candidate(analyzed)
+            if materialize:
+                versions = await query_materializer.source_versions(
+                    self.db_url, analyzed.tables, lambda: self.router.run_read(_fetch_table_versions)
+                )
+                materialized = await query_materializer.lookup(self.db_url, analyzed, versions)
+                if materialized is not None:
+                    trace.source = "materialized"
+                    return materialized
+
+            print(f"INFO:app.tools.mysql_tool:Ejecutando consulta [{analyzed.fingerprint}]: {sql}")
+            started = time.perf_counter()
+            result = await self.router.run_read(self._execute_query, sql, trace)
+            if materialize:
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                await query_materializer.observe(
+                    self.db_url, analyzed, result, elapsed_ms, versions, db_label=self.router.primary.label
+                )
+            return result
+
+        except NoHealthyReplicaError as e:
+            print(f"ERROR:app.tools.mysql_tool:{e}")
             return {
                 "success": False,
-                "error": "Solo se permiten consultas SELECT por razones de seguridad.",
-                "data": []
+                "error": str(e),
+                "rows": []
             }
+        except Exception as e:
+            if star_columns:
+                schema_catalog.invalidate(self.db_url) # El esquema pudo cambiar: se relee en la próxima consulta
+            error_msg = f"Error ejecutando consulta SQL: {str(e)}"
+            print(f"ERROR:app.tools.mysql_tool:{error_msg}")
+            print(f"ERROR:app.tools.mysql_tool:Consulta problemática: {query}")
 
-        async with self.AsyncSessionLocal() as session:
-            try:
-                print(f"INFO:app.tools.mysql_tool:Ejecutando consulta: {query}")
-                
-                result = await session.execute(sa_text(query))
-                
-                # Obtener nombres de columnas y filas
-                if result.returns_rows:
-                    column_names = list(result.keys())
-                    rows = result.fetchall()
-                    
-                    formatted_results = []
-                    for row in rows:
-                        row_dict = {}
-                        for i, col in enumerate(column_names):
-                            value = row[i]
-                            # Convertir tipos no serializables a string
-                            if hasattr(value, 'isoformat'):  # datetime objects
-                                value = value.isoformat()
-                            elif isinstance(value, bytes):
-                                value = value.decode('utf-8', errors='replace')
-                            row_dict[col] = value
-                        formatted_results.append(row_dict)
-                    
-                    print(f"INFO:app.tools.mysql_tool:Consulta exitosa. {len(formatted_results)} filas retornadas")
-                    
-                    return {
-                        "success": True,
-                        "data": formatted_results,
-                        "row_count": len(formatted_results)
-                    }
-                else:
-                    return {
-                        "success": True,
-                        "data": [],
-                        "message": "Consulta ejecutada exitosamente sin resultados"
-                    }
-                    
-            except Exception as e:
-                await session.rollback()
-                error_msg = f"Error ejecutando consulta SQL: {str(e)}"
-                print(f"ERROR:app.tools.mysql_tool:{error_msg}")
-                print(f"ERROR:app.tools.mysql_tool:Consulta problemática: {query}")
-                
-                return {
-                    "success": False,
-                    "error": error_msg,
-                    "data": []
-                }
\ No newline at end of file
+            return {
+                "success": False,
+                "error": error_msg,
+                "rows": []
+            }
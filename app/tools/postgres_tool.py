@@ -1,17 +1,86 @@
 # app/tools/postgres_tool.py
-import json
-from typing import Dict, Any, Optional
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import text as sa_text
-
-# Asume que BaseTool está definida así o similar en app/tools/base_tool.py
-# Si no la tienes, te la proporciono al final.
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
+
+from sqlalchemy.engine import make_url
+
+from app.core import jsonutil
+from app.core.config import settings
+from app.core.process_local import ProcessLocal
+from app.services.query_log import QueryTrace, query_log
 from app.tools.base_tool import BaseTool
+from app.tools.sql_result import postgres_converters, convert_rows, capped_result, tabular_result, ColumnConverter
+from app.tools.sql_rewriter import (
+    AnalyzedQuery, Catalog, StarColumns, UnsafeQueryError, analyze_sql, rewrite_sql, schema_catalog, star_columns_for
+)
+
+_CATALOG_QUERY = (
+    "SELECT table_name, column_name, data_type FROM information_schema.columns "
+    "WHERE table_schema = ANY(current_schemas(false)) ORDER BY table_name, ordinal_position"
+)
+
+
+def _asyncpg_dsn(db_url: str) -> str:
+    """'postgresql+asyncpg://...' (formato SQLAlchemy) -> 'postgresql://...' (formato asyncpg/libpq)."""
+    return make_url(db_url).set(drivername="postgresql").render_as_string(hide_password=False)
+
+
+class _PoolHolder:
+    """Pool asyncpg por DSN, creado la primera vez que se usa (un pool por proceso, ver ProcessLocal)."""
+
+    def __init__(self):
+        self.pools: Dict[str, Any] = {}
+        self.lock = asyncio.Lock()
+
+
+_pools: ProcessLocal[_PoolHolder] = ProcessLocal(_PoolHolder)
+
+
+async def create_postgres_pool(db_url: str, max_size: int = settings.POSTGRES_TOOL_POOL_MAX_SIZE):
+    import asyncpg # Import perezoso: solo hace falta con BDs PostgreSQL
+
+    return await asyncpg.create_pool(
+        _asyncpg_dsn(db_url),
+        min_size=min(settings.POSTGRES_TOOL_POOL_MIN_SIZE, max_size),
+        max_size=max_size,
+        statement_cache_size=settings.POSTGRES_TOOL_STATEMENT_CACHE_SIZE,
+        max_inactive_connection_lifetime=300,
+        server_settings={
+            "application_name": "chatbot-postgres-tool",
+            # El servidor corta las consultas que se pasen del límite (también si el cliente desaparece)
+            "statement_timeout": str(settings.SQL_TOOL_STATEMENT_TIMEOUT_MS),
+        },
+    )
+
+
+async def get_postgres_pool(db_url: str):
+    holder = _pools.get()
+    dsn = _asyncpg_dsn(db_url)
+    pool = holder.pools.get(dsn)
+    if pool is not None:
+        return pool
+    async with holder.lock:
+        pool = holder.pools.get(dsn)
+        if pool is None:
+            pool = await create_postgres_pool(db_url)
+            holder.pools[dsn] = pool
+    return pool
+
+
+async def close_postgres_pools() -> None:
+    holder = _pools.peek()
+    if holder is None:
+        return
+    pools = list(holder.pools.values())
+    holder.pools.clear()
+    await asyncio.gather(*(pool.close() for pool in pools), return_exceptions=True)
+
 
 class PostgresTool(BaseTool):
     # La clase BaseTool requiere que estas propiedades sean definidas
-    name: str = "postgres_query_tool" 
+    name: str = "postgres_query_tool"
     description: str = "Ejecuta una consulta SQL SELECT contra la base de datos PostgreSQL externa para obtener información de la base de datos."
     parameters: Dict[str, Any] = {
         "type": "object",
@@ -23,45 +92,134 @@ class PostgresTool(BaseTool):
         },
         "required": ["query"]
     }
+    # Para el prompt de sistema del LLM: motor y cómo consultar las columnas de una tabla con esta tool
+    # (DESCRIBE y SHOW no existen en PostgreSQL)
+    engine: str = "PostgreSQL"
+    schema_lookup: str = (
+        "`SELECT column_name, data_type FROM information_schema.columns "
+        "WHERE table_schema = ANY(current_schemas(false)) AND table_name = 'table_name' ORDER BY ordinal_position;`"
+    )
 
-    def __init__(self, db_url: str):
+    # Columnas y conversores por (BD, texto de consulta), compartidos por todas las instancias: con un
+    # acierto la consulta va directa a la caché de sentencias preparadas de asyncpg, sin pedir los metadatos.
+    _result_shapes: "OrderedDict[Tuple[str, str], Tuple[List[str], List[Optional[ColumnConverter]]]]" = OrderedDict()
+
+    def __init__(self, db_url: str, max_connections: Optional[int] = None):
         self.db_url = db_url # Guardamos la URL para propósitos de logging si es necesario
-        self.engine = create_async_engine(db_url)
-        self.AsyncSessionLocal = sessionmaker(
-            self.engine, expire_on_commit=False, class_=AsyncSession
-        )
+        self.database_name = make_url(db_url).database or "nilo_db"
+        # Con max_connections la tool tiene su propio pool acotado (BD de un tenant), que se cierra con close()
+        self.max_connections = max_connections
+        self._own_pool = None
+        self._own_pool_lock = asyncio.Lock()
         print(f"INFO:app.tools.postgres_tool:PostgresTool inicializado para DB: {db_url.split('@')[-1]}")
 
+    @classmethod
+    def _remember_shape(cls, key: Tuple[str, str], shape: Tuple[List[str], List[Optional[ColumnConverter]]]) -> None:
+        cls._result_shapes[key] = shape
+        cls._result_shapes.move_to_end(key)
+        while len(cls._result_shapes) > settings.POSTGRES_TOOL_STATEMENT_CACHE_SIZE:
+            cls._result_shapes.popitem(last=False)
+
+    async def _get_pool(self):
+        if self.max_connections is None:
+            return await get_postgres_pool(self.db_url)
+        if self._own_pool is None:
+            async with self._own_pool_lock:
+                if self._own_pool is None:
+                    self._own_pool = await create_postgres_pool(self.db_url, max_size=self.max_connections)
+        return self._own_pool
+
+    async def close(self) -> None:
+        pool, self._own_pool = self._own_pool, None
+        if pool is not None:
+            await pool.close()
+
+    async def _load_catalog(self) -> Catalog:
+        pool = await self._get_pool()
+        catalog: Catalog = {}
+        for table, column, data_type in await pool.fetch(_CATALOG_QUERY):
+            catalog.setdefault(table.lower(), []).append((column, data_type))
+        return catalog
+
+    async def _star_columns(self, analyzed: AnalyzedQuery) -> StarColumns:
+        """Columnas del catálogo para expandir los `SELECT *` de la consulta (vacío si no hay o falla)."""
+        if not analyzed.has_star or not settings.SQL_REWRITE_EXPAND_STAR:
+            return ()
+        try:
+            catalog = await schema_catalog.get(self.db_url, self._load_catalog)
+        except Exception as e:
+            print(f"WARNING:app.tools.postgres_tool:No se pudo leer el catálogo de columnas: {e}")
+            return ()
+        return star_columns_for(analyzed, catalog)
+
+    async def _execute_query(self, conn, query: str, trace: Optional[QueryTrace] = None) -> Dict[str, Any]:
+        max_rows = settings.SQL_TOOL_MAX_ROWS
+        shape_key = (self.db_url, query)
+        shape = self._result_shapes.get(shape_key)
+        # Transacción de solo lectura: el servidor rechaza cualquier escritura aunque pase la validación
+        async with conn.transaction(readonly=True):
+            if shape is None:
+                statement = await conn.prepare(query)
+                attributes = statement.get_attributes()
+                shape = ([attribute.name for attribute in attributes], postgres_converters(attributes))
+                self._remember_shape(shape_key, shape)
+                cursor = await statement.cursor()
+            else:
+                cursor = await conn.cursor(query) # Usa la sentencia preparada cacheada en la conexión
+            # Solo se traen del servidor las filas que caben en el límite (+1 para saber si hay más)
+            records = await cursor.fetch(max_rows + 1)
+
+        column_names, converters = shape
+        if not column_names:
+            return tabular_result([], [], message="Consulta ejecutada exitosamente sin resultados")
+        more_rows = len(records) > max_rows
+        rows = convert_rows(records[:max_rows], converters)
+        print(f"INFO:app.tools.postgres_tool:Consulta exitosa. {len(rows)} filas retornadas")
+        return capped_result(column_names, rows, more_rows, trace)
+
+    async def explain(self, sql: str) -> Dict[str, Any]:
+        """Plan de ejecución (EXPLAIN en JSON, sin ejecutar la consulta) para el asesor de índices."""
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction(readonly=True):
+                plan = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {sql}")
+        if isinstance(plan, str):
+            plan = jsonutil.loads(plan)
+        return {"format": "postgres", "plan": plan}
+
     async def run(self, query: str) -> Dict[str, Any]:
         """
         Ejecuta una consulta SQL contra la base de datos PostgreSQL.
-        Solo se permiten consultas SELECT.
+        Solo se permiten consultas de lectura (SELECT, también UNION; ver sql_rewriter).
         """
-        # Validación de seguridad: solo permitir SELECT
-        if not query.strip().upper().startswith("SELECT"):
-            return {"error": "Solo se permiten consultas SELECT por razones de seguridad."}
-
-        async with self.AsyncSessionLocal() as session:
-            try:
-                # Ejecutar la consulta
-                result = await session.execute(sa_text(query))
-                
-                # Obtener nombres de columnas
-                column_names = list(result.keys())
-                
-                # Obtener todas las filas
-                rows = result.fetchall()
-                
-                # Formatear resultados como una lista de diccionarios
-                formatted_results = []
-                for row in rows:
-                    formatted_results.append({col: row[i] for i, col in enumerate(column_names)})
-                
-                print(f"DEBUG:app.tools.postgres_tool:Consulta SQL ejecutada: {query}")
-                print(f"DEBUG:app.tools.postgres_tool:Resultados: {json.dumps(formatted_results, indent=2)}")
-
-                return {"success": True, "data": formatted_results}
-            except Exception as e:
-                await session.rollback() # Revertir la transacción en caso de error
-                print(f"ERROR:app.tools.postgres_tool:Error al ejecutar la consulta SQL '{query}': {e}")
-                return {"success": False, "error": f"Error al ejecutar la consulta SQL: {str(e)}"}
\ No newline at end of file
+        trace = QueryTrace(query)
+        started = time.perf_counter()
+        result = await self._run(query, trace)
+        query_log.record(self.name, self.db_url.split("@")[-1], trace, result, (time.perf_counter() - started) * 1000)
+        return result
+
+    async def _run(self, query: str, trace: QueryTrace) -> Dict[str, Any]:
+        # Validación sobre el AST (y, además, la transacción de solo lectura en el servidor)
+        try:
+            analyzed = analyze_sql(query, "postgres")
+        except UnsafeQueryError as e:
+            trace.source = "rejected"
+            print(f"WARNING:app.tools.postgres_tool:Consulta rechazada: {e}")
+            return {"success": False, "error": str(e), "rows": []}
+        trace.analyzed = analyzed
+
+        sql = query
+        try:
+            star_columns = await self._star_columns(analyzed)
+            # +1 fila para saber si el resultado se recortó (ver capped_result)
+            sql = trace.sql = rewrite_sql(analyzed, settings.SQL_TOOL_MAX_ROWS + 1, star_columns)
+            pool = await self._get_pool()
+            async with pool.acquire() as conn:
+                return await self._execute_query(conn, sql, trace)
+        except Exception as e:
+            # Si el esquema cambió, la forma cacheada ya no vale: se vuelve a preparar en la próxima llamada
+            self._result_shapes.pop((self.db_url, sql), None)
+            if analyzed.has_star:
+                schema_catalog.invalidate(self.db_url)
+            print(f"ERROR:app.tools.postgres_tool:Error al ejecutar la consulta SQL '{query}': {e}")
+            return {"success": False, "error": f"Error al ejecutar la consulta SQL: {str(e)}", "rows": []}
@@ -0,0 +1,41 @@
+# app/tools/registry.py
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy.engine import make_url
+
+from app.tools.base_tool import BaseTool
+
+# Tool SQL por motor de la URL (backend de SQLAlchemy): "mysql+aiomysql://..." -> MySQLTool,
+# "postgresql+asyncpg://..." -> PostgresTool. Ambas devuelven el mismo contrato de resultado
+# (ver app/tools/sql_result.py) y comparten pools por proceso.
+
+
+def _mysql_tool(db_url: str, replica_urls: Optional[List[str]], max_connections: Optional[int]) -> BaseTool:
+    from app.tools.mysql_tool import MySQLTool
+    return MySQLTool(db_url=db_url, replica_urls=replica_urls, max_connections=max_connections)
+
+
+def _postgres_tool(db_url: str, replica_urls: Optional[List[str]], max_connections: Optional[int]) -> BaseTool:
+    from app.tools.postgres_tool import PostgresTool
+    return PostgresTool(db_url=db_url, max_connections=max_connections)
+
+
+SQL_TOOL_FACTORIES: Dict[str, Callable[[str, Optional[List[str]], Optional[int]], BaseTool]] = {
+    "mysql": _mysql_tool,
+    "mariadb": _mysql_tool,
+    "postgresql": _postgres_tool,
+}
+
+
+def create_sql_tool(
+    db_url: str, replica_urls: Optional[List[str]] = None, max_connections: Optional[int] = None
+) -> BaseTool:
+    """
+    Instancia la tool SQL que corresponde al motor de `db_url`. Sin `max_connections` usa los pools
+    compartidos del proceso; con él, la tool crea los suyos con ese tope y hay que cerrarla (close()).
+    """
+    backend = make_url(db_url).get_backend_name()
+    factory = SQL_TOOL_FACTORIES.get(backend)
+    if factory is None:
+        raise ValueError(f"No hay tool SQL registrada para el motor '{backend}'.")
+    return factory(db_url, replica_urls, max_connections)
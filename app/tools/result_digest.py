@@ -0,0 +1,41 @@
+# app/tools/result_digest.py
+from typing import Any, Dict, Optional
+
+from app.core import jsonutil
+from app.core.config import settings
+
+
+def digest_tool_response(response: Any, summary: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Resumen compacto de la respuesta de una tool (`{"content": <resultado>}`) para el historial del LLM:
+    columnas, número de filas, las primeras HISTORY_DIGEST_SAMPLE_ROWS filas y, si se conoce, el
+    resumen que el asistente dio de ese resultado. Conserva la forma `{"content": ...}`.
+    """
+    content = response.get("content") if isinstance(response, dict) else response
+    digest: Dict[str, Any] = {"compacted": True}
+
+    if isinstance(content, dict):
+        if "success" in content:
+            digest["success"] = content["success"]
+        if content.get("error"):
+            digest["error"] = content["error"]
+        data = content.get("data") # Formato anterior a sql_result: lista de dicts
+        if isinstance(content.get("rows"), list):
+            digest["columns"] = content.get("columns", [])
+            digest["row_count"] = content.get("row_count", len(content["rows"]))
+            digest["sample_rows"] = content["rows"][:settings.HISTORY_DIGEST_SAMPLE_ROWS]
+            if content.get("message"):
+                digest["message"] = content["message"]
+        elif isinstance(data, list):
+            digest["row_count"] = content.get("row_count", len(data))
+            digest["columns"] = list(data[0].keys()) if data and isinstance(data[0], dict) else []
+            digest["sample_rows"] = data[:settings.HISTORY_DIGEST_SAMPLE_ROWS]
+        elif content.get("message"):
+            digest["message"] = content["message"]
+    else:
+        digest["preview"] = jsonutil.dumps(content)[:settings.MESSAGE_BLOB_PREVIEW_CHARS]
+
+    if summary:
+        digest["assistant_summary"] = summary[:settings.HISTORY_DIGEST_SUMMARY_CHARS]
+    digest["note"] = "Resultado resumido de un turno anterior. Vuelve a ejecutar la consulta si necesitas las filas completas."
+    return {"content": digest}
@@ -0,0 +1,253 @@
+# app/tools/sql_result.py
+import datetime
+import decimal
+import uuid
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, NamedTuple, Optional, Sequence
+
+from pymysql.constants import FIELD_TYPE
+
+from app.core import jsonutil
+from app.core.config import settings
+
+if TYPE_CHECKING:
+    from app.services.query_log import QueryTrace
+
+# Conversión de resultados SQL a tipos JSON, columna a columna: el conversor de cada columna se
+# elige una vez a partir de los metadatos del cursor (no con isinstance/hasattr en cada celda).
+#
+# Cada conversor tiene una vía rápida (un método C aplicado con map() a toda la columna, que lanza
+# TypeError/ValueError ante un NULL o un valor inesperado) y una vía segura, celda a celda, que solo
+# se usa en las columnas donde la rápida falla. `None` como conversor: el valor ya es JSON nativo.
+# Con `dedupe`, las columnas con muchos valores repetidos (fechas, horas) convierten cada valor
+# distinto una sola vez.
+class ColumnConverter(NamedTuple):
+    fast: Optional[Callable[[Any], Any]]
+    safe: Callable[[Any], Any]
+    dedupe: bool = False
+
+
+def _to_iso(value: Any) -> Any:
+    try:
+        return value.isoformat()
+    except AttributeError: # p.ej. '0000-00-00 00:00:00', que el driver deja como str
+        return value
+
+
+def _decimal_to_str(value: Any) -> Any:
+    return str(value) if isinstance(value, decimal.Decimal) else value # Exacto: float perdería precisión
+
+
+def _timedelta_to_str(value: Any) -> Any:
+    # MySQL TIME llega como timedelta (puede ser negativo o superar 24 h): se formatea como [-]HH:MM:SS[.ffffff]
+    if not isinstance(value, datetime.timedelta):
+        return value
+    total = value.days * 86400 + value.seconds
+    micros = value.microseconds
+    sign = ""
+    if total < 0:
+        sign = "-"
+        if micros:
+            total, micros = total + 1, 1_000_000 - micros
+        total = -total
+    hours, rest = divmod(total, 3600)
+    minutes, secs = divmod(rest, 60)
+    if micros:
+        return f"{sign}{hours:02d}:{minutes:02d}:{secs:02d}.{micros:06d}"
+    return f"{sign}{hours:02d}:{minutes:02d}:{secs:02d}"
+
+
+def _bytes_to_str(value: Any) -> Any:
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value).decode("utf-8", errors="replace")
+    return value
+
+
+def _bit_to_int(value: Any) -> Any:
+    if isinstance(value, (bytes, bytearray)):
+        return int.from_bytes(value, "big")
+    return value
+
+
+def _json_to_obj(value: Any) -> Any:
+    try:
+        return jsonutil.loads(value)
+    except (jsonutil.JSONDecodeError, TypeError):
+        return value
+
+
+def _set_to_list(value: Any) -> Any:
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    return value
+
+
+def _to_json_value(value: Any) -> Any:
+    """Conversión genérica (recursiva) para tipos compuestos: arrays, records, rangos, etc."""
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_to_json_value(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): _to_json_value(item) for key, item in value.items()}
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if isinstance(value, datetime.timedelta):
+        return _timedelta_to_str(value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).decode("utf-8", errors="replace")
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    if hasattr(value, "items"): # asyncpg.Record de un tipo compuesto
+        return {str(key): _to_json_value(item) for key, item in value.items()}
+    return str(value) # UUID, inet, rangos, ...
+
+
+DECIMAL = ColumnConverter(decimal.Decimal.__str__, _decimal_to_str)
+DATETIME = ColumnConverter(datetime.datetime.isoformat, _to_iso, dedupe=True)
+DATE = ColumnConverter(datetime.date.isoformat, _to_iso, dedupe=True)
+TIME_OF_DAY = ColumnConverter(datetime.time.isoformat, _to_iso, dedupe=True)
+TIMEDELTA = ColumnConverter(None, _timedelta_to_str, dedupe=True)
+BIT = ColumnConverter(None, _bit_to_int)
+JSON_TEXT = ColumnConverter(jsonutil.loads, _json_to_obj)
+SET = ColumnConverter(None, _set_to_list)
+# Texto o binario según la collation: solo se convierte si la columna trae bytes (ver convert_rows)
+MAYBE_BYTES = ColumnConverter(bytes.decode, _bytes_to_str)
+TO_STR = ColumnConverter(str, str)
+GENERIC = ColumnConverter(None, _to_json_value)
+
+_MYSQL_CONVERTERS: Dict[int, ColumnConverter] = {
+    FIELD_TYPE.DECIMAL: DECIMAL,
+    FIELD_TYPE.NEWDECIMAL: DECIMAL,
+    FIELD_TYPE.DATE: DATE,
+    FIELD_TYPE.NEWDATE: DATE,
+    FIELD_TYPE.DATETIME: DATETIME,
+    FIELD_TYPE.TIMESTAMP: DATETIME,
+    FIELD_TYPE.TIME: TIMEDELTA,
+    FIELD_TYPE.BIT: BIT,
+    FIELD_TYPE.JSON: JSON_TEXT,
+    FIELD_TYPE.SET: SET,
+    FIELD_TYPE.TINY_BLOB: MAYBE_BYTES,
+    FIELD_TYPE.MEDIUM_BLOB: MAYBE_BYTES,
+    FIELD_TYPE.LONG_BLOB: MAYBE_BYTES,
+    FIELD_TYPE.BLOB: MAYBE_BYTES,
+    FIELD_TYPE.VAR_STRING: MAYBE_BYTES,
+    FIELD_TYPE.STRING: MAYBE_BYTES,
+    FIELD_TYPE.VARCHAR: MAYBE_BYTES,
+    FIELD_TYPE.GEOMETRY: MAYBE_BYTES,
+}
+# Enteros, FLOAT/DOUBLE, YEAR, ENUM y NULL ya son tipos JSON
+
+
+def mysql_converters(description: Sequence[Sequence[Any]]) -> List[Optional[ColumnConverter]]:
+    """Un conversor por columna a partir de `cursor.description` (type_code de PyMySQL/aiomysql)."""
+    return [_MYSQL_CONVERTERS.get(column[1]) for column in description]
+
+
+_DEDUPE_SAMPLE = 256
+
+
+# PostgreSQL (asyncpg, protocolo binario): tipos por nombre (pg_type.typname)
+_POSTGRES_CONVERTERS: Dict[str, ColumnConverter] = {
+    "numeric": DECIMAL,
+    "timestamp": DATETIME,
+    "timestamptz": DATETIME,
+    "date": DATE,
+    "time": TIME_OF_DAY,
+    "timetz": TIME_OF_DAY,
+    "interval": TIMEDELTA,
+    "json": JSON_TEXT,
+    "jsonb": JSON_TEXT,
+    "bytea": MAYBE_BYTES,
+    "uuid": ColumnConverter(uuid.UUID.__str__, str, dedupe=True),
+    "inet": TO_STR,
+    "cidr": TO_STR,
+    "macaddr": TO_STR,
+    "bit": TO_STR,
+    "varbit": TO_STR,
+}
+# Enteros, float4/float8, bool, text/varchar/char, money (texto en asyncpg) ya son tipos JSON
+_POSTGRES_NATIVE = {"int2", "int4", "int8", "oid", "float4", "float8", "bool", "text", "varchar", "bpchar", "name", "char", "money"}
+
+
+def postgres_converters(attributes: Sequence[Any]) -> List[Optional[ColumnConverter]]:
+    """Un conversor por columna a partir de `PreparedStatement.get_attributes()` de asyncpg."""
+    converters: List[Optional[ColumnConverter]] = []
+    for attribute in attributes:
+        pg_type = attribute.type
+        if pg_type.name in _POSTGRES_CONVERTERS:
+            converters.append(_POSTGRES_CONVERTERS[pg_type.name])
+        elif pg_type.name in _POSTGRES_NATIVE or pg_type.kind == "enum":
+            converters.append(None)
+        else: # arrays, compuestos, rangos, dominios y tipos de extensiones
+            converters.append(GENERIC)
+    return converters
+
+
+def _convert_column(column: Sequence[Any], converter: Optional[ColumnConverter]) -> Sequence[Any]:
+    if converter is None:
+        return column
+    if converter is MAYBE_BYTES:
+        # Columnas de texto: el driver ya da str salvo con collation binaria; se mira el primer valor no nulo
+        sample = next((value for value in column if value is not None), None)
+        if not isinstance(sample, (bytes, bytearray)):
+            return column
+    # Una muestra decide si merece la pena deduplicar (p.ej. un DATETIME casi siempre distinto no)
+    if converter.dedupe and len(set(column[:_DEDUPE_SAMPLE])) * 2 <= min(len(column), _DEDUPE_SAMPLE):
+        distinct = set(column)
+        if len(distinct) * 2 <= len(column):
+            safe = converter.safe
+            mapping = {value: None if value is None else safe(value) for value in distinct}
+            return list(map(mapping.__getitem__, column))
+    if converter.fast is not None:
+        try:
+            return list(map(converter.fast, column))
+        except (TypeError, ValueError): # NULLs o valores fuera del tipo esperado: vía segura
+            pass
+    safe = converter.safe
+    return [None if value is None else safe(value) for value in column]
+
+
+def convert_rows(rows: Sequence[Sequence[Any]], converters: List[Optional[ColumnConverter]]) -> List[List[Any]]:
+    """Aplica los conversores columna a columna y retorna las filas como listas."""
+    if not rows:
+        return []
+    if all(converter is None for converter in converters):
+        return [list(row) for row in rows]
+    columns = list(zip(*rows))
+    converted = [_convert_column(column, converter) for column, converter in zip(columns, converters)]
+    return [list(row) for row in zip(*converted)]
+
+
+def capped_result(
+    columns: List[str], rows: List[List[Any]], more_rows: bool = False, trace: Optional["QueryTrace"] = None
+) -> Dict[str, Any]:
+    """
+    tabular_result aplicando SQL_TOOL_MAX_RESULT_BYTES (el límite de filas lo aplica cada tool al
+    leer: `more_rows` indica que había más filas que SQL_TOOL_MAX_ROWS). El tamaño medido se deja en
+    `trace.result_bytes` para el registro de consultas, que así no vuelve a serializar las filas.
+    """
+    truncated = more_rows
+    max_bytes = settings.SQL_TOOL_MAX_RESULT_BYTES
+    if max_bytes and rows:
+        size = len(jsonutil.dumps_bytes(rows))
+        if size > max_bytes:
+            kept = max(1, int(len(rows) * max_bytes / size))
+            size = size * kept // len(rows) # Aproximado: proporcional a las filas que quedan
+            rows = rows[:kept]
+            truncated = True
+        if trace is not None:
+            trace.result_bytes = size
+    if truncated:
+        return tabular_result(
+            columns, rows, truncated=True,
+            note="Resultado recortado por tamaño. Usa filtros, agregaciones o LIMIT para acotar la consulta."
+        )
+    return tabular_result(columns, rows)
+
+
+def tabular_result(columns: List[str], rows: List[List[Any]], **extra: Any) -> Dict[str, Any]:
+    """
+    Contrato de resultado de las tools SQL: nombres de columna una sola vez y filas como listas
+    (mucho más compacto que una lista de dicts, tanto en JSON como en tokens del LLM).
+    """
+    return {"success": True, "columns": columns, "rows": rows, "row_count": len(rows), **extra}
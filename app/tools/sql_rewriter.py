@@ -0,0 +1,302 @@
+# app/tools/sql_rewriter.py
+import asyncio
+import hashlib
+import re
+import time
+from functools import lru_cache
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import sqlglot
+from sqlglot import exp
+from sqlglot.errors import ParseError
+
+from app.core.config import settings
+from app.core.process_local import ProcessLocal
+
+# Capa de análisis de las consultas que genera el LLM, delante de las tools SQL:
+#   - valida que sea una sola sentencia de solo lectura (SELECT, UNION/INTERSECT/EXCEPT, DESCRIBE, SHOW)
+#     recorriendo el AST, no con startswith("SELECT"), y sin comentarios ejecutables de MySQL (/*! */),
+#     que sqlglot ignora pero el servidor ejecuta;
+#   - calcula una forma canónica con los literales como `?` y su huella (fingerprint), estables frente a
+#     espacios, mayúsculas y valores concretos: sirven de clave de caché, para agrupar métricas y deduplicar;
+#   - reescribe: añade LIMIT si falta (o lo acota) y expande `SELECT *` a las columnas del catálogo,
+#     descartando las binarias (BLOB, geometrías...) que no aportan nada a una respuesta de chat.
+# Los ASTs se cachean por (texto, dialecto); si no hay nada que reescribir se ejecuta el texto original.
+
+
+class UnsafeQueryError(ValueError):
+    """La consulta no se puede analizar o no es de solo lectura."""
+
+
+def _node_types(*names: str) -> Tuple[type, ...]:
+    # Según la versión de sqlglot algunas clases no existen
+    return tuple(getattr(exp, name) for name in names if hasattr(exp, name))
+
+
+_READ_ONLY_ROOTS = _node_types("Select", "SetOperation", "Union", "Intersect", "Except", "Describe", "Show")
+_FORBIDDEN_NODES = _node_types(
+    "Insert", "Update", "Delete", "Merge", "Copy", "Create", "Drop", "Alter", "TruncateTable", "LoadData",
+    "Command", "Into", "Lock", "Set", "Transaction", "Commit", "Rollback", "Use", "Grant", "Pragma", "Kill",
+)
+# Funciones con efectos secundarios o que bloquean/duermen el servidor
+_FORBIDDEN_FUNCTIONS = {
+    "SLEEP", "BENCHMARK", "GET_LOCK", "RELEASE_LOCK", "RELEASE_ALL_LOCKS", "LOAD_FILE",
+    "PG_SLEEP", "PG_READ_FILE", "PG_READ_BINARY_FILE", "PG_LS_DIR", "PG_TERMINATE_BACKEND",
+    "PG_CANCEL_BACKEND", "PG_ADVISORY_LOCK", "LO_IMPORT", "LO_EXPORT", "DBLINK", "DBLINK_EXEC",
+    "SET_CONFIG", "NEXTVAL", "SETVAL",
+}
+# Comentarios ejecutables de MySQL/MariaDB (/*!50000 ... */, /*M! ... */) e hints del optimizador (/*+ ... */):
+# sqlglot los trata como comentarios normales, pero el servidor ejecuta su contenido
+_EXECUTABLE_COMMENT_RE = re.compile(r"/\*(?:M?!|\+)")
+
+
+class AnalyzedQuery(NamedTuple):
+    query: str # Texto original
+    dialect: str
+    kind: str # "select" | "set_operation" | "describe" | "show"
+    normalized: str # Forma canónica con los literales como `?`
+    fingerprint: str # Huella de `normalized`
+    canonical: str # Forma canónica con los literales: misma consulta salvo formato -> mismo texto
+    tables: Tuple[str, ...] # Tablas base referenciadas (sin los CTEs), en minúsculas
+    has_star: bool
+    has_limit: bool
+    is_aggregate: bool # SELECT con GROUP BY o funciones de agregación en la proyección
+    expression: exp.Expression # AST cacheado: no se modifica (las reescrituras trabajan sobre una copia)
+
+
+def _kind(expression: exp.Expression) -> str:
+    if isinstance(expression, exp.Describe):
+        return "describe"
+    if isinstance(expression, exp.Show):
+        return "show"
+    if isinstance(expression, exp.Select):
+        return "select"
+    return "set_operation"
+
+
+def _function_name(node: exp.Func) -> str:
+    return (node.name if isinstance(node, exp.Anonymous) else node.sql_name()).upper()
+
+
+def _parameterize(node: exp.Expression) -> exp.Expression:
+    if isinstance(node, exp.Literal):
+        return exp.Placeholder()
+    if isinstance(node, exp.In) and node.args.get("expressions"):
+        # IN (1, 2, 3) e IN (4, 5) comparten huella
+        node.set("expressions", [exp.Placeholder()])
+    return node
+
+
+def _is_aggregate(expression: exp.Expression) -> bool:
+    if not isinstance(expression, exp.Select):
+        return False
+    if expression.args.get("group"):
+        return True
+    return any(projection.find(exp.AggFunc) is not None for projection in expression.expressions)
+
+
+def _cte_names(expression: exp.Expression) -> set:
+    return {cte.alias_or_name.lower() for cte in expression.find_all(exp.CTE)}
+
+
+def _base_tables(expression: exp.Expression) -> Tuple[str, ...]:
+    ctes = _cte_names(expression)
+    tables = []
+    for table in expression.find_all(exp.Table):
+        name = table.name.lower()
+        if name and name not in ctes and name not in tables:
+            tables.append(name)
+    return tuple(tables)
+
+
+@lru_cache(maxsize=settings.SQL_PARSE_CACHE_SIZE)
+def analyze_sql(query: str, dialect: str) -> AnalyzedQuery:
+    """Parsea y valida la consulta (ver cabecera). Lanza UnsafeQueryError si no se permite."""
+    if _EXECUTABLE_COMMENT_RE.search(query):
+        raise UnsafeQueryError("La consulta contiene comentarios ejecutables (/*! */) o hints (/*+ */), que no están permitidos.")
+    try:
+        statements = [statement for statement in sqlglot.parse(query, read=dialect) if statement is not None]
+    except ParseError as e:
+        raise UnsafeQueryError(f"No se pudo analizar la consulta SQL: {str(e).splitlines()[0]}") from e
+    if len(statements) != 1:
+        raise UnsafeQueryError("Solo se permite una sentencia SQL por consulta.")
+    expression = statements[0]
+    if not isinstance(expression, _READ_ONLY_ROOTS):
+        raise UnsafeQueryError("Solo se permiten consultas de lectura (SELECT, DESCRIBE, SHOW) por razones de seguridad.")
+    forbidden = expression.find(*_FORBIDDEN_NODES)
+    if forbidden is not None:
+        raise UnsafeQueryError(f"La consulta contiene una operación no permitida ({forbidden.key.upper()}).")
+    for function in expression.find_all(exp.Func):
+        if _function_name(function) in _FORBIDDEN_FUNCTIONS:
+            raise UnsafeQueryError(f"La función {_function_name(function)} no está permitida.")
+
+    normalized = expression.transform(_parameterize).sql(dialect=dialect, normalize=True)
+    is_query = isinstance(expression, exp.Query)
+    return AnalyzedQuery(
+        query=query,
+        dialect=dialect,
+        kind=_kind(expression),
+        normalized=normalized,
+        fingerprint=hashlib.sha1(normalized.encode("utf-8")).hexdigest()[:16],
+        canonical=expression.sql(dialect=dialect, normalize=True),
+        tables=_base_tables(expression),
+        has_star=is_query and any(select.is_star for select in expression.find_all(exp.Select)),
+        has_limit=is_query and expression.args.get("limit") is not None,
+        is_aggregate=_is_aggregate(expression),
+        expression=expression,
+    )
+
+
+# --- Reescritura ---
+
+# (tabla, columnas a las que se expande su `*`), solo de las tablas de la consulta: hashable, para la caché
+StarColumns = Tuple[Tuple[str, Tuple[str, ...]], ...]
+
+
+def _select_sources(select: exp.Select, ctes: set) -> Optional[List[Tuple[str, str, exp.Identifier]]]:
+    """
+    (alias, tabla, identificador) de FROM y JOINs, o None si alguna fuente no es una tabla base
+    expandible. El identificador es el alias o el nombre tal cual se escribió (citado o no).
+    """
+    from_ = select.args.get("from_") or select.args.get("from")
+    if from_ is None:
+        return None
+    sources = [from_.this] + [join.this for join in select.args.get("joins") or []]
+    for join in select.args.get("joins") or []:
+        if join.args.get("using") or join.args.get("method"): # USING/NATURAL fusionan columnas
+            return None
+    result = []
+    for source in sources:
+        if not isinstance(source, exp.Table) or source.args.get("db") or source.name.lower() in ctes:
+            return None
+        identifier = source.args["alias"].this if source.alias else source.this
+        result.append((source.alias_or_name, source.name.lower(), identifier))
+    return result
+
+
+def _expand_stars(expression: exp.Expression, star_columns: Dict[str, Tuple[str, ...]]) -> bool:
+    ctes = _cte_names(expression)
+    changed = False
+    for select in list(expression.find_all(exp.Select)):
+        if not select.is_star or isinstance(select.parent, exp.Exists):
+            continue
+        sources = _select_sources(select, ctes)
+        if not sources:
+            continue
+        qualify = len(sources) > 1
+        projections = []
+        for projection in select.expressions:
+            if isinstance(projection, exp.Star):
+                targets = sources
+            elif isinstance(projection, exp.Column) and isinstance(projection.this, exp.Star):
+                targets = [source for source in sources if source[0].lower() == projection.table.lower()]
+            else:
+                projections.append(projection)
+                continue
+            if not targets or any(not star_columns.get(table) for _, table, _ in targets):
+                projections.append(projection)
+                continue
+            for _, table, identifier in targets:
+                qualifier = identifier.copy() if qualify else None
+                for column in star_columns[table]:
+                    # Citadas: columnas del catálogo como `order`, `key` o `group` son palabras reservadas
+                    projections.append(exp.column(exp.to_identifier(column, quoted=True), table=qualifier))
+            changed = True
+        select.set("expressions", projections)
+    return changed
+
+
+@lru_cache(maxsize=settings.SQL_PARSE_CACHE_SIZE)
+def _rewrite(query: str, dialect: str, limit: Optional[int], star_columns: StarColumns) -> str:
+    analyzed = analyze_sql(query, dialect)
+    if not isinstance(analyzed.expression, exp.Query):
+        return query # DESCRIBE / SHOW
+    expression = analyzed.expression.copy()
+    changed = bool(star_columns) and _expand_stars(expression, dict(star_columns))
+    if limit is not None:
+        current = expression.args.get("limit")
+        current_value = current.expression if isinstance(current, exp.Limit) else None
+        if current is None:
+            expression = expression.limit(limit, copy=False)
+            changed = True
+        elif isinstance(current_value, exp.Literal) and current_value.is_int and int(current_value.name) > limit:
+            current.set("expression", exp.Literal.number(limit))
+            changed = True
+    # Sin cambios se ejecuta el texto original, tal cual lo escribió el modelo
+    return expression.sql(dialect=dialect, comments=False) if changed else query
+
+
+def rewrite_sql(analyzed: AnalyzedQuery, max_rows: Optional[int], star_columns: StarColumns = ()) -> str:
+    """
+    SQL a ejecutar: con LIMIT `max_rows` (si falta o es mayor) y los `*` expandidos a `star_columns`.
+    """
+    limit = max_rows if settings.SQL_REWRITE_INJECT_LIMIT else None
+    if not settings.SQL_REWRITE_EXPAND_STAR:
+        star_columns = ()
+    return _rewrite(analyzed.query, analyzed.dialect, limit, star_columns)
+
+
+# --- Catálogo (columnas por tabla) ---
+
+# tabla (minúsculas) -> [(columna, tipo)]
+Catalog = Dict[str, List[Tuple[str, str]]]
+
+
+def _pruned_types() -> set:
+    return {name.strip().lower() for name in settings.SQL_REWRITE_PRUNED_TYPES.split(",") if name.strip()}
+
+
+class _CatalogState:
+    def __init__(self):
+        self.catalogs: Dict[str, Tuple[float, Catalog]] = {}
+        self.locks: Dict[str, asyncio.Lock] = {}
+
+
+class SchemaCatalog:
+    """Columnas de las tablas de cada BD externa, cacheadas por proceso durante SQL_CATALOG_TTL_SECONDS."""
+
+    def __init__(self, ttl: float = settings.SQL_CATALOG_TTL_SECONDS):
+        self.ttl = ttl
+        self._state: ProcessLocal[_CatalogState] = ProcessLocal(_CatalogState)
+
+    async def get(self, key: str, loader: Callable[[], Awaitable[Catalog]]) -> Catalog:
+        state = self._state.get()
+        cached = state.catalogs.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        lock = state.locks.setdefault(key, asyncio.Lock())
+        async with lock: # Una sola carga por BD aunque lleguen varias consultas a la vez
+            cached = state.catalogs.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                return cached[1]
+            catalog = await loader()
+            now = time.monotonic()
+            # Con muchos tenants no se acumulan catálogos de BDs que ya no se consultan
+            for stale in [other for other, (expires, _) in state.catalogs.items() if expires <= now]:
+                del state.catalogs[stale]
+                if not state.locks[stale].locked():
+                    del state.locks[stale]
+            state.catalogs[key] = (now + self.ttl, catalog)
+            return catalog
+
+    def invalidate(self, key: str) -> None:
+        """Fuerza la recarga (p.ej. si una consulta reescrita falla porque el esquema cambió)."""
+        state = self._state.peek()
+        if state is not None:
+            state.catalogs.pop(key, None)
+
+
+def star_columns_for(analyzed: AnalyzedQuery, catalog: Catalog) -> StarColumns:
+    """Columnas a las que se expande el `*` de cada tabla de la consulta (sin las de tipos descartados)."""
+    pruned = _pruned_types()
+    result = []
+    for table in analyzed.tables:
+        columns = catalog.get(table)
+        if not columns:
+            continue
+        kept = tuple(name for name, data_type in columns if data_type.lower() not in pruned)
+        result.append((table, kept or tuple(name for name, _ in columns)))
+    return tuple(result)
+
+
+schema_catalog = SchemaCatalog()
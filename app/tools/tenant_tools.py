@@ -0,0 +1,270 @@
+# app/tools/tenant_tools.py
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, NamedTuple, Optional, Set, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core import jsonutil
+from app.core.config import settings
+from app.core.process_local import ProcessLocal
+from app.crud import crud_tenant
+from app.db.replica_router import parse_url_list
+from app.tools.base_tool import BaseTool
+from app.tools.registry import create_sql_tool
+
+
+class TenantNotFoundError(Exception):
+    """La sesión indica un tenant que no existe o está desactivado."""
+
+
+def tenant_id_from_session_data(session_data: Any) -> Optional[str]:
+    """`tenant_id` de la metadata de una sesión (JSON en texto o ya decodificada), o None."""
+    if isinstance(session_data, (str, bytes)):
+        try:
+            session_data = jsonutil.loads(session_data)
+        except jsonutil.JSONDecodeError:
+            return None
+    if isinstance(session_data, dict) and session_data.get("tenant_id"):
+        return str(session_data["tenant_id"])
+    return None
+
+
+class _TenantConfig(NamedTuple):
+    db_url: str
+    replica_urls: Tuple[str, ...]
+    max_connections: int
+
+
+class _TenantEntry:
+    """Tool de un tenant con sus pools, y cuántos turnos la están usando."""
+
+    def __init__(self, tenant_id: str, config: _TenantConfig, tool: BaseTool):
+        self.tenant_id = tenant_id
+        self.config = config
+        self.tool = tool
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.in_use = 0
+        self.retired = False # Fuera de la caché: se cierra al soltarla el último turno
+
+    @property
+    def label(self) -> str:
+        # Nunca exponer credenciales en logs/estadísticas
+        return self.config.db_url.split("@")[-1]
+
+
+class _CacheState:
+    def __init__(self):
+        self.entries: "OrderedDict[str, _TenantEntry]" = OrderedDict()
+        # tenant_id -> (caduca, configuración o None si no existe); evita consultar tenants en cada turno
+        self.configs: Dict[str, Tuple[float, Optional[_TenantConfig]]] = {}
+        self.closing: Set[asyncio.Task] = set()
+        self.lock = asyncio.Lock()
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "tools_created": 0,
+            "evicted_lru": 0,
+            "evicted_idle": 0,
+            "evicted_config_change": 0,
+            "closed": 0,
+            "close_errors": 0,
+            "config_lookups": 0,
+        }
+
+
+class TenantToolCache:
+    """
+    Tools SQL por tenant (cada una con sus engines/pools) en una LRU acotada por proceso.
+
+    - Como mucho `max_entries` tenants con pools abiertos: al superarlo se cierra el usado hace más tiempo.
+    - Un barrido periódico cierra los que llevan `idle_seconds` sin uso.
+    - Los pools de cada tenant tienen un tope de conexiones (tenants.max_connections o
+      TENANT_DB_MAX_CONNECTIONS), así que miles de tenants no abren miles de pools completos.
+    - Una tool en uso por un turno nunca se cierra debajo de él: si sale de la caché, se cierra al soltarla.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = settings.TENANT_POOL_CACHE_SIZE,
+        idle_seconds: float = settings.TENANT_POOL_IDLE_SECONDS,
+        sweep_interval: float = settings.TENANT_POOL_SWEEP_INTERVAL,
+        config_ttl: float = settings.TENANT_CONFIG_TTL_SECONDS,
+    ):
+        self.max_entries = max(1, max_entries)
+        self.idle_seconds = idle_seconds
+        self.sweep_interval = sweep_interval
+        self.config_ttl = config_ttl
+        self._state: ProcessLocal[_CacheState] = ProcessLocal(_CacheState)
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        """Detiene el barrido y cierra todos los pools de tenants de este proceso."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        state = self._state.peek()
+        if state is None:
+            return
+        for entry in list(state.entries.values()):
+            entry.in_use = 0 # En el apagado no quedan turnos a los que esperar
+            self._retire(state, entry, None)
+        await asyncio.gather(*state.closing, return_exceptions=True)
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                self.sweep_idle()
+            except Exception as e:
+                print(f"ERROR:app.tools.tenant_tools:Error en el barrido de pools de tenants: {e}")
+
+    # --- Resolución ---
+
+    async def _get_config(self, db: AsyncSession, tenant_id: str) -> _TenantConfig:
+        state = self._state.get()
+        now = time.monotonic()
+        cached = state.configs.get(tenant_id)
+        if cached is not None and cached[0] > now:
+            config = cached[1]
+        else:
+            state.counters["config_lookups"] += 1
+            tenant = await crud_tenant.get_tenant(db, tenant_id)
+            config = None
+            if tenant is not None:
+                config = _TenantConfig(
+                    tenant.db_url,
+                    tuple(parse_url_list(tenant.replica_urls or "")),
+                    tenant.max_connections or settings.TENANT_DB_MAX_CONNECTIONS,
+                )
+            state.configs[tenant_id] = (now + self.config_ttl, config)
+        if config is None:
+            raise TenantNotFoundError(f"El tenant '{tenant_id}' no existe o está desactivado.")
+        return config
+
+    @asynccontextmanager
+    async def lease(self, db: AsyncSession, tenant_id: str) -> AsyncIterator[BaseTool]:
+        """Tool SQL del tenant para la duración de un turno (se crea si no está en la caché)."""
+        config = await self._get_config(db, tenant_id)
+        state = self._state.get()
+        async with state.lock:
+            entry = state.entries.get(tenant_id)
+            if entry is not None and entry.config != config:
+                # URL, réplicas o tope cambiados en la tabla tenants: la tool anterior se descarta
+                self._retire(state, entry, "evicted_config_change")
+                entry = None
+            if entry is None:
+                state.counters["misses"] += 1
+                tool = create_sql_tool(config.db_url, list(config.replica_urls), max_connections=config.max_connections)
+                state.counters["tools_created"] += 1
+                entry = _TenantEntry(tenant_id, config, tool)
+                state.entries[tenant_id] = entry
+                print(f"INFO:app.tools.tenant_tools:Pools creados para el tenant {tenant_id} ({entry.label}), "
+                      f"máx. {config.max_connections} conexiones")
+                while len(state.entries) > self.max_entries:
+                    _, oldest = next(iter(state.entries.items()))
+                    self._retire(state, oldest, "evicted_lru")
+            else:
+                state.counters["hits"] += 1
+                state.entries.move_to_end(tenant_id)
+            entry.in_use += 1
+            entry.last_used = time.monotonic()
+        try:
+            yield entry.tool
+        finally:
+            entry.in_use -= 1
+            entry.last_used = time.monotonic()
+            if entry.retired and entry.in_use == 0:
+                self._schedule_close(state, entry)
+
+    # --- Expulsión y cierre ---
+
+    def _retire(self, state: _CacheState, entry: _TenantEntry, reason: Optional[str]) -> None:
+        if state.entries.get(entry.tenant_id) is entry:
+            del state.entries[entry.tenant_id]
+        if entry.retired:
+            return
+        entry.retired = True
+        if reason is not None:
+            state.counters[reason] += 1
+        if entry.in_use == 0:
+            self._schedule_close(state, entry)
+
+    def _schedule_close(self, state: _CacheState, entry: _TenantEntry) -> None:
+        task = asyncio.create_task(self._close(state, entry))
+        state.closing.add(task)
+        task.add_done_callback(state.closing.discard)
+
+    async def _close(self, state: _CacheState, entry: _TenantEntry) -> None:
+        try:
+            await entry.tool.close()
+            state.counters["closed"] += 1
+            print(f"INFO:app.tools.tenant_tools:Pools del tenant {entry.tenant_id} cerrados")
+        except Exception as e:
+            state.counters["close_errors"] += 1
+            print(f"ERROR:app.tools.tenant_tools:Error cerrando los pools del tenant {entry.tenant_id}: {e}")
+
+    def sweep_idle(self) -> int:
+        """Cierra los pools de tenants sin uso desde hace más de `idle_seconds`. Retorna cuántos."""
+        state = self._state.peek()
+        if state is None:
+            return 0
+        now = time.monotonic()
+        idle = [
+            entry for entry in state.entries.values()
+            if entry.in_use == 0 and now - entry.last_used > self.idle_seconds
+        ]
+        for entry in idle:
+            self._retire(state, entry, "evicted_idle")
+        # Las configuraciones caducadas (incluidos tenants inexistentes) no se guardan indefinidamente
+        for tenant_id in [key for key, (expires, _) in state.configs.items() if expires <= now]:
+            del state.configs[tenant_id]
+        return len(idle)
+
+    def stats(self) -> Dict[str, Any]:
+        state = self._state.peek() or _CacheState()
+        now = time.monotonic()
+        lookups = state.counters["hits"] + state.counters["misses"]
+        return {
+            **state.counters,
+            "hit_ratio": round(state.counters["hits"] / lookups, 4) if lookups else None,
+            "cached_tenants": len(state.entries),
+            "max_entries": self.max_entries,
+            "closing": len(state.closing),
+            "tenants": [
+                {
+                    "tenant_id": entry.tenant_id,
+                    "target": entry.label,
+                    "max_connections": entry.config.max_connections,
+                    "in_use": entry.in_use,
+                    "idle_seconds": round(now - entry.last_used, 1),
+                    "age_seconds": round(now - entry.created_at, 1),
+                }
+                for entry in reversed(state.entries.values())
+            ],
+        }
+
+
+tenant_tool_cache = TenantToolCache()
+
+
+@asynccontextmanager
+async def sql_tool_for(db: AsyncSession, tenant_id: Optional[str]) -> AsyncIterator[BaseTool]:
+    """
+    Tool SQL de la BD de un tenant (pools en la LRU de tenant_tool_cache) o, sin tenant, la de
+    EXTERNAL_DB_URL con los pools compartidos del proceso.
+    """
+    if tenant_id is None:
+        # Tool SQL según el motor de la BD externa (MySQLTool o PostgresTool, ver app/tools/registry.py)
+        yield create_sql_tool(settings.EXTERNAL_DB_URL)
+        return
+    async with tenant_tool_cache.lease(db, tenant_id) as tool:
+        yield tool
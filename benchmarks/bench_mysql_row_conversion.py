@@ -0,0 +1,147 @@
+# benchmarks/bench_mysql_row_conversion.py
+"""
+Conversión de filas de MySQLTool: bucle celda a celda anterior (hasattr/isinstance por valor, filas
+como dicts) frente a los conversores por columna de app/tools/sql_result.py.
+
+Las filas se generan con los tipos Python que devuelve aiomysql para cada tipo de columna.
+
+Se comparan dos líneas base, y el factor de mejora depende de cuál se tome:
+- "anterior": el bucle tal como estaba, que deja Decimal y TIME sin convertir (Decimal rompía json.dumps).
+  Es la comparación con el código previo: del orden de x2.
+- "anterior, con Decimal/TIME": el mismo bucle corrigiendo esas conversiones, es decir, lo que costaría
+  arreglar el bug sin cambiar de enfoque: del orden de x3.
+Las cifras absolutas dependen de la máquina; solo los cocientes son comparables entre ejecuciones.
+
+Uso (desde la raíz del repo):
+    python -m benchmarks.bench_mysql_row_conversion --rows 20000 --repeat 10
+"""
+import argparse
+import datetime
+import decimal
+import gc
+import statistics
+import time
+
+from pymysql.constants import FIELD_TYPE
+
+from app.core import jsonutil
+from app.tools.sql_result import convert_rows, mysql_converters, tabular_result
+
+# (nombre, type_code) como en cursor.description
+DESCRIPTION = [
+    ("id", FIELD_TYPE.LONG),
+    ("name", FIELD_TYPE.VAR_STRING),
+    ("price", FIELD_TYPE.NEWDECIMAL),
+    ("quantity", FIELD_TYPE.LONG),
+    ("created_at", FIELD_TYPE.DATETIME),
+    ("due_date", FIELD_TYPE.DATE),
+    ("open_time", FIELD_TYPE.TIME),
+    ("ratio", FIELD_TYPE.DOUBLE),
+    ("status", FIELD_TYPE.VAR_STRING),
+    ("notes", FIELD_TYPE.BLOB),
+]
+
+
+def build_rows(count: int):
+    base = datetime.datetime(2024, 1, 1, 8, 0, 0)
+    return [
+        (
+            i,
+            f"Producto {i}",
+            decimal.Decimal(i) / decimal.Decimal(7),
+            i % 500,
+            base + datetime.timedelta(minutes=i),
+            (base + datetime.timedelta(days=i % 365)).date(),
+            datetime.timedelta(hours=8, minutes=i % 60),
+            i / 3,
+            "activo" if i % 2 else "inactivo",
+            None if i % 3 else f"nota {i}",
+        )
+        for i in range(count)
+    ]
+
+
+def old_conversion(column_names, rows):
+    """Copia del bucle anterior de MySQLTool._execute_query."""
+    formatted_results = []
+    for row in rows:
+        row_dict = {}
+        for i, col in enumerate(column_names):
+            value = row[i]
+            if hasattr(value, 'isoformat'):
+                value = value.isoformat()
+            elif isinstance(value, bytes):
+                value = value.decode('utf-8', errors='replace')
+            row_dict[col] = value
+        formatted_results.append(row_dict)
+    return {"success": True, "data": formatted_results, "row_count": len(formatted_results)}
+
+
+def old_conversion_fixed(column_names, rows):
+    """El mismo bucle celda a celda, completado para que Decimal y TIME (timedelta) sean serializables."""
+    formatted_results = []
+    for row in rows:
+        row_dict = {}
+        for i, col in enumerate(column_names):
+            value = row[i]
+            if hasattr(value, 'isoformat'):
+                value = value.isoformat()
+            elif isinstance(value, bytes):
+                value = value.decode('utf-8', errors='replace')
+            elif isinstance(value, decimal.Decimal):
+                value = str(value)
+            elif isinstance(value, datetime.timedelta):
+                value = str(value)
+            row_dict[col] = value
+        formatted_results.append(row_dict)
+    return {"success": True, "data": formatted_results, "row_count": len(formatted_results)}
+
+
+def new_conversion(column_names, rows):
+    return tabular_result(column_names, convert_rows(rows, mysql_converters(DESCRIPTION)))
+
+
+def _measure(fn, repeat: int):
+    timings = []
+    gc.disable() # Como timeit: el GC cíclico añade ruido proporcional a las asignaciones
+    try:
+        for _ in range(repeat):
+            started = time.process_time()
+            fn()
+            timings.append(time.process_time() - started)
+    finally:
+        gc.enable()
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    column_names = [name for name, _ in DESCRIPTION]
+    rows = build_rows(args.rows)
+
+    old = _measure(lambda: old_conversion(column_names, rows), args.repeat)
+    old_fixed = _measure(lambda: old_conversion_fixed(column_names, rows), args.repeat)
+    new = _measure(lambda: new_conversion(column_names, rows), args.repeat)
+
+    try:
+        jsonutil.dumps(old_conversion(column_names, rows[:10]))
+        old_serializable = "sí (con jsonutil)"
+    except TypeError:
+        old_serializable = "no"
+    old_bytes = len(jsonutil.dumps_bytes(old_conversion(column_names, rows)))
+    new_bytes = len(jsonutil.dumps_bytes(new_conversion(column_names, rows)))
+
+    print(f"{args.rows} filas x {len(DESCRIPTION)} columnas")
+    print(f"  celda a celda (anterior, Decimal/TIME sin convertir): {old * 1000:8.1f} ms CPU  (x{old / new:.1f} frente al código previo)")
+    print(f"  celda a celda (anterior, con Decimal/TIME):          {old_fixed * 1000:8.1f} ms CPU  (x{old_fixed / new:.1f} frente al bucle corregido)")
+    print(f"  por columna (sql_result):                            {new * 1000:8.1f} ms CPU")
+    print(f"  JSON del resultado: {old_bytes / 1024:.0f} KiB -> {new_bytes / 1024:.0f} KiB")
+    print(f"  Decimal con el bucle anterior serializable: {old_serializable}; con json estándar fallaba (TypeError)")
+
+
+if __name__ == "__main__":
+    main()
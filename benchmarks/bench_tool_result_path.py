@@ -0,0 +1,94 @@
+# benchmarks/bench_tool_result_path.py
+"""
+Coste de CPU por turno del camino del resultado de una tool, antes y después de serializar una sola vez.
+
+Antes:   execute_tool json.dumps -> orquestador json.loads -> BD json.dumps -> siguiente turno json.loads
+         (+ los volcados de depuración con indent=2 del historial y del resultado)
+Después: BD jsonutil.dumps (una vez) -> siguiente turno jsonutil.loads
+
+Uso (desde la raíz del repo):
+    python -m benchmarks.bench_tool_result_path --rows 5000 --cols 12 --repeat 20
+"""
+import argparse
+import datetime
+import decimal
+import json
+import statistics
+import time
+
+from app.core import jsonutil
+
+
+def build_result(rows: int, cols: int):
+    """Resultado con la forma que devuelve MySQLTool (filas como dicts, ya convertidas a tipos JSON)."""
+    base = datetime.datetime(2024, 1, 1)
+    data = []
+    for r in range(rows):
+        row = {}
+        for c in range(cols):
+            kind = c % 4
+            if kind == 0:
+                row[f"col_{c}"] = r * cols + c
+            elif kind == 1:
+                row[f"col_{c}"] = f"valor número {r}-{c}"
+            elif kind == 2:
+                row[f"col_{c}"] = str(decimal.Decimal(r) / 7)
+            else:
+                row[f"col_{c}"] = (base + datetime.timedelta(minutes=r)).isoformat()
+        data.append(row)
+    return {"success": True, "data": data, "row_count": rows}
+
+
+def old_path(result, debug_logging: bool):
+    tool_json = json.dumps(result)                              # execute_tool
+    content = json.loads(tool_json)                             # handle_user_message
+    parts = [{"function_response": {"name": "mysql_tool", "response": {"content": content}}}]
+    if debug_logging:
+        json.dumps(parts, indent=2)                             # volcado de depuración del resultado
+    stored = json.dumps(parts)                                  # create_chat_message
+    loaded = json.loads(stored)                                 # _load_conversation_history (siguiente turno)
+    if debug_logging:
+        json.dumps(loaded, indent=2)                            # volcado de depuración del historial
+    return loaded
+
+
+def new_path(result):
+    parts = [{"function_response": {"name": "mysql_tool", "response": {"content": result}}}]
+    stored = jsonutil.dumps(parts)                              # create_chat_message (única serialización)
+    return jsonutil.loads(stored)                               # _load_conversation_history (siguiente turno)
+
+
+def _measure(fn, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        started = time.process_time()
+        fn()
+        timings.append(time.process_time() - started)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--cols", type=int, default=12)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    result = build_result(args.rows, args.cols)
+    payload_bytes = len(jsonutil.dumps_bytes(result))
+    assert old_path(result, False) == new_path(result)
+
+    old_debug = _measure(lambda: old_path(result, True), args.repeat)
+    old = _measure(lambda: old_path(result, False), args.repeat)
+    new = _measure(lambda: new_path(result), args.repeat)
+
+    print(f"Resultado: {args.rows} filas x {args.cols} columnas ({payload_bytes / 1024:.0f} KiB JSON), "
+          f"backend: {'orjson' if jsonutil.orjson is not None else 'json'}")
+    print(f"  antes (con volcados de depuración): {old_debug * 1000:8.1f} ms CPU/turno")
+    print(f"  antes (sin volcados):               {old * 1000:8.1f} ms CPU/turno")
+    print(f"  después:                            {new * 1000:8.1f} ms CPU/turno  "
+          f"(x{old / new:.1f} sin volcados, x{old_debug / new:.1f} con volcados)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# benchmarks/check_sql_rewriter.py
+"""
+Comprobación de las reescrituras de app/tools/sql_rewriter.py en los dos dialectos de las tools
+(MySQL y Postgres): LIMIT inyectado o acotado y `SELECT *` expandido a las columnas del catálogo,
+incluidas columnas que son palabras reservadas (`order`, `key`, `group`), que deben salir citadas.
+Cada SQL reescrito se vuelve a analizar con analyze_sql para asegurar que sigue siendo válido, y las
+consultas con comentarios ejecutables de MySQL (/*! */) o hints (/*+ */) deben rechazarse.
+
+Sale con código 1 si alguna comprobación falla.
+
+Uso (desde la raíz del repo):
+    python -m benchmarks.check_sql_rewriter
+"""
+import sys
+
+from app.tools.sql_rewriter import UnsafeQueryError, analyze_sql, rewrite_sql
+
+DIALECTS = ("mysql", "postgres")
+
+# Catálogo de prueba: tabla -> columnas a las que se expande el `*`
+STAR_COLUMNS = (
+    ("pedidos", ("id", "order", "key", "group", "total")),
+    ("clientes", ("id", "nombre", "select")),
+)
+
+# (consulta, max_rows, fragmentos que deben aparecer en el SQL reescrito, sin comillas de dialecto)
+CASES = [
+    ("SELECT * FROM pedidos", 100,
+     ['"id"', '"order"', '"key"', '"group"', '"total"', "LIMIT 100"]),
+    ("SELECT p.* FROM pedidos p WHERE p.total > 10 LIMIT 5000", 100,
+     ['"order"', '"key"', '"group"', "LIMIT 100"]),
+    ("SELECT * FROM pedidos p JOIN clientes c ON c.id = p.id", None,
+     ['p."order"', 'p."group"', 'c."select"', 'c."nombre"']),
+    ("SELECT COUNT(*) FROM pedidos", 100, ["COUNT(*)", "LIMIT 100"]),
+]
+
+# Deben rechazarse en los dos dialectos: comentarios ejecutables de MySQL e hints del optimizador
+REJECTED = [
+    "SELECT id FROM t /*!50000 UNION SELECT SLEEP(5) */ LIMIT 5",
+    "SELECT id FROM t /*M!100000 UNION SELECT SLEEP(5) */",
+    "SELECT /*+ MAX_EXECUTION_TIME(1) */ id FROM t",
+]
+
+
+def _normalize(sql: str, dialect: str) -> str:
+    # Los fragmentos usan comillas dobles; MySQL cita con acentos graves
+    return sql.replace("`", '"') if dialect == "mysql" else sql
+
+
+def main() -> int:
+    failures = 0
+    for dialect in DIALECTS:
+        for query, max_rows, expected in CASES:
+            rewritten = rewrite_sql(analyze_sql(query, dialect), max_rows, STAR_COLUMNS)
+            problems = [fragment for fragment in expected if fragment not in _normalize(rewritten, dialect)]
+            try:
+                analyze_sql(rewritten, dialect)
+            except ValueError as e:
+                problems.append(f"SQL inválido: {e}")
+            if problems:
+                failures += 1
+                print(f"FALLO [{dialect}] {query}\n  -> {rewritten}\n  faltan/errores: {problems}")
+            else:
+                print(f"ok    [{dialect}] {rewritten}")
+        for query in REJECTED:
+            try:
+                analyze_sql(query, dialect)
+            except UnsafeQueryError:
+                print(f"ok    [{dialect}] rechazada: {query}")
+                continue
+            failures += 1
+            print(f"FALLO [{dialect}] aceptada: {query}")
+    print(f"{failures} comprobaciones fallidas" if failures else "Todas las reescrituras son válidas")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,456 @@
+# benchmarks/replay_conversations.py
+"""
+Grabación y reproducción offline de conversaciones reales para medir el coste por turno del
+orquestador contra una línea base guardada.
+
+- record: lee de la BD de conversaciones (CONVERSATION_DB_URL) los mensajes de las sesiones
+  elegidas, con los payloads de chat_message_blobs ya resueltos, y escribe un "cassette" por sesión
+  (una línea JSON, opcionalmente .gz).
+- replay: vuelve a ejecutar cada turno con el ChatOrchestrator actual. Las respuestas del LLM (texto
+  y function_call) y los resultados de las tools se sirven desde el cassette, así que no hay red ni
+  BD externa; la BD de conversaciones es un SQLite en memoria (requiere aiosqlite) con el mismo
+  esquema ORM. Por turno se mide: CPU (mediana de --repeat pasadas, sin contar el propio harness),
+  tiempo real, round-trips a la BD, llamadas al LLM y a tools, bytes del prompt enviado al LLM y pico
+  de memoria asignada (tracemalloc, en una pasada aparte para no distorsionar la CPU).
+
+Con --baseline se comparan los totales y los turnos con la línea base y el código de salida es 1 si
+hay regresiones: cualquier aumento en las métricas deterministas (round-trips, llamadas, bytes del
+prompt) o un aumento de CPU / memoria por encima de --threshold %.
+
+Uso (desde la raíz del repo):
+    python -m benchmarks.replay_conversations record --latest 50 --out cassettes.jsonl.gz
+    python -m benchmarks.replay_conversations record --session-id <id> --session-id <id> --out cassettes.jsonl.gz
+    python -m benchmarks.replay_conversations replay cassettes.jsonl.gz --save-baseline baseline.json
+    python -m benchmarks.replay_conversations replay cassettes.jsonl.gz --baseline baseline.json --channel ws
+"""
+import argparse
+import asyncio
+import contextlib
+import gzip
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from collections import deque
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.core import jsonutil
+from app.core.tool_context import bind_tool_context
+from app.crud import crud_conversation
+from app.db.blob_store import blob_ids_in_message, decode_blob, resolve_blob_refs
+from app.db.models_conversation import ChatMessageBlob, ChatSession
+from app.services.chat_orchestrator import ChatOrchestrator
+from app.tools.base_tool import BaseTool
+from app.tools.mysql_tool import MySQLTool
+from app.tools.tenant_tools import tenant_id_from_session_data
+
+METRICS = (
+    "cpu_ms", "wall_ms", "db_round_trips", "llm_calls", "tool_calls",
+    "prompt_bytes", "max_prompt_bytes", "alloc_peak_kib",
+)
+# No dependen del tiempo: cualquier aumento es una regresión
+EXACT_METRICS = ("db_round_trips", "llm_calls", "tool_calls", "prompt_bytes", "max_prompt_bytes")
+# Con ruido de medida: regresión solo por encima de --threshold
+NOISY_METRICS = ("cpu_ms", "alloc_peak_kib")
+
+# La PK compuesta (id, timestamp) de chat_messages no es autoincremental en SQLite: DDL propio
+_CHAT_MESSAGES_DDL = (
+    "CREATE TABLE chat_messages ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+    "session_id VARCHAR(36) NOT NULL, "
+    "sender VARCHAR(50) NOT NULL, "
+    "message TEXT NOT NULL, "
+    "timestamp DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+)
+
+
+def _open(path: str, mode: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+# --- Grabación ---
+
+async def record(args) -> None:
+    from app.db.database import AsyncSessionLocalConversation, dispose_engines
+
+    since = datetime.fromisoformat(args.since) if args.since else None
+    recorded = 0
+    async with AsyncSessionLocalConversation() as db:
+        session_ids = args.session_id or await crud_conversation.get_recent_session_ids(
+            db, args.latest, user_id=args.user_id, since=since
+        )
+        with _open(args.out, "w") as out:
+            for session_id in session_ids:
+                messages = await crud_conversation.get_messages_by_session(db, session_id=session_id, limit=None)
+                if not messages:
+                    print(f"Sesión {session_id} sin mensajes, se omite")
+                    continue
+                blob_ids = [blob_id for msg in messages for blob_id in blob_ids_in_message(msg.message)]
+                blobs = {blob.id: decode_blob(blob) for blob in await crud_conversation.get_message_blobs(db, blob_ids)}
+                out.write(jsonutil.dumps({
+                    "session_id": session_id,
+                    "recorded_at": datetime.utcnow().isoformat(),
+                    "messages": [{"sender": msg.sender, "message": msg.message} for msg in messages],
+                    "blobs": blobs,
+                }) + "\n")
+                recorded += 1
+    await dispose_engines()
+    print(f"{recorded} sesiones grabadas en {args.out}")
+
+
+def load_cassettes(paths: List[str]) -> List[Dict[str, Any]]:
+    cassettes = []
+    for path in paths:
+        with _open(path, "r") as f:
+            cassettes.extend(jsonutil.loads(line) for line in f if line.strip())
+    return cassettes
+
+
+# --- Cassette -> turnos ---
+
+class RecordedTurn:
+    """Lo que pasó en un turno grabado: el mensaje del usuario y, en orden, las salidas del LLM y de las tools."""
+
+    def __init__(self, user_text: str):
+        self.user_text = user_text
+        self.llm_outputs: List[Dict[str, Any]] = []
+        self.tool_results: List[Any] = []
+
+
+def _parts(message: str) -> Optional[List[Any]]:
+    try:
+        parsed = jsonutil.loads(message)
+    except (jsonutil.JSONDecodeError, TypeError):
+        return None
+    if isinstance(parsed, dict):
+        return [parsed]
+    return parsed if isinstance(parsed, list) else None
+
+
+def recorded_turns(cassette: Dict[str, Any]) -> List[RecordedTurn]:
+    """Turnos del cassette (cada mensaje de usuario abre uno). Se reconstruyen en cada pasada: el orquestador puede mutarlos."""
+    blobs = cassette.get("blobs") or {}
+    turns: List[RecordedTurn] = []
+    for msg in cassette["messages"]:
+        if msg["sender"] == "user":
+            turns.append(RecordedTurn(msg["message"]))
+            continue
+        if not turns:
+            continue # Mensajes anteriores al primer mensaje de usuario (sesión recortada por retención)
+        turn = turns[-1]
+        parts = _parts(msg["message"])
+        if parts is not None:
+            resolve_blob_refs(parts, blobs)
+            calls = [p["function_call"] for p in parts if isinstance(p, dict) and "function_call" in p]
+            responses = [p["function_response"] for p in parts if isinstance(p, dict) and "function_response" in p]
+            if calls:
+                turn.llm_outputs.append({
+                    "text": None,
+                    "tool_calls": [{"name": call["name"], "args": call.get("args") or {}} for call in calls],
+                })
+                continue
+            if responses:
+                for response in responses:
+                    content = response.get("response")
+                    turn.tool_results.append(content.get("content", content) if isinstance(content, dict) else content)
+                continue
+        turn.llm_outputs.append({"text": msg["message"], "tool_calls": []})
+    return turns
+
+
+# --- Dobles del LLM y de la tool ---
+
+class CassetteTool(BaseTool):
+    """Solo aporta el nombre al prompt de sistema: las llamadas las responde CassetteLLM.execute_tool."""
+
+    name: str = "mysql_tool"
+    description: str = "Tool SQL reproducida desde un cassette"
+    parameters: Dict[str, Any] = {"type": "object", "properties": {"query": {"type": "string"}}, "required": ["query"]}
+    engine: str = MySQLTool.engine
+    schema_lookup: str = MySQLTool.schema_lookup
+    database_name: str = "nilo_db"
+
+    async def run(self, **kwargs) -> Dict[str, Any]:
+        raise RuntimeError("CassetteTool no ejecuta consultas")
+
+
+class CassetteLLM:
+    """Sustituye a GeminiLLMHandler: sirve en orden las salidas del LLM y de las tools grabadas en el turno."""
+
+    def __init__(self, measure_prompt: bool = True):
+        self.measure_prompt = measure_prompt
+        self.outputs: deque = deque()
+        self.tool_results: deque = deque()
+        self.stats: Dict[str, Any] = {}
+        self.harness_cpu = 0.0 # CPU gastada midiendo el prompt, que se descuenta del turno
+
+    def begin_turn(self, turn: RecordedTurn, stats: Dict[str, Any]) -> None:
+        self.outputs = deque(turn.llm_outputs)
+        self.tool_results = deque(turn.tool_results)
+        self.stats = stats
+        self.harness_cpu = 0.0
+
+    async def generate_response(self, chat_history: List[Dict[str, Any]], user_prompt: str) -> Dict[str, Any]:
+        self.stats["llm_calls"] += 1
+        if self.measure_prompt:
+            started = time.process_time()
+            size = len(jsonutil.dumps_bytes(chat_history)) + len(user_prompt.encode("utf-8"))
+            self.harness_cpu += time.process_time() - started
+            self.stats["prompt_bytes"] += size
+            self.stats["max_prompt_bytes"] = max(self.stats["max_prompt_bytes"], size)
+        if not self.outputs:
+            self.stats["desync"] = True # El código actual pide más iteraciones que la grabación
+            return {"text": "[replay] Sin más respuestas grabadas del LLM.", "tool_calls": [], "finish_reason": "STOP"}
+        output = self.outputs.popleft()
+        return {"text": output["text"], "tool_calls": output["tool_calls"], "finish_reason": "STOP"}
+
+    async def stream_response(self, chat_history: List[Dict[str, Any]], user_prompt: str, on_text) -> Dict[str, Any]:
+        result = await self.generate_response(chat_history, user_prompt)
+        if result["text"]:
+            await on_text(result["text"])
+        return result
+
+    async def execute_tool(self, tool_name: str, tool_args: Dict[str, Any]) -> Dict[str, Any]:
+        self.stats["tool_calls"] += 1
+        if not self.tool_results:
+            self.stats["desync"] = True
+            return {"error": "[replay] Sin más resultados grabados de tools."}
+        return self.tool_results.popleft()
+
+
+class ReplayOrchestrator(ChatOrchestrator):
+    """ChatOrchestrator con la tool y el LLM del cassette; el resto (CRUD, historial) es el código real."""
+
+    def __init__(self, db_session: AsyncSession, session_id: str, llm: CassetteLLM, keep_history: bool = False):
+        super().__init__(db_session=db_session, session_id=session_id, keep_history=keep_history)
+        self.replay_llm = llm
+        self.replay_tool = CassetteTool()
+
+    @asynccontextmanager
+    async def _session_sql_tool(self):
+        # Misma lectura de la sesión que el original, pero sin abrir la BD externa del tenant
+        if not self._tenant_resolved:
+            session = await crud_conversation.get_chat_session(self.db_session, self.session_id)
+            self.tenant_id = tenant_id_from_session_data(session.session_data) if session is not None else None
+            self._tenant_resolved = True
+        with bind_tool_context(self.session_id, self.tenant_id):
+            yield self.replay_tool
+
+    def _create_llm_handler(self, sql_tool: BaseTool) -> CassetteLLM:
+        self.sql_tool = sql_tool
+        self.available_tools = [sql_tool]
+        return self.replay_llm
+
+
+# --- Reproducción ---
+
+def _create_schema(conn) -> None:
+    ChatSession.__table__.create(conn)
+    ChatMessageBlob.__table__.create(conn)
+    conn.exec_driver_sql(_CHAT_MESSAGES_DDL)
+
+
+async def replay_cassette(
+    cassette: Dict[str, Any], channel: str, measure_prompt: bool = True, trace_alloc: bool = False
+) -> List[Dict[str, Any]]:
+    """Reproduce todas las sesiones del cassette sobre una BD nueva y devuelve las métricas de cada turno."""
+    engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+    round_trips = [0]
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def _count(*_):
+        round_trips[0] += 1
+
+    async with engine.begin() as conn:
+        await conn.run_sync(_create_schema)
+    session_maker = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    session_id = cassette["session_id"]
+    llm = CassetteLLM(measure_prompt)
+    results = []
+    try:
+        async with session_maker() as db:
+            db.add(ChatSession(id=session_id))
+            await db.commit()
+            orchestrator: Optional[ReplayOrchestrator] = None
+            for turn in recorded_turns(cassette):
+                stats: Dict[str, Any] = {metric: 0 for metric in METRICS}
+                stats["desync"] = False
+                llm.begin_turn(turn, stats)
+                # HTTP: un orquestador por petición; WebSocket: uno por conexión, con el historial en memoria
+                if orchestrator is None or channel == "http":
+                    orchestrator = ReplayOrchestrator(db, session_id, llm, keep_history=channel == "ws")
+                trips_before = round_trips[0]
+                if trace_alloc:
+                    tracemalloc.reset_peak()
+                    allocated_before = tracemalloc.get_traced_memory()[0]
+                wall_started = time.perf_counter()
+                cpu_started = time.process_time()
+                await orchestrator.handle_user_message(turn.user_text)
+                stats["cpu_ms"] = (time.process_time() - cpu_started - llm.harness_cpu) * 1000
+                stats["wall_ms"] = (time.perf_counter() - wall_started) * 1000
+                stats["db_round_trips"] = round_trips[0] - trips_before
+                if trace_alloc:
+                    stats["alloc_peak_kib"] = (tracemalloc.get_traced_memory()[1] - allocated_before) / 1024
+                if channel == "http":
+                    await db.rollback() # Como al terminar la petición: la siguiente vuelve a leer la sesión
+                results.append(stats)
+    finally:
+        await engine.dispose()
+    return results
+
+
+async def replay_all(cassettes: List[Dict[str, Any]], channel: str, repeat: int, trace_alloc: bool, verbose: bool) -> Dict[str, Dict[str, Any]]:
+    """Métricas por turno ("session_id#n"): CPU y tiempo real como mediana de `repeat` pasadas."""
+    turns: Dict[str, Dict[str, Any]] = {}
+    with contextlib.ExitStack() as stack:
+        if not verbose:
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+        for cassette in cassettes:
+            passes = [await replay_cassette(cassette, channel) for _ in range(max(1, repeat))]
+            allocations = None
+            if trace_alloc:
+                tracemalloc.start()
+                try:
+                    allocations = await replay_cassette(cassette, channel, measure_prompt=False, trace_alloc=True)
+                finally:
+                    tracemalloc.stop()
+            for index, stats in enumerate(passes[0]):
+                stats["cpu_ms"] = statistics.median(p[index]["cpu_ms"] for p in passes)
+                stats["wall_ms"] = statistics.median(p[index]["wall_ms"] for p in passes)
+                if allocations is not None:
+                    stats["alloc_peak_kib"] = allocations[index]["alloc_peak_kib"]
+                turns[f"{cassette['session_id']}#{index + 1}"] = stats
+    return turns
+
+
+# --- Informe ---
+
+def totals(turns: Dict[str, Dict[str, Any]]) -> Dict[str, float]:
+    summed = {metric: sum(stats[metric] for stats in turns.values()) for metric in METRICS}
+    summed["max_prompt_bytes"] = max((stats["max_prompt_bytes"] for stats in turns.values()), default=0)
+    summed["turns"] = len(turns)
+    summed["desync"] = sum(1 for stats in turns.values() if stats["desync"])
+    return summed
+
+
+def _delta(before: float, after: float) -> str:
+    if not before:
+        return "—" if not after else "nuevo"
+    return f"{(after - before) / before * 100:+.1f}%"
+
+
+def regressions(baseline: Dict[str, Any], turns: Dict[str, Dict[str, Any]], threshold: float) -> List[str]:
+    found = []
+    common = [key for key in turns if key in baseline["turns"]]
+    before = totals({key: baseline["turns"][key] for key in common})
+    after = totals({key: turns[key] for key in common})
+    for metric in EXACT_METRICS:
+        if after[metric] > before[metric]:
+            found.append(f"{metric}: {before[metric]:.0f} -> {after[metric]:.0f}")
+    for metric in NOISY_METRICS:
+        if before[metric] and after[metric] > before[metric] * (1 + threshold / 100):
+            found.append(f"{metric}: {before[metric]:.1f} -> {after[metric]:.1f} ({_delta(before[metric], after[metric])})")
+    for key in common:
+        for metric in ("db_round_trips", "llm_calls", "tool_calls"):
+            if turns[key][metric] > baseline["turns"][key][metric]:
+                found.append(f"{key} {metric}: {baseline['turns'][key][metric]} -> {turns[key][metric]}")
+    return found
+
+
+def report(turns: Dict[str, Dict[str, Any]], baseline: Optional[Dict[str, Any]], top: int) -> None:
+    current = totals(turns)
+    print(f"{current['turns']} turnos reproducidos ({current['desync']} desincronizados con la grabación)")
+    if baseline is None:
+        for metric in METRICS:
+            print(f"  {metric:<18} {current[metric]:>14.1f}   ({current[metric] / max(current['turns'], 1):.1f} por turno)")
+    else:
+        common = [key for key in turns if key in baseline["turns"]]
+        before = totals({key: baseline["turns"][key] for key in common})
+        after = totals({key: turns[key] for key in common})
+        missing = len(baseline["turns"]) - len(common)
+        print(f"Comparación con la línea base ({baseline.get('created_at')}, canal {baseline.get('channel')}): "
+              f"{len(common)} turnos en común, {missing} ausentes")
+        print(f"  {'métrica':<18} {'base':>14} {'actual':>14} {'delta':>9}")
+        for metric in METRICS:
+            print(f"  {metric:<18} {before[metric]:>14.1f} {after[metric]:>14.1f} {_delta(before[metric], after[metric]):>9}")
+        slower = sorted(common, key=lambda key: turns[key]["cpu_ms"] - baseline["turns"][key]["cpu_ms"], reverse=True)
+        print("Turnos con más CPU añadida:")
+        for key in slower[:top]:
+            print(f"  {key:<48} {baseline['turns'][key]['cpu_ms']:>9.2f} -> {turns[key]['cpu_ms']:>9.2f} ms")
+    desynced = [key for key, stats in turns.items() if stats["desync"]]
+    if desynced:
+        print("Turnos desincronizados (el código pidió más LLM/tools que la grabación): " + ", ".join(desynced[:top]))
+
+
+async def replay(args) -> int:
+    cassettes = load_cassettes(args.cassettes)
+    turns = await replay_all(cassettes, args.channel, args.repeat, not args.no_alloc, args.verbose)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = jsonutil.loads(f.read())
+    report(turns, baseline, args.top)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            f.write(jsonutil.dumps({
+                "created_at": datetime.utcnow().isoformat(),
+                "channel": args.channel,
+                "totals": totals(turns),
+                "turns": turns,
+            }))
+        print(f"Línea base guardada en {args.save_baseline}")
+
+    if baseline is not None:
+        found = regressions(baseline, turns, args.threshold)
+        if found:
+            print("REGRESIONES:")
+            for line in found:
+                print(f"  {line}")
+            return 1
+        print("Sin regresiones respecto a la línea base")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = commands.add_parser("record", help="Graba sesiones reales de la BD de conversaciones")
+    record_parser.add_argument("--session-id", action="append", help="Sesión a grabar (repetible)")
+    record_parser.add_argument("--latest", type=int, default=20, help="Sin --session-id: las N sesiones más recientes")
+    record_parser.add_argument("--user-id", help="Sin --session-id: solo sesiones de este usuario")
+    record_parser.add_argument("--since", help="Sin --session-id: sesiones creadas desde esta fecha ISO")
+    record_parser.add_argument("--out", required=True, help="Fichero de cassettes (.jsonl o .jsonl.gz)")
+
+    replay_parser = commands.add_parser("replay", help="Reproduce cassettes y mide el coste por turno")
+    replay_parser.add_argument("cassettes", nargs="+", help="Ficheros de cassettes")
+    replay_parser.add_argument("--channel", choices=("http", "ws"), default="http",
+                               help="http: orquestador por turno; ws: orquestador por sesión con historial en memoria")
+    replay_parser.add_argument("--repeat", type=int, default=3, help="Pasadas por cassette (CPU y tiempo: mediana)")
+    replay_parser.add_argument("--no-alloc", action="store_true", help="No medir el pico de memoria (más rápido)")
+    replay_parser.add_argument("--baseline", help="Línea base con la que comparar (código de salida 1 si hay regresiones)")
+    replay_parser.add_argument("--save-baseline", help="Guarda las métricas de esta ejecución como línea base")
+    replay_parser.add_argument("--threshold", type=float, default=15.0, help="%% de aumento tolerado en CPU y memoria")
+    replay_parser.add_argument("--top", type=int, default=10, help="Turnos a listar en el informe")
+    replay_parser.add_argument("--verbose", action="store_true", help="Muestra los logs del orquestador")
+
+    args = parser.parse_args()
+    if args.command == "record":
+        asyncio.run(record(args))
+    else:
+        sys.exit(asyncio.run(replay(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,15 @@
+# gunicorn.conf.py
+# Modo multi-proceso: gunicorn gestiona N workers uvicorn (uno por núcleo disponible).
+# Engines, pools y el cliente de Gemini se crean dentro de cada worker la primera vez que
+# se usan (app/core/process_local.py), por lo que cargar la app antes del fork es seguro.
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_class = "uvicorn.workers.UvicornWorker"
+# Cargar la app en el master reduce memoria (copy-on-write) y el tiempo de arranque de cada worker
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+# Los turnos con varias tools pueden tardar; el worker no debe morir por un turno largo
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = 5